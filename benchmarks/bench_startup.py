@@ -0,0 +1,146 @@
+"""
+Benchmark the startup time of the VarNoiseDB command line and write the
+results as JSON.
+
+Every case runs the command line in a fresh interpreter --repeat times, the
+way workflow managers call it, and records the median and fastest wall time.
+The cases cover --version, the help texts, an error in the arguments and a
+lookup in an empty SQLite database. Every case is also run once more to
+record which of the heavy dependencies it imported.
+
+Results of two runs, for example of two commits, are compared with
+--compare, which fails with --max-slowdown if any case got slower by more
+than that factor.
+
+Usage:
+    python benchmarks/bench_startup.py [--repeat 20] [--output results.json]
+    python benchmarks/bench_startup.py --compare baseline.json results.json [--max-slowdown 1.2]
+"""
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+from bench_suite import _git_commit
+
+CASES = {
+    'version': ['--version'],
+    'help': ['--help'],
+    'load-help': ['load', '--help'],
+    'bad-argument': ['load', '--no-such-option'],
+    'query': ['query', 'chr1:1-1000'],
+}
+
+# Top-level packages whose import dominates the startup time
+HEAVY_MODULES = ('alembic', 'cerberus', 'cyvcf2', 'mysql', 'numpy', 'psycopg2', 'sqlalchemy', 'yaml')
+
+# Runs the command line like the VarNoiseDB entry point
+_RUN_CLI = """
+import sys
+from varnoisedb.cli.cli import cli
+try:
+    cli(sys.argv[1:], prog_name='VarNoiseDB')
+except SystemExit:
+    pass
+"""
+
+# Also prints the imported packages as the last line
+_LIST_IMPORTS = _RUN_CLI + """
+import json
+print()
+print(json.dumps(sorted({name.split('.')[0] for name in sys.modules})))
+"""
+
+def _imported(config_path, args):
+    """Return the heavy packages imported by a run of the command line."""
+    result = subprocess.run([sys.executable, '-c', _LIST_IMPORTS, '--config', config_path, *args], capture_output=True, text=True)
+    imported = json.loads(result.stdout.strip().splitlines()[-1])
+    return [name for name in HEAVY_MODULES if name in imported]
+
+def run_case(config_path, args, repeat):
+    """Run the command line with args repeat times and return the measurements."""
+    seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-c', _RUN_CLI, '--config', config_path, *args], capture_output=True)
+        seconds.append(time.perf_counter() - start)
+    return {
+        'args': args,
+        'median_seconds': statistics.median(seconds),
+        'min_seconds': min(seconds),
+        'heavy_imports': _imported(config_path, args),
+    }
+
+def compare(baseline_path, results_path, max_slowdown=None):
+    """Print the change in median startup time of every case and return the cases slower than max_slowdown."""
+    with open(baseline_path) as file:
+        baseline = json.load(file)
+    with open(results_path) as file:
+        results = json.load(file)
+    print(f"Comparing {results['meta']['commit']} against {baseline['meta']['commit']}")
+    regressions = []
+    for case, result in results['results'].items():
+        if case not in baseline['results']:
+            continue
+        before = baseline['results'][case]['median_seconds']
+        after = result['median_seconds']
+        slowdown = after / before if before else float('nan')
+        print(f"{case:>12}: {before * 1000:8.1f} ms -> {after * 1000:8.1f} ms ({slowdown:5.2f}x)")
+        if max_slowdown is not None and slowdown > max_slowdown:
+            regressions.append(case)
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=20, help='Number of runs of every case')
+    parser.add_argument('--output', help='Write the results as JSON to this file')
+    parser.add_argument('--compare', nargs=2, metavar=('BASELINE', 'RESULTS'), help='Compare two result files and exit')
+    parser.add_argument('--max-slowdown', type=float,
+                        help='With --compare, exit with an error if a case is slower than the baseline by more than this factor')
+    args = parser.parse_args()
+
+    if args.compare:
+        regressions = compare(*args.compare, args.max_slowdown)
+        if regressions:
+            sys.exit(f"Startup got slower by more than {args.max_slowdown}x for: {', '.join(regressions)}")
+        return
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        config_path = os.path.join(work_dir, 'config.yaml')
+        with open(config_path, 'w') as file:
+            file.write(f"database:\n  type: sqlite\n  name: {os.path.join(work_dir, 'startup.db')}\n")
+        subprocess.run([sys.executable, '-c', _RUN_CLI, '--config', config_path, 'init'], capture_output=True, check=True)
+
+        results = {}
+        for case, case_args in CASES.items():
+            results[case] = run_case(config_path, case_args, args.repeat)
+            print(f"{case:>12}: median {results[case]['median_seconds'] * 1000:8.1f} ms, "
+                  f"min {results[case]['min_seconds'] * 1000:8.1f} ms, "
+                  f"imports {', '.join(results[case]['heavy_imports']) or 'none'}", file=sys.stderr)
+
+    output = {
+        'meta': {
+            'commit': _git_commit(),
+            'created': datetime.now(timezone.utc).isoformat(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'repeat': args.repeat,
+        },
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(output, file, indent=2)
+    else:
+        json.dump(output, sys.stdout, indent=2)
+        print()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+"""
+Benchmark the scalar update_stats against the vectorized update_multiple_stats.
+
+Usage:
+    python benchmarks/bench_update_stats.py [--size 100000] [--repeat 5]
+"""
+
+import argparse
+import timeit
+import numpy as np
+
+from varnoisedb.utils import update_stats, update_multiple_stats
+
+def make_inputs(size, seed=0):
+    rng = np.random.default_rng(seed)
+    ns = rng.integers(1, 100, size)
+    means = rng.random(size) * 0.1
+    std_devs = rng.random(size) * 0.05
+    new_vals = rng.random(size) * 0.1
+    return means, std_devs, ns, new_vals
+
+def scalar(means, std_devs, ns, new_vals, operation):
+    return [
+        update_stats(mean, std_dev, n, new_val, operation=operation)
+        for mean, std_dev, n, new_val in zip(means.tolist(), std_devs.tolist(), ns.tolist(), new_vals.tolist())
+    ]
+
+def vectorized(means, std_devs, ns, new_vals, operation):
+    return update_multiple_stats(means, std_devs, ns, new_vals, operation=operation)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size', type=int, default=100000, help='Number of positions per batch')
+    parser.add_argument('--repeat', type=int, default=5, help='Number of timing repeats')
+    args = parser.parse_args()
+
+    inputs = make_inputs(args.size)
+    for operation in ['add', 'remove']:
+        # Both paths must agree before their timings are worth comparing
+        expected = np.array(scalar(*inputs, operation), dtype=np.float64).T
+        actual = vectorized(*inputs, operation)
+        for e, a in zip(expected, actual):
+            np.testing.assert_allclose(a, e, rtol=1e-9, atol=1e-12)
+
+        scalar_time = min(timeit.repeat(lambda: scalar(*inputs, operation), number=1, repeat=args.repeat))
+        vector_time = min(timeit.repeat(lambda: vectorized(*inputs, operation), number=1, repeat=args.repeat))
+        print(
+            f"{operation:>6}: scalar {scalar_time * 1000:8.2f} ms, "
+            f"vectorized {vector_time * 1000:8.2f} ms, "
+            f"speedup {scalar_time / vector_time:6.1f}x ({args.size} positions)"
+        )
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,147 @@
+"""
+Generate synthetic single-sample GVCF files for benchmarks.
+
+Every contig gets a shared layout of records, reference blocks with an END
+and variant sites, some of them multi-allelic or deletions. Every sample
+keeps each record of the layout with probability --overlap, so most
+positions are shared between samples as in real cohorts. Depths are Poisson
+distributed and non-reference depths binomial with a low noise allele
+frequency. Files are written bgzipped with a tabix index unless --plain is
+given, together with a manifest.json describing them.
+
+Usage:
+    python benchmarks/generate_gvcf.py OUT_DIR [--samples 10] [--contigs 2] [--records 100000]
+        [--block-fraction 0.7] [--multiallelic-fraction 0.05] [--overlap 0.9] [--seed 0] [--plain]
+"""
+
+import argparse
+import json
+import os
+import numpy as np
+
+from varnoisedb.bgzf import BgzfWriter, TabixIndex
+
+HEADER = """##fileformat=VCFv4.2
+{contigs}
+##ALT=<ID=NON_REF,Description="Represents any possible alternative allele not already represented at this location">
+##INFO=<ID=END,Number=1,Type=Integer,Description="Stop position of the interval">
+##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">
+##FORMAT=<ID=DP,Number=1,Type=Integer,Description="Approximate read depth">
+##FORMAT=<ID=AD,Number=R,Type=Integer,Description="Allelic depths for the ref and alt alleles in the order listed">
+#CHROM	POS	ID	REF	ALT	QUAL	FILTER	INFO	FORMAT	{sample}
+"""
+
+# Record kinds of the layout
+BLOCK, SITE, MULTIALLELIC, DELETION = range(4)
+
+class Layout:
+    """The records of one contig shared by all samples: start, end and kind of every record."""
+    def __init__(self, rng, n_records, block_fraction, multiallelic_fraction):
+        kind = np.where(rng.random(n_records) < block_fraction, BLOCK, SITE)
+        sites = np.flatnonzero(kind == SITE)
+        special = sites[rng.random(len(sites)) < multiallelic_fraction]
+        kind[special] = np.where(rng.random(len(special)) < 0.5, MULTIALLELIC, DELETION)
+        # Blocks cover 1 to 200 bp, deletions 2 to 5 bp of reference
+        span = np.where(kind == BLOCK, rng.integers(1, 200, n_records), 1)
+        span[kind == DELETION] = rng.integers(2, 6, int((kind == DELETION).sum()))
+        self.kind = kind
+        self.pos = np.concatenate(([1], 1 + np.cumsum(span[:-1]))).astype(np.int64)
+        self.end = self.pos + span - 1
+
+    @property
+    def length(self):
+        return int(self.end[-1]) if len(self.end) else 1
+
+def _format_records(rng, chr, layout, keep):
+    """Format the kept records of a layout for one sample as VCF lines, returned with their start and end."""
+    kind = layout.kind[keep]
+    pos = layout.pos[keep]
+    end = layout.end[keep]
+    n = len(pos)
+    dp = rng.poisson(30, n) + 1
+    af = rng.beta(1, 200, n)
+    non_ref = rng.binomial(dp, af)
+    alt = rng.binomial(dp - non_ref, 0.4) * (kind >= MULTIALLELIC)
+    ref = dp - non_ref - alt
+
+    lines = []
+    for k, p, e, d, r, a, nr in zip(kind.tolist(), pos.tolist(), end.tolist(), dp.tolist(), ref.tolist(), alt.tolist(), non_ref.tolist()):
+        if k == BLOCK:
+            lines.append(f"{chr}\t{p}\t.\tA\t<NON_REF>\t.\t.\tEND={e}\tGT:DP:AD\t0/0:{d}:{r},{nr}\n")
+        elif k == SITE:
+            lines.append(f"{chr}\t{p}\t.\tA\t<NON_REF>\t.\t.\t.\tGT:DP:AD\t0/0:{d}:{r},{nr}\n")
+        elif k == MULTIALLELIC:
+            lines.append(f"{chr}\t{p}\t.\tA\tC,<NON_REF>\t50\t.\t.\tGT:DP:AD\t0/1:{d}:{r},{a},{nr}\n")
+        else:
+            lines.append(f"{chr}\t{p}\t.\t{'A' * (e - p + 1)}\tA,<NON_REF>\t50\t.\t.\tGT:DP:AD\t0/1:{d}:{r},{a},{nr}\n")
+    return lines, pos, end
+
+def write_sample(path, sample, layouts, rng, overlap, bgzf=True):
+    """Write the GVCF file of one sample and return its number of records."""
+    contigs = '\n'.join(f"##contig=<ID={chr},length={layout.length}>" for chr, layout in layouts.items())
+    header = HEADER.format(contigs=contigs, sample=sample).encode()
+    index = TabixIndex() if bgzf else None
+    n_records = 0
+    with (BgzfWriter(path) if bgzf else open(path, 'wb')) as file:
+        file.write(header)
+        for chr, layout in layouts.items():
+            keep = rng.random(len(layout.pos)) < overlap
+            lines, pos, end = _format_records(rng, chr, layout, keep)
+            data = [line.encode() for line in lines]
+            if bgzf:
+                offset = file.data_offset()
+                for line, p, e in zip(data, pos.tolist(), end.tolist()):
+                    index.add(chr, p - 1, e, offset, offset + len(line))
+                    offset += len(line)
+            file.write(b''.join(data))
+            n_records += len(data)
+    if bgzf:
+        index.write(path + '.tbi', file)
+    return n_records
+
+def generate(out_dir, samples=10, contigs=2, records=100000, block_fraction=0.7, multiallelic_fraction=0.05,
+             overlap=0.9, seed=0, bgzf=True):
+    """Generate the GVCF files of a synthetic cohort in out_dir and return its manifest."""
+    os.makedirs(out_dir, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    layouts = {f"chr{i + 1}": Layout(rng, records, block_fraction, multiallelic_fraction) for i in range(contigs)}
+    files = []
+    for i in range(samples):
+        sample = f"SYN{i:05d}"
+        path = os.path.join(out_dir, f"{sample}.g.vcf{'.gz' if bgzf else ''}")
+        n_records = write_sample(path, sample, layouts, rng, overlap, bgzf)
+        files.append({'sample': sample, 'path': os.path.abspath(path), 'records': n_records})
+    manifest = {
+        'parameters': {
+            'samples': samples, 'contigs': contigs, 'records': records, 'block_fraction': block_fraction,
+            'multiallelic_fraction': multiallelic_fraction, 'overlap': overlap, 'seed': seed, 'bgzf': bgzf,
+        },
+        'files': files,
+    }
+    with open(os.path.join(out_dir, 'manifest.json'), 'w') as file:
+        json.dump(manifest, file, indent=2)
+    return manifest
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('out_dir', help='Directory to write the GVCF files and manifest.json to')
+    parser.add_argument('--samples', type=int, default=10, help='Number of samples, one file each')
+    parser.add_argument('--contigs', type=int, default=2, help='Number of contigs')
+    parser.add_argument('--records', type=int, default=100000, help='Number of records per contig in the shared layout')
+    parser.add_argument('--block-fraction', type=float, default=0.7, help='Fraction of records that are reference blocks')
+    parser.add_argument('--multiallelic-fraction', type=float, default=0.05,
+                        help='Fraction of variant sites that are multi-allelic or deletions')
+    parser.add_argument('--overlap', type=float, default=0.9, help='Probability that a sample has a record of the layout')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the random generator')
+    parser.add_argument('--plain', action='store_true', help='Write uncompressed files without an index')
+    args = parser.parse_args()
+
+    manifest = generate(
+        args.out_dir, args.samples, args.contigs, args.records, args.block_fraction, args.multiallelic_fraction,
+        args.overlap, args.seed, bgzf=not args.plain
+    )
+    n_records = sum(file['records'] for file in manifest['files'])
+    print(f"Wrote {len(manifest['files'])} GVCF files with {n_records} records to {args.out_dir}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+"""
+This module annotates a call VCF with the noise statistics in the database.
+The call VCF is read in file order and the variants table is read alongside
+it with one range scan per run of nearby records, so the records and the
+stored variants are merge joined in a single sequential pass.
+"""
+
+import numpy as np
+from cyvcf2 import VCF
+
+from varnoisedb.bgzf import BgzfWriter, TabixIndex
+from varnoisedb.vcf_writer import INFO_FIELDS, is_bgzf_path
+
+# The statistics written for every record found in the database, as (INFO ID, variants column)
+ANNOTATIONS = [
+    ('MEAN_AF', 'mean_non_ref_af'),
+    ('SD_AF', 'sd_non_ref_af'),
+    ('MAX_AF', 'max_non_ref_af'),
+    ('SAMPLES', 'number_of_samples'),
+]
+
+Z_SCORE_FIELD = ('Z_AF', '1', 'Float', 'Z-score of the non-reference allele frequency of the first sample against the noise distribution')
+
+# Records further apart than this many bp are fetched with separate range scans by default
+DEFAULT_MAX_GAP = 1000
+
+def _header_fields():
+    ids = {info_id for info_id, _ in ANNOTATIONS}
+    return [field for field in INFO_FIELDS if field[0] in ids] + [Z_SCORE_FIELD]
+
+def _non_ref_af(record):
+    """Return the non-reference allele frequency of the first sample from FORMAT/AD, or None."""
+    try:
+        ad = record.format('AD')
+    except KeyError:
+        return None
+    if ad is None:
+        return None
+    ad = ad[0]
+    # Missing depths are negative in cyvcf2
+    depth = ad[ad >= 0].sum()
+    if depth <= 0 or ad[0] < 0:
+        return None
+    return float(depth - ad[0]) / depth
+
+def _annotate(record, row):
+    for info_id, column in ANNOTATIONS:
+        value = getattr(row, column)
+        if value is not None:
+            record.INFO[info_id] = value
+    af = _non_ref_af(record)
+    if af is not None and row.mean_non_ref_af is not None and row.sd_non_ref_af:
+        record.INFO['Z_AF'] = (af - row.mean_non_ref_af) / row.sd_non_ref_af
+
+def _runs(vcf, chunk_size, max_gap):
+    """Group the records into runs on one chromosome with at most max_gap bp between neighbours."""
+    run = []
+    seen = set()
+    chr = None
+    last_pos = 0
+    for record in vcf:
+        if record.CHROM != chr:
+            if record.CHROM in seen:
+                raise ValueError(f"The VCF file is not sorted: records for {record.CHROM} are not contiguous")
+            seen.add(record.CHROM)
+            chr = record.CHROM
+        elif record.POS < last_pos:
+            raise ValueError(f"The VCF file is not sorted: {chr}:{record.POS} after {chr}:{last_pos}")
+        if run and (record.CHROM != run[-1].CHROM or record.POS - last_pos > max_gap or len(run) >= chunk_size):
+            yield run
+            run = []
+        run.append(record)
+        last_pos = record.POS
+    if run:
+        yield run
+
+def annotate_vcf(source, vcf_path, output, chunk_size=10000, max_gap=DEFAULT_MAX_GAP):
+    """Annotate a sorted VCF file with the noise statistics of the database.
+
+    source is a DatabaseAdapter or a Snapshot, anything providing
+    fetch_variants(chr, start, end). Records are matched to variants by
+    chromosome and position. Output ending with .gz is written as BGZF and
+    indexed with tabix as output + '.tbi'.
+
+    Returns the number of records written and the number of those annotated.
+    """
+    vcf = VCF(vcf_path)
+    for info_id, number, type, description in _header_fields():
+        if not vcf.contains(info_id):
+            vcf.add_info_to_header({'ID': info_id, 'Number': number, 'Type': type, 'Description': description})
+
+    bgzf = is_bgzf_path(output)
+    index = TabixIndex() if bgzf else None
+    file = BgzfWriter(output) if bgzf else open(output, 'wb')
+
+    n_records = 0
+    n_annotated = 0
+    with file:
+        file.write(vcf.raw_header.encode())
+        for run in _runs(vcf, chunk_size, max_gap):
+            chr = run[0].CHROM
+            rows = source.fetch_variants(chr, run[0].POS, run[-1].POS)
+            row_pos = np.fromiter((row.pos for row in rows), dtype=np.int64, count=len(rows))
+            record_pos = np.fromiter((record.POS for record in run), dtype=np.int64, count=len(run))
+            idx = np.searchsorted(row_pos, record_pos)
+
+            lines = []
+            offset = file.data_offset() if bgzf else 0
+            for record, i in zip(run, idx.tolist()):
+                if i < len(rows) and rows[i].pos == record.POS:
+                    _annotate(record, rows[i])
+                    n_annotated += 1
+                line = str(record).encode()
+                if bgzf:
+                    index.add(chr, record.POS - 1, record.end, offset, offset + len(line))
+                    offset += len(line)
+                lines.append(line)
+            file.write(b''.join(lines))
+            n_records += len(run)
+
+    if bgzf:
+        index.write(output + '.tbi', file)
+    vcf.close()
+    return (n_records, n_annotated)
@@ -0,0 +1,156 @@
+"""
+This module chooses the batch size of loads with --batch-size auto. The
+batch size is bounded by the limits of the backend: the bound parameters of
+a statement on SQLite and PostgreSQL, as the stored rows of a batch are
+fetched with an IN list of its positions, and the size of a statement on
+MySQL, whose driver sends the rows of an executemany as one multi-row
+INSERT of at most max_allowed_packet bytes.
+
+Within these limits, BatchSizer starts from the fixed default and doubles
+the batch size as long as that raises the number of rows written per second
+and the batches are written within the latency target. When a batch size
+writes slower, it settles on the best one. Batches over the latency target,
+which hold locks and delay checkpoints for longer, or a growth of the peak
+memory of the process beyond the memory budget halve the batch size and
+lower its limit.
+"""
+
+import logging
+import sqlite3
+import sys
+from sqlalchemy import text
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, where the peak memory is not observed
+    resource = None
+
+DEFAULT_BATCH_SIZE = 1000
+
+# Bound parameters used by a statement besides the positions, such as the contig id
+_RESERVED_PARAMETERS = 16
+
+# The protocol of PostgreSQL numbers the parameters of a statement with 16 bits
+_POSTGRESQL_MAX_PARAMETERS = 65535
+
+# Upper bound of the bytes of one row in a multi-row INSERT of the variants table
+_MYSQL_ROW_BYTES = 256
+
+# Estimated bytes of a row in memory while it is written, as Python mappings and driver parameters
+_ROW_BYTES = 2048
+
+# Estimated bytes of a row of a parsed batch waiting to be written, as NumPy columns
+_PARSED_ROW_BYTES = 128
+
+def _sqlite_max_parameters(dbapi_connection):
+    if hasattr(dbapi_connection, 'getlimit'):
+        return dbapi_connection.getlimit(sqlite3.SQLITE_LIMIT_VARIABLE_NUMBER)
+    # The compiled-in default, raised in SQLite 3.32
+    return 32766 if sqlite3.sqlite_version_info >= (3, 32, 0) else 999
+
+def max_batch_size(db_adapter):
+    """Return the largest number of rows of a batch the backend accepts in one statement."""
+    with db_adapter.engine.connect() as connection:
+        if db_adapter.db_type == 'sqlite':
+            limit = _sqlite_max_parameters(connection.connection.dbapi_connection)
+        elif db_adapter.db_type == 'mysql':
+            limit = connection.execute(text("SELECT @@max_allowed_packet")).scalar() // _MYSQL_ROW_BYTES
+        else:
+            limit = _POSTGRESQL_MAX_PARAMETERS
+    return max(limit - _RESERVED_PARAMETERS, 1)
+
+def _peak_memory():
+    """Return the peak resident memory of the process in bytes, None where it cannot be read."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Reported in bytes on macOS and in KiB elsewhere
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+class BatchSizer:
+    """The batch size of a load, adapted to the measured write latency and memory.
+
+    size is the number of records of the next batch of every GVCF file,
+    read by the parsers whenever they start a batch. observe() is called
+    with the number of rows and the seconds of every written batch. The
+    batches of n_files files are merged into batches of up to n_files times
+    size rows, so the limit of the backend is shared between the files.
+    The prefetch batches parsed ahead at the previous size are not measured
+    after a change of the size.
+    """
+    # Batches written at a size before its throughput is compared
+    WINDOW = 3
+    # Gain in rows per second a larger batch size must bring
+    MIN_GAIN = 0.05
+
+    def __init__(self, limit, n_files=1, start=DEFAULT_BATCH_SIZE, max_seconds=1.0, memory_budget=256 * 2 ** 20,
+                 prefetch=0):
+        # The parsed batches waiting in the prefetch queue are also held in memory
+        row_bytes = _ROW_BYTES + prefetch * _PARSED_ROW_BYTES
+        self.limit = max(min(limit, memory_budget // row_bytes) // n_files, 1)
+        self.minimum = min(100, self.limit)
+        self.size = max(min(start, self.limit), self.minimum)
+        self.max_seconds = max_seconds
+        self.memory_budget = memory_budget
+        self.prefetch = prefetch
+        self.settled = False
+        self._best = None
+        self._rows = 0
+        self._seconds = 0.0
+        self._batches = 0
+        self._skip = 0
+        self._base_memory = _peak_memory()
+
+    def __repr__(self):
+        return f"<BatchSizer(size={self.size}, limit={self.limit}, settled={self.settled})>"
+
+    def observe(self, n_rows, seconds):
+        """Record a written batch and adapt the size once WINDOW batches were written at it."""
+        if self._skip:
+            self._skip -= 1
+            return
+        self._rows += n_rows
+        self._seconds += seconds
+        self._batches += 1
+        if self._batches < self.WINDOW:
+            return
+        rate = self._rows / self._seconds if self._seconds > 0 else float('inf')
+        latency = self._seconds / self._batches
+        (self._rows, self._seconds, self._batches) = (0, 0.0, 0)
+
+        memory = _peak_memory()
+        if memory is not None and self._base_memory is not None and memory - self._base_memory > self.memory_budget:
+            # The peak never drops again, so the size is not raised after this
+            self._base_memory = memory
+            self._shrink("the memory budget was exceeded")
+        elif latency > self.max_seconds:
+            self._shrink(f"batches took {latency:.2f}s to write")
+        elif not self.settled:
+            self._grow(rate)
+
+    def _grow(self, rate):
+        if self._best is None or rate > self._best[0] * (1 + self.MIN_GAIN):
+            self._best = (rate, self.size)
+            if self.size < self.limit:
+                self._resize(min(2 * self.size, self.limit))
+                return
+        self._resize(self._best[1])
+        self.settled = True
+        logging.debug(f"Settled on a batch size of {self.size} rows at {self._best[0]:.0f} rows per second")
+
+    def _shrink(self, reason):
+        if self.size <= self.minimum:
+            return
+        self.limit = max(self.size // 2, self.minimum)
+        self._resize(self.limit)
+        # Throughput measured at larger sizes no longer applies
+        self._best = None
+        self.settled = True
+        logging.info(f"Lowered the batch size to {self.size} rows, {reason}")
+
+    def _resize(self, size):
+        if size != self.size:
+            self.size = size
+            # The batches in the prefetch queue and the one waiting to be queued
+            self._skip = self.prefetch + 1 if self.prefetch else 0
@@ -0,0 +1,155 @@
+"""
+This module writes BGZF compressed files and tabix (.tbi) indices for them.
+BGZF is the blocked gzip format used by htslib, which allows random access to
+region queries through an index.
+"""
+
+import struct
+import zlib
+
+# htslib fills blocks with at most this many uncompressed bytes
+_BLOCK_DATA_SIZE = 0xff00
+_EOF_BLOCK = bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000000000')
+
+# Tabix bins cover 2**14 bp at the finest level and the linear index uses the same window
+MIN_SHIFT = 14
+_TBX_VCF = 2
+
+def reg2bin(beg, end):
+    """Return the smallest tabix bin containing the 0-based, end exclusive interval [beg, end)."""
+    end -= 1
+    if beg >> 14 == end >> 14:
+        return ((1 << 15) - 1) // 7 + (beg >> 14)
+    if beg >> 17 == end >> 17:
+        return ((1 << 12) - 1) // 7 + (beg >> 17)
+    if beg >> 20 == end >> 20:
+        return ((1 << 9) - 1) // 7 + (beg >> 20)
+    if beg >> 23 == end >> 23:
+        return ((1 << 6) - 1) // 7 + (beg >> 23)
+    if beg >> 26 == end >> 26:
+        return ((1 << 3) - 1) // 7 + (beg >> 26)
+    return 0
+
+class BgzfWriter:
+    """Write a BGZF file.
+
+    Every block except the last holds exactly the same amount of uncompressed
+    data, so a position in the uncompressed data (a data offset) can be turned
+    into the virtual offset stored by tabix indices once its block has been
+    written: the compressed offset of the block shifted left by 16 bits plus
+    the offset within the uncompressed block.
+    """
+    def __init__(self, path, compresslevel=6):
+        self.path = path
+        self.compresslevel = compresslevel
+        self._file = open(path, 'wb')
+        self._buffer = bytearray()
+        self._block_offsets = [0]
+        self._data_offset = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def data_offset(self):
+        """Return the number of uncompressed bytes written so far."""
+        return self._data_offset
+
+    def virtual_offset(self, data_offset):
+        """Convert a data offset to a virtual offset. Its block must have been written, or be the current one."""
+        block, within = divmod(data_offset, _BLOCK_DATA_SIZE)
+        return (self._block_offsets[block] << 16) | within
+
+    def tell(self):
+        """Return the virtual offset of the next byte."""
+        return self.virtual_offset(self._data_offset)
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode()
+        self._buffer += data
+        self._data_offset += len(data)
+        while len(self._buffer) >= _BLOCK_DATA_SIZE:
+            self._write_block(bytes(self._buffer[:_BLOCK_DATA_SIZE]))
+            del self._buffer[:_BLOCK_DATA_SIZE]
+
+    def close(self):
+        if self._file.closed:
+            return
+        if self._buffer:
+            self._write_block(bytes(self._buffer))
+            self._buffer.clear()
+        self._file.write(_EOF_BLOCK)
+        self._file.close()
+
+    def _write_block(self, data):
+        compressor = zlib.compressobj(self.compresslevel, zlib.DEFLATED, -15)
+        compressed = compressor.compress(data) + compressor.flush()
+        block_size = 18 + len(compressed) + 8
+        header = struct.pack(
+            '<4BI2BH2BHH', 0x1f, 0x8b, 8, 4, 0, 0, 0xff, 6, ord('B'), ord('C'), 2, block_size - 1
+        )
+        self._file.write(header + compressed + struct.pack('<2I', zlib.crc32(data), len(data)))
+        self._block_offsets.append(self._block_offsets[-1] + block_size)
+
+class TabixIndex:
+    """Build a tabix index for a coordinate sorted VCF written with BgzfWriter.
+
+    Records must be added in file order with add(), giving their 0-based, end
+    exclusive interval and the offsets before and after the record. Several
+    consecutive records in the same bin can be added at once with the interval
+    of the first one. The offsets are either virtual offsets, or data offsets
+    that are converted by the writer when the index is written.
+    """
+    def __init__(self):
+        self._names = []
+        self._bins = []
+        self._linear = []
+
+    def add(self, chr, beg, end, start_offset, end_offset):
+        if not self._names or self._names[-1] != chr:
+            if chr in self._names:
+                raise ValueError(f"Records for {chr} are not contiguous, the file cannot be indexed")
+            self._names.append(chr)
+            self._bins.append({})
+            self._linear.append([])
+
+        chunks = self._bins[-1].setdefault(reg2bin(beg, end), [])
+        if chunks and chunks[-1][1] == start_offset:
+            chunks[-1][1] = end_offset
+        else:
+            chunks.append([start_offset, end_offset])
+
+        linear = self._linear[-1]
+        last_window = (end - 1) >> MIN_SHIFT
+        if last_window >= len(linear):
+            linear.extend([None] * (last_window + 1 - len(linear)))
+        for window in range(beg >> MIN_SHIFT, last_window + 1):
+            if linear[window] is None:
+                linear[window] = start_offset
+
+    def write(self, path, writer=None):
+        """Write the index to path, converting data offsets with the closed writer if given."""
+        resolve = writer.virtual_offset if writer is not None else (lambda offset: offset)
+        names = b''.join(name.encode() + b'\0' for name in self._names)
+        data = bytearray(b'TBI\x01')
+        data += struct.pack('<8i', len(self._names), _TBX_VCF, 1, 2, 0, ord('#'), 0, len(names))
+        data += names
+        for bins, linear in zip(self._bins, self._linear):
+            data += struct.pack('<i', len(bins))
+            for bin_number in sorted(bins):
+                chunks = bins[bin_number]
+                data += struct.pack('<Ii', bin_number, len(chunks))
+                for start_offset, end_offset in chunks:
+                    data += struct.pack('<2Q', resolve(start_offset), resolve(end_offset))
+            # Empty windows point at the previous record, which is a safe lower bound
+            offsets = []
+            previous = 0
+            for offset in linear:
+                previous = previous if offset is None else resolve(offset)
+                offsets.append(previous)
+            data += struct.pack(f'<i{len(offsets)}Q', len(offsets), *offsets)
+        with BgzfWriter(path) as index_writer:
+            index_writer.write(bytes(data))
@@ -0,0 +1,38 @@
+import click
+import logging
+from varnoisedb.annotate import DEFAULT_MAX_GAP, annotate_vcf
+from varnoisedb.cli.context import get_db_adapter
+from varnoisedb.snapshot import Snapshot
+
+@click.command()
+@click.option('--vcf', 'vcf_path', required=True, type=click.Path(exists=True), help='Sorted VCF file with the calls to annotate')
+@click.option('--output', '-o', default='annotated.vcf',
+              help='Output VCF file path, a .gz file is written with BGZF compression and a tabix index')
+@click.option('--chunk-size', default=10000, show_default=True, type=click.IntRange(min=1),
+              help='Maximum number of records joined with the database at a time')
+@click.option('--max-gap', default=DEFAULT_MAX_GAP, show_default=True, type=click.IntRange(min=0),
+              help='Records further apart than this many bp are fetched with separate range scans')
+@click.option('--snapshot', 'snapshot_directory', type=click.Path(exists=True, file_okay=False),
+              help='Read the statistics from a snapshot written by the snapshot command instead of the database')
+@click.pass_context
+def annotate(ctx, vcf_path, output, chunk_size, max_gap, snapshot_directory):
+    """Annotate a VCF file with the noise statistics of the database.
+
+    Adds MEAN_AF, SD_AF, MAX_AF and SAMPLES to the INFO field of every record
+    at a position in the database, and Z_AF, the z-score of the non-reference
+    allele frequency of the first sample from FORMAT/AD.
+    """
+    logging.info(f"Annotating {vcf_path} with noise statistics into {output}...")
+    
+    # A snapshot is read without connecting to the database at all
+    if snapshot_directory:
+        source = Snapshot(snapshot_directory)
+    else:
+        source = get_db_adapter(ctx)
+    try:
+        (n_records, n_annotated) = annotate_vcf(source, vcf_path, output, chunk_size, max_gap)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    
+    logging.info(f"Annotation complete. Annotated {n_annotated} of {n_records} records in {output}")
+    click.echo(f"Annotated {n_annotated} of {n_records} records in {output}")
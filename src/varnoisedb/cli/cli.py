@@ -1,23 +1,47 @@
 import os
 import click
+import importlib
 import logging
-import yaml
-import importlib.resources as pkg_resources
 
-from varnoisedb.schema import validate_config
 from varnoisedb.__version__ import __version__
-from varnoisedb.cli.load import load
-from varnoisedb.cli.export import export
-from varnoisedb.cli.init import init
-from varnoisedb.cli.remove import remove
 
 logging.basicConfig(level=logging.INFO)
 
-def load_config(config_file):
-    with open(config_file, 'r') as file:
-        return yaml.safe_load(file)
+class LazyGroup(click.Group):
+    """A group that imports the module of a subcommand only when the subcommand is looked up.
 
-@click.group()
+    lazy_commands maps command names to 'module:attribute'. Running one
+    command imports its module and dependencies only, --version and errors
+    in the arguments of the group none of them.
+    """
+    def __init__(self, *args, lazy_commands=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.lazy_commands = lazy_commands or {}
+
+    def list_commands(self, ctx):
+        return sorted(set(super().list_commands(ctx)) | set(self.lazy_commands))
+
+    def get_command(self, ctx, cmd_name):
+        if cmd_name not in self.commands and cmd_name in self.lazy_commands:
+            module_name, attribute = self.lazy_commands[cmd_name].split(':')
+            self.add_command(getattr(importlib.import_module(module_name), attribute), cmd_name)
+        return super().get_command(ctx, cmd_name)
+
+_COMMANDS = {
+    'load': 'varnoisedb.cli.load:load',
+    'export': 'varnoisedb.cli.export:export',
+    'init': 'varnoisedb.cli.init:init',
+    'remove': 'varnoisedb.cli.remove:remove',
+    'query': 'varnoisedb.cli.query:query',
+    'annotate': 'varnoisedb.cli.annotate:annotate',
+    'snapshot': 'varnoisedb.cli.snapshot:snapshot',
+    'jobs': 'varnoisedb.cli.jobs:jobs',
+    'rebuild': 'varnoisedb.cli.rebuild:rebuild',
+    'migrate': 'varnoisedb.cli.migrate:migrate',
+    'patch': 'varnoisedb.cli.patch:patch',
+}
+
+@click.group(cls=LazyGroup, lazy_commands=_COMMANDS)
 @click.option('--config', type=click.Path(exists=True), help='Path to the configuration file')
 @click.version_option(__version__)
 @click.pass_context
@@ -27,25 +51,11 @@ def cli(ctx, config):
     elif os.getenv('VARNOISEDB_CONFIG'):
         config_file = os.getenv('VARNOISEDB_CONFIG')
     else:
+        import importlib.resources as pkg_resources
         with pkg_resources.path('varnoisedb', 'default_config.yaml') as default_config_path:
             config_file = str(default_config_path)
-    
-    ctx.ensure_object(dict)
-    config = load_config(config_file)
-    config = validate_config(config)
-    ctx.obj['CONFIG'] = config
-
-    db_config = config['database']
-    db_type = db_config['type']
-    db_host = db_config.get('host', 'localhost')
-    db_port = db_config.get('port', 5432 if db_type == 'postgresql' else 3306)
-    
-    if db_type == 'sqlite':
-        logging.info(f"Connecting to sqlite database {db_config['name']}")
-    else:
-        logging.info(f"Connecting to {db_type} database at {db_host}:{db_port} using database name {db_config['name']}")
 
-cli.add_command(load)
-cli.add_command(export)
-cli.add_command(init)
-cli.add_command(remove)
+    # The configuration is read and validated, and the database connected, by the commands that
+    # need them, see varnoisedb.cli.context
+    ctx.ensure_object(dict)
+    ctx.obj['CONFIG_FILE'] = config_file
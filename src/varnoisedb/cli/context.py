@@ -0,0 +1,53 @@
+import click
+import logging
+
+def load_config(config_file):
+    import yaml
+    with open(config_file, 'r') as file:
+        return yaml.safe_load(file)
+
+def get_config(ctx):
+    """Return the validated configuration, read from the file given to the cli group on first use."""
+    obj = ctx.find_root().obj
+    if 'CONFIG' not in obj:
+        from varnoisedb.schema import validate_config
+        obj['CONFIG'] = validate_config(load_config(obj['CONFIG_FILE']))
+    return obj['CONFIG']
+
+def get_db_adapter(ctx):
+    """Return the database adapter shared by the commands of this invocation.
+
+    The adapter, and with it the connection pool, is created on first use
+    and closed when the command has finished.
+    """
+    root = ctx.find_root()
+    if 'DB_ADAPTER' not in root.obj:
+        from varnoisedb.database import DatabaseAdapter
+        db_config = get_config(ctx)['database']
+        db_type = db_config['type']
+        if db_type == 'sqlite':
+            logging.info(f"Connecting to sqlite database {db_config['name']}")
+        else:
+            db_host = db_config.get('host', 'localhost')
+            db_port = db_config.get('port', 5432 if db_type == 'postgresql' else 3306)
+            logging.info(f"Connecting to {db_type} database at {db_host}:{db_port} using database name {db_config['name']}")
+        root.obj['DB_ADAPTER'] = DatabaseAdapter.from_config(db_config)
+        root.call_on_close(root.obj['DB_ADAPTER'].close)
+    return root.obj['DB_ADAPTER']
+
+class BatchSizeType(click.ParamType):
+    """A positive number of records, or 'auto' to adapt the batch size while loading."""
+    name = 'integer|auto'
+
+    def convert(self, value, param, ctx):
+        if value == 'auto' or isinstance(value, int):
+            return value
+        try:
+            size = int(value)
+        except ValueError:
+            self.fail(f"'{value}' is neither a number nor 'auto'", param, ctx)
+        if size < 1:
+            self.fail(f"{size} is not a positive number", param, ctx)
+        return size
+
+BATCH_SIZE = BatchSizeType()
@@ -1,75 +1,60 @@
 import click
 import logging
-import gzip
-from varnoisedb.database import DatabaseAdapter
-from varnoisedb.models import Variant
-import os
+from varnoisedb.cli.context import get_db_adapter
+from varnoisedb.cli.instrument import instrument_options, instrumented
+from varnoisedb.generations import SinceError, finish_generation
+from varnoisedb.metrics import Metrics
+from varnoisedb.vcf_writer import is_bgzf_path, write_vcf
 
 @click.command()
-@click.option('--output', '-o', default='variants.vcf', help='Output VCF file path')
+@click.option('--output', '-o', default='variants.vcf',
+              help='Output VCF file path, a .gz file is written with BGZF compression and a tabix index')
+@click.option('--chunk-size', default=10000, show_default=True, type=click.IntRange(min=1),
+              help='Number of variants fetched from the database and written at a time')
+@click.option('--contig', 'contigs', multiple=True, help='Only export the variants on this contig, can be given several times')
+@click.option('--since', type=click.IntRange(min=0),
+              help='Only export the variants changed and the positions deleted after this generation, '
+                   'as recorded in the header of an earlier export')
+@click.option('--finish-generation', 'finish', multiple=True, type=int,
+              help='Mark a generation left unfinished by a killed load or removal as finished before exporting, '
+                   'can be given several times')
+@instrument_options
 @click.pass_context
-def export(ctx, output):
-    """Export the database in VCF format with variant statistics in the INFO field."""
-    config = ctx.obj['CONFIG']
-    db_config = config['database']
+def export(ctx, output, chunk_size, contigs, since, finish, metrics_out, profile, sql_timing):
+    """Export the database in VCF format with variant statistics in the INFO field.
+
+    Variants are streamed from the database, so memory use does not depend on
+    the size of the database. The generation of the database the export
+    covers is recorded in its header. A delta export written with --since is
+    applied to an earlier export with patch.
+
+    An export only covers the generations before the oldest unfinished one.
+    A load or removal that was killed leaves its generation unfinished, which
+    is finished by resuming the load or removing its sample, or with
+    --finish-generation once no process writes as it anymore.
+    """
+    db_adapter = get_db_adapter(ctx)
+    for generation in finish:
+        finish_generation(db_adapter, generation)
     
     logging.info(f"Exporting database to VCF format in {output}...")
     
-    # Connect to the database
-    db_adapter = DatabaseAdapter(
-        db_type=db_config['type'],
-        db_name=db_config['name'],
-        host=db_config.get('host'),
-        port=db_config.get('port'),
-        user=db_config.get('user'),
-        password=db_config.get('password')
-    )
-    
     session = db_adapter.get_session()
     
-    # Query all variants
-    variants = session.query(Variant).order_by(Variant.chr, Variant.pos).all()
-    
-    # Determine if output should be compressed
-    is_gzipped = output.endswith('.vcf.gz')
-    
-    # Write to VCF file
-    open_func = gzip.open if is_gzipped else open
-    mode = 'wt' if is_gzipped else 'w'
-    
-    with open_func(output, mode) as file:
-        # Write header
-        file.write("##fileformat=VCFv4.2\n")
-        file.write('##INFO=<ID=MEAN_AF,Number=1,Type=Float,Description="Mean non-reference allele frequency">\n')
-        file.write('##INFO=<ID=SD_AF,Number=1,Type=Float,Description="Standard deviation of non-reference allele frequency">\n')
-        file.write('##INFO=<ID=MAX_AF,Number=1,Type=Float,Description="Maximum non-reference allele frequency">\n')
-        file.write('##INFO=<ID=MIN_AF,Number=1,Type=Float,Description="Minimum non-reference allele frequency">\n')
-        file.write('##INFO=<ID=DEPTH,Number=1,Type=Float,Description="Total sequencing depth">\n')
-        file.write('##INFO=<ID=SAMPLES,Number=1,Type=Integer,Description="Number of samples">\n')
-        file.write("#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n")
-        
-        # Write variants
-        for variant in variants:
-            mean_af = variant.mean_non_ref_af if variant.mean_non_ref_af is not None else 0.0
-            sd_af = variant.sd_non_ref_af if variant.sd_non_ref_af is not None else 0.0
-            max_af = variant.max_non_ref_af if variant.max_non_ref_af is not None else 0.0
-            min_af = variant.min_non_ref_af if variant.min_non_ref_af is not None else 0.0
-            total_depth = variant.total_depth if variant.total_depth is not None else 0.0
-            number_of_samples = variant.number_of_samples if variant.number_of_samples is not None else 0
-            
-            info = (
-                f"MEAN_AF={mean_af:.6f};"
-                f"MAX_AF={max_af:.6f};"
-                f"SD_AF={sd_af:.6f};"
-                f"MIN_AF={min_af:.6f};"
-                f"DEPTH={total_depth:.1f};"
-                f"SAMPLES={number_of_samples}"
-            )
-            
-            file.write(f"{variant.chr}\t{variant.pos}\t.\tN\t<NON_REF>\t.\tPASS\t{info}\n")
-    
-    session.close()
-    db_adapter.close()
-    
-    logging.info(f"Export complete. Wrote {len(variants)} variants to {output}")
-    click.echo(f"Exported {len(variants)} variants to {output}")
+    # Stream the variants to the VCF file
+    metrics = Metrics()
+    with instrumented('export', metrics, db_adapter.engine, metrics_out, profile, sql_timing):
+        try:
+            n_variants = write_vcf(session, output, chunk_size, contigs, metrics, since)
+        except SinceError as e:
+            raise click.BadParameter(str(e), param_hint='--since')
+        finally:
+            session.close()
+    
+    if is_bgzf_path(output):
+        logging.info(f"Wrote tabix index {output}.tbi")
+    logging.info(f"Export complete. Wrote {n_variants} variants to {output}")
+    if since is None:
+        click.echo(f"Exported {n_variants} variants to {output}")
+    else:
+        click.echo(f"Exported {n_variants} changed variants and {metrics.counts['deleted']} deleted positions to {output}")
@@ -0,0 +1,47 @@
+import click
+import contextlib
+import cProfile
+import json
+import logging
+import time
+
+def instrument_options(command):
+    """Add the --metrics-out, --profile and --sql-timing options to a command."""
+    command = click.option('--sql-timing', is_flag=True,
+                           help='Also count and time the SQL statements executed, by statement and table')(command)
+    command = click.option('--profile', type=click.Path(dir_okay=False, writable=True),
+                           help='Profile the command with cProfile and write the statistics to this file, '
+                                'readable with pstats or snakeviz')(command)
+    command = click.option('--metrics-out', type=click.Path(dir_okay=False, writable=True),
+                           help='Write the time per stage, the row counts and the throughput as JSON to this file')(command)
+    return command
+
+@contextlib.contextmanager
+def instrumented(command, metrics, engine, metrics_out=None, profile=None, sql_timing=False):
+    """Collect metrics while running the body of a command.
+
+    When the body completes, the metrics are logged as one line starting with
+    'Metrics:' followed by JSON and written to metrics_out if given. The
+    profile covers the calling thread only, not reader threads or worker
+    processes.
+    """
+    if sql_timing:
+        metrics.time_statements(engine)
+    profiler = cProfile.Profile() if profile else None
+    start = time.perf_counter()
+    if profiler is not None:
+        profiler.enable()
+    try:
+        yield metrics
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(profile)
+            logging.info(f"Wrote the profile to {profile}")
+
+    report = {'command': command, **metrics.to_dict(time.perf_counter() - start)}
+    logging.info(f"Metrics: {json.dumps(report)}")
+    if metrics_out:
+        with open(metrics_out, 'w') as file:
+            json.dump(report, file, indent=2)
+        logging.info(f"Wrote the metrics to {metrics_out}")
@@ -0,0 +1,111 @@
+import click
+import logging
+import os
+from varnoisedb.cli.context import BATCH_SIZE, get_config, get_db_adapter
+from varnoisedb.jobs import FAILED, RUNNING, STATUSES, count_jobs, list_jobs, requeue_jobs, run_worker, submit_jobs
+
+logging.basicConfig(level=logging.INFO)
+
+# Write modes that can resume from a checkpoint
+_WORKER_WRITE_MODES = ('upsert', 'orm')
+
+@click.group()
+def jobs():
+    """Queue GVCF files for loading and run workers that load them.
+
+    Any number of workers, on any number of machines, can load from the
+    queue into the same PostgreSQL or MySQL database at the same time.
+    """
+
+@jobs.command()
+@click.option('--gvcf', 'gvcfs', multiple=True, type=click.Path(exists=True),
+              help='Path to a .gvcf file, can be given several times')
+@click.option('--gvcf-list', type=click.File('r'), help='File listing one .gvcf path per line')
+@click.pass_context
+def submit(ctx, gvcfs, gvcf_list):
+    """Queue GVCF files for loading, one job per file."""
+    gvcf_paths = list(gvcfs)
+    if gvcf_list:
+        gvcf_paths += [line.strip() for line in gvcf_list if line.strip() and not line.startswith('#')]
+    if not gvcf_paths:
+        raise click.UsageError("Provide at least one GVCF file with --gvcf or --gvcf-list.")
+    for path in gvcf_paths:
+        if not os.path.exists(path):
+            raise click.BadParameter(f"GVCF file '{path}' does not exist.", param_hint='--gvcf-list')
+    # The workers can run in other directories
+    gvcf_paths = [os.path.abspath(path) for path in gvcf_paths]
+
+    session = get_db_adapter(ctx).get_session()
+    try:
+        job_ids = submit_jobs(session, gvcf_paths)
+    except ValueError as e:
+        raise click.BadParameter(str(e), param_hint='--gvcf')
+    finally:
+        session.close()
+    logging.info(f"Queued {len(job_ids)} jobs, ids {job_ids[0]} to {job_ids[-1]}.")
+
+@jobs.command(name='list')
+@click.option('--status', 'statuses', multiple=True, type=click.Choice(STATUSES),
+              help='Only list jobs with this status, can be given several times')
+@click.pass_context
+def list_(ctx, statuses):
+    """List the jobs in the queue as tab separated lines."""
+    session = get_db_adapter(ctx).get_session()
+    try:
+        click.echo('#' + '\t'.join(['id', 'status', 'attempts', 'sample', 'gvcf', 'worker', 'error']))
+        for job in list_jobs(session, statuses):
+            fields = [job.id, job.status, job.attempts, job.sample_name, job.gvcf_path, job.worker, job.error]
+            click.echo('\t'.join('.' if field is None else str(field).replace('\n', ' ') for field in fields))
+        counts = count_jobs(session)
+    finally:
+        session.close()
+    logging.info(', '.join(f"{counts.get(status, 0)} {status}" for status in STATUSES))
+
+@jobs.command()
+@click.option('--batch-size', default=1000, show_default=True, type=BATCH_SIZE,
+              help="Number of variants to process in each batch, 'auto' adapts it to the backend and the write latency")
+@click.option('--write-mode', type=click.Choice(_WORKER_WRITE_MODES), default='upsert', show_default=True,
+              help='Merge statistics with one upsert per batch or read and update rows through the ORM')
+@click.option('--checkpoint-interval', default=100, show_default=True, type=click.IntRange(min=1),
+              help='Number of batches written between commits and checkpoints')
+@click.option('--prefetch', default=8, show_default=True, type=click.IntRange(min=0),
+              help='Number of batches parsed ahead by a reader thread while the previous ones are written')
+@click.option('--max-jobs', type=click.IntRange(min=1), help='Stop after running this many jobs')
+@click.option('--exit-when-empty', is_flag=True, help='Stop when no job is pending instead of waiting for new jobs')
+@click.option('--poll-interval', default=10.0, show_default=True, type=click.FloatRange(min=0),
+              help='Seconds to wait before checking an empty queue again')
+@click.option('--max-attempts', default=3, show_default=True, type=click.IntRange(min=1),
+              help='Number of times a job failing with a database error, like a deadlock, is tried')
+@click.pass_context
+def work(ctx, batch_size, write_mode, checkpoint_interval, prefetch, max_jobs, exit_when_empty, poll_interval, max_attempts):
+    """Load queued GVCF files until stopped.
+
+    Start as many workers as wanted, every job is run by only one of them.
+    """
+    db_config = get_config(ctx)['database']
+
+    (n_jobs, n_failed) = run_worker(
+        get_db_adapter(ctx), max_jobs=max_jobs, poll_interval=poll_interval, exit_when_empty=exit_when_empty,
+        max_attempts=max_attempts, batch_size=batch_size, write_mode=write_mode,
+        reference_blocks=db_config.get('reference_blocks', False),
+        contributions=db_config.get('contributions', False),
+        checkpoint_interval=checkpoint_interval, prefetch=prefetch
+    )
+    logging.info(f"Ran {n_jobs} jobs, {n_failed} of them failed.")
+
+@jobs.command()
+@click.argument('job_ids', nargs=-1, type=int)
+@click.option('--running', is_flag=True,
+              help='Also requeue running jobs, only do this when their workers have stopped')
+@click.pass_context
+def requeue(ctx, job_ids, running):
+    """Return failed jobs, all of them or those with JOB_IDS, to the queue.
+
+    The jobs continue from the last checkpoint of their previous attempt.
+    """
+    session = get_db_adapter(ctx).get_session()
+    try:
+        n_jobs = requeue_jobs(session, job_ids, (FAILED, RUNNING) if running else (FAILED,))
+    finally:
+        session.close()
+    logging.info(f"Requeued {n_jobs} jobs.")
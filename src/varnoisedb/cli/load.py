@@ -1,57 +1,180 @@
 import click
+import contextlib
 import logging
 import os
-from varnoisedb.database import DatabaseAdapter
-from varnoisedb.updater import Updater
-from varnoisedb.gvcf_parser import GVCFParser
+from varnoisedb.cli.context import BATCH_SIZE, get_config, get_db_adapter
+from varnoisedb.cli.instrument import instrument_options, instrumented
+from varnoisedb.metrics import Metrics
+from varnoisedb.updater import Updater, WRITE_MODES
+from varnoisedb.gvcf_parser import CohortParser, GVCFParser, has_index
 from varnoisedb.models import Sample
+from varnoisedb.parallel import DEFAULT_SHARD_SIZE, load_parallel
+from varnoisedb.progress import read_progress
+from varnoisedb.targets import Targets
 
 logging.basicConfig(level=logging.INFO)
 
 @click.command()
-@click.option('--gvcf', required=True, type=click.Path(exists=True), help='Path to the .gvcf file')
-@click.option('--batch-size', default=1000, help='Number of variants to process in each batch')
+@click.option('--gvcf', 'gvcfs', multiple=True, type=click.Path(exists=True),
+              help='Path to a .gvcf file, can be given several times to load a cohort')
+@click.option('--gvcf-list', type=click.File('r'), help='File listing one .gvcf path per line')
+@click.option('--targets', type=click.Path(exists=True, dir_okay=False),
+              help='BED file of target regions, only the records within them are loaded')
+@click.option('--batch-size', default=1000, show_default=True, type=BATCH_SIZE,
+              help="Number of variants to process in each batch, 'auto' adapts it to the backend and the write latency")
 @click.option('--force', is_flag=True, help='Force load even if sample already exists in the database')
+@click.option('--write-mode', type=click.Choice(WRITE_MODES), default='upsert', show_default=True,
+              help='Merge statistics with one upsert per batch, read and update rows through the ORM, '
+                   'or stream the sample through a COPY staging table (PostgreSQL only)')
+@click.option('--workers', default=1, show_default=True, type=click.IntRange(min=1),
+              help='Number of processes parsing and writing genomic regions in parallel (requires indexed GVCF files)')
+@click.option('--shard-size', default=DEFAULT_SHARD_SIZE, show_default=True, type=click.IntRange(min=1),
+              help='Size in bp of the genomic regions processed by each worker')
+@click.option('--checkpoint-interval', default=100, show_default=True, type=click.IntRange(min=0),
+              help='Number of batches written between commits and checkpoints, 0 loads in a single transaction')
+@click.option('--resume', is_flag=True, help='Continue an interrupted load of the same files from its last checkpoint')
+@click.option('--prefetch', default=8, show_default=True, type=click.IntRange(min=0),
+              help='Number of batches parsed ahead by a reader thread while the previous ones are written, '
+                   '0 parses and writes in turn')
+@instrument_options
 @click.pass_context
-def load(ctx, gvcf, batch_size, force):
-    """Load data from a .gvcf file into the database."""
-    config = ctx.obj['CONFIG']
+def load(ctx, gvcfs, gvcf_list, targets, batch_size, force, write_mode, workers, shard_size, checkpoint_interval, resume, prefetch,
+         metrics_out, profile, sql_timing):
+    """Load data from one or more .gvcf files into the database.
+
+    Several files are merged by position and every position is written once
+    with the statistics of all samples. With several workers, the metrics
+    only cover the wall time and the written rows. With --targets, records
+    are clipped to the target regions, which are read through the index of
+    indexed files.
+    """
+    config = get_config(ctx)
     db_config = config['database']
     
-    # Get absolute path for tracking
-    gvcf_path = os.path.abspath(gvcf)
+    reference_blocks = db_config.get('reference_blocks', False)
+    contributions = db_config.get('contributions', False)
+    if write_mode == 'copy' and db_config['type'] != 'postgresql':
+        raise click.BadParameter("the copy write mode requires a PostgreSQL database", param_hint='--write-mode')
+    if write_mode == 'copy' and reference_blocks:
+        raise click.BadParameter("the copy write mode does not support reference blocks", param_hint='--write-mode')
+    if workers > 1 and reference_blocks and db_config['type'] != 'sqlite':
+        raise click.BadParameter("parallel loading of reference blocks is only supported for SQLite", param_hint='--workers')
+    if resume and (workers > 1 or write_mode == 'copy' or not checkpoint_interval):
+        raise click.BadParameter("only loads with a single worker and checkpoints can be resumed, not parallel or copy loads",
+                                 param_hint='--resume')
+    if targets and workers > 1:
+        raise click.BadParameter("loads restricted to targets run with a single worker", param_hint='--workers')
+    
+    gvcf_paths = list(gvcfs)
+    if gvcf_list:
+        gvcf_paths += [line.strip() for line in gvcf_list if line.strip() and not line.startswith('#')]
+    if not gvcf_paths:
+        raise click.UsageError("Provide at least one GVCF file with --gvcf or --gvcf-list.")
+    for path in gvcf_paths:
+        if not os.path.exists(path):
+            raise click.BadParameter(f"GVCF file '{path}' does not exist.", param_hint='--gvcf-list')
+    
+    # Get absolute paths for tracking
+    gvcf_paths = [os.path.abspath(path) for path in gvcf_paths]
+    
+    if workers > 1:
+        unindexed = [path for path in gvcf_paths if not has_index(path)]
+        if unindexed:
+            raise click.BadParameter(
+                f"parallel loading needs bgzipped GVCF files with a tabix or CSI index, missing for: {', '.join(unindexed)}",
+                param_hint='--workers'
+            )
+    
+    if targets:
+        try:
+            targets = Targets.from_bed(targets)
+        except ValueError as e:
+            raise click.BadParameter(str(e), param_hint='--targets')
+        logging.info(f"Restricting the load to {len(targets)} target regions covering {targets.size} bp")
+    else:
+        targets = None
     
-    # Connect to database
-    db_adapter = DatabaseAdapter(
-        db_type=db_config['type'],
-        db_name=db_config['name'],
-        host=db_config.get('host'),
-        port=db_config.get('port'),
-        user=db_config.get('user'),
-        password=db_config.get('password')
-    )
+    db_adapter = get_db_adapter(ctx)
     
-    # Parse sample name from the GVCF
-    gvcf_parser = GVCFParser(gvcf_path)
-    sample_name = gvcf_parser.get_sample_name()
+    # Parse sample names from the GVCFs
+    if len(gvcf_paths) == 1:
+        gvcf_parser = GVCFParser(gvcf_paths[0], targets=targets)
+    else:
+        gvcf_parser = CohortParser(gvcf_paths, targets=targets)
+    sample_names = [sample_name for sample_name, _ in gvcf_parser.samples()]
+    duplicates = sorted({name for name in sample_names if sample_names.count(name) > 1})
+    if duplicates:
+        raise click.BadParameter(f"Samples {', '.join(duplicates)} occur in more than one GVCF file.", param_hint='--gvcf')
     
-    # Check if sample already exists
+    # Check if samples already exist
     session = db_adapter.get_session()
-    existing_sample = session.query(Sample).filter(Sample.name == sample_name).first()
+    existing_samples = dict(session.query(Sample.name, Sample.targets_path).filter(Sample.name.in_(sample_names)).all())
+    unfinished = read_progress(session, sample_names)
     
-    if existing_sample and not force:
-        logging.warning(f"Sample '{sample_name}' already exists in the database. Use --force to reload.")
+    if resume and existing_samples:
+        if sorted(unfinished) != sorted(sample_names) or len(set(unfinished.values())) != 1:
+            session.close()
+            raise click.BadParameter(
+                "the samples of the GVCF files do not share an unfinished load, resume with the same files as the interrupted load.",
+                param_hint='--resume'
+            )
+        targets_path = None if targets is None else os.path.abspath(targets.path)
+        if any(path != targets_path for path in existing_samples.values()):
+            session.close()
+            raise click.BadParameter("resume with the same targets as the interrupted load.", param_hint='--targets')
+    elif unfinished:
+        session.close()
+        raise click.BadParameter(
+            f"Loading samples {', '.join(sorted(unfinished))} was interrupted, continue it with --resume or remove them first.",
+            param_hint='--gvcf'
+        )
+    elif existing_samples and not force:
+        for sample_name in existing_samples:
+            logging.warning(f"Sample '{sample_name}' already exists in the database. Use --force to reload.")
         session.close()
-        db_adapter.close()
         raise click.Abort()
+    if existing_samples and contributions and not resume:
+        session.close()
+        raise click.BadParameter(
+            f"Samples {', '.join(existing_samples)} already have stored contributions, remove them before reloading.",
+            param_hint='--force'
+        )
+    
+    resume = resume and bool(existing_samples)
+    if len(gvcf_paths) == 1:
+        logging.info(f"Loading data for sample '{sample_names[0]}' from {gvcf_paths[0]} into the database with batch size {batch_size}...")
+    else:
+        logging.info(f"Loading data for {len(sample_names)} samples into the database with batch size {batch_size}...")
+    
+    # Partitions for all contigs of the header are created before writing
+    db_adapter.ensure_partitions(gvcf_parser.contigs())
     
-    logging.info(f"Loading data for sample '{sample_name}' from {gvcf_path} into the database with batch size {batch_size}...")
+    # In bulk load mode the secondary indexes are rebuilt once after the load
+    deferred = db_adapter.deferred_indexes() if db_adapter.bulk_load else contextlib.nullcontext()
     
     # Load the variants
-    updater = Updater(db_adapter, gvcf_parser, batch_size)
-    (tot_inserted, tot_updated) = updater.insert_sample()
-    logging.info(f"Inserted a total of '{tot_inserted}' and updated '{tot_updated}' variants.")
+    metrics = Metrics()
+    with instrumented('load', metrics, db_adapter.engine, metrics_out, profile, sql_timing), deferred:
+        if workers > 1:
+            (tot_inserted, tot_updated) = load_parallel(db_config, gvcf_paths, workers, batch_size, write_mode, shard_size)
+            metrics.count('written', tot_inserted)
+        else:
+            updater = Updater(
+                db_adapter, gvcf_parser, batch_size, write_mode=write_mode,
+                reference_blocks=reference_blocks, contributions=contributions,
+                checkpoint_interval=checkpoint_interval, prefetch=prefetch, metrics=metrics
+            )
+            (tot_inserted, tot_updated) = updater.insert_sample(resume=resume)
+            metrics.count('parsed', gvcf_parser.records_parsed)
+            metrics.count('skipped_without_non_ref', gvcf_parser.records_skipped)
+            metrics.count('skipped_duplicate_position', gvcf_parser.records_duplicate)
+            logging.info(f"Time per stage: {metrics}")
+            if 'batch_size' in metrics.values:
+                logging.info(f"Settled on a batch size of {metrics.values['batch_size']} records")
+    if tot_updated is None:
+        logging.info(f"Upserted a total of '{tot_inserted}' variants.")
+    else:
+        logging.info(f"Inserted a total of '{tot_inserted}' and updated '{tot_updated}' variants.")
     
     session.close()
-    db_adapter.close()
-    logging.info(f"Data loading for sample '{sample_name}' complete.")
+    logging.info(f"Data loading for sample{'s' if len(sample_names) > 1 else ''} '{', '.join(sample_names)}' complete.")
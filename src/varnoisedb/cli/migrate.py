@@ -0,0 +1,35 @@
+import click
+import logging
+from varnoisedb import migrate as migrations
+from varnoisedb.cli.context import get_db_adapter
+
+@click.command()
+@click.option('--revision', default=None, help='Revision to migrate to, the latest by default')
+@click.option('--downgrade', is_flag=True, help='Migrate down to --revision, which must then be given')
+@click.pass_context
+def migrate(ctx, revision, downgrade):
+    """Migrate the schema of an existing database to this version of VarNoiseDB.
+
+    Tables are rewritten where the schema changed, which can take long on a
+    large database and needs the disk space of a second copy of the table.
+    Back up the database first.
+    """
+    if downgrade and revision is None:
+        raise click.UsageError("--downgrade needs the --revision to migrate down to")
+    
+    db_adapter = get_db_adapter(ctx)
+    try:
+        if downgrade:
+            (before, after) = migrations.downgrade(db_adapter, revision)
+        else:
+            (before, after) = migrations.upgrade(db_adapter, revision or 'head')
+            # Tables added since the database was created
+            db_adapter.create_tables()
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    
+    if before == after:
+        click.echo(f"Database is already at revision {after}.")
+    else:
+        logging.info(f"Migrated the database from revision {before} to {after}")
+        click.echo(f"Database migrated to revision {after}.")
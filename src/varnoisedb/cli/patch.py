@@ -0,0 +1,25 @@
+import click
+import logging
+from varnoisedb.vcf_writer import is_bgzf_path, patch_vcf
+
+@click.command()
+@click.argument('base', type=click.Path(exists=True, dir_okay=False))
+@click.argument('delta', type=click.Path(exists=True, dir_okay=False))
+@click.option('--output', '-o', required=True,
+              help='Output VCF file path, a .gz file is written with BGZF compression and a tabix index')
+def patch(base, delta, output):
+    """Apply DELTA, written by export --since, to the earlier export BASE.
+
+    The records of BASE are copied, replaced or deleted at the positions in
+    DELTA, which gives the export at the generation of DELTA without reading
+    the database.
+    """
+    logging.info(f"Patching {base} with {delta} into {output}...")
+    try:
+        (n_written, n_changed, n_deleted) = patch_vcf(base, delta, output)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    
+    if is_bgzf_path(output):
+        logging.info(f"Wrote tabix index {output}.tbi")
+    click.echo(f"Wrote {n_written} variants to {output}, {n_changed} changed and {n_deleted} deleted")
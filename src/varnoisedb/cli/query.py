@@ -0,0 +1,75 @@
+import click
+import logging
+from varnoisedb.cli.context import get_db_adapter
+from varnoisedb.query import parse_region, read_positions
+
+_COLUMNS = [
+    'chr', 'pos', 'mean_non_ref_af', 'sd_non_ref_af', 'max_non_ref_af', 'min_non_ref_af',
+    'total_depth', 'number_of_samples', 'max_non_ref_af_sample', 'min_non_ref_af_sample',
+]
+
+def _format_row(row):
+    values = [row.mean_non_ref_af, row.sd_non_ref_af, row.max_non_ref_af, row.min_non_ref_af]
+    fields = [row.chr, str(row.pos)] + ['.' if value is None else f"{value:.6f}" for value in values]
+    fields.append('.' if row.total_depth is None else f"{row.total_depth:.1f}")
+    fields.append('.' if row.number_of_samples is None else str(row.number_of_samples))
+    fields += [row.max_non_ref_af_sample or '.', row.min_non_ref_af_sample or '.']
+    return '\t'.join(fields) + '\n'
+
+def _format_missing(chr, pos):
+    return '\t'.join([chr, str(pos)] + ['.'] * (len(_COLUMNS) - 2)) + '\n'
+
+def _contig_names(db_adapter):
+    session = db_adapter.get_session()
+    try:
+        return set(db_adapter.contig_names(session).values())
+    finally:
+        session.close()
+
+@click.command()
+@click.argument('regions', nargs=-1)
+@click.option('--positions', type=click.File('r'),
+              help='File with a chromosome and a position on each line, every position is reported even if absent')
+@click.option('--bed', type=click.File('r'), help='BED file with regions to query')
+@click.option('--output', '-o', type=click.File('w'), default='-', help='Output TSV file, standard output by default')
+@click.pass_context
+def query(ctx, regions, positions, bed, output):
+    """Look up variant statistics for regions (chr, chr:pos or chr:start-end), positions or BED regions.
+
+    Contig names containing ':' can be braced, as in {HLA-A*01:01}:1-100.
+    Writes one tab separated line per variant found.
+    """
+    if not regions and positions is None and bed is None:
+        raise click.UsageError("Provide at least one region, --positions or --bed.")
+
+    db_adapter = get_db_adapter(ctx)
+    # An unbraced region with a ':' can be the name of a contig
+    contigs = _contig_names(db_adapter) if any(':' in region and not region.startswith('{') for region in regions) else None
+    try:
+        regions = [parse_region(region, contigs) for region in regions]
+    except ValueError as e:
+        raise click.BadParameter(str(e), param_hint='REGIONS')
+
+    n_found = 0
+    output.write('#' + '\t'.join(_COLUMNS) + '\n')
+    for chr, start, end in regions:
+        for row in db_adapter.query_region(chr, start, end):
+            output.write(_format_row(row))
+            n_found += 1
+
+    if positions is not None:
+        sites = list(read_positions(positions))
+        for (chr, pos), row in zip(sites, db_adapter.query_positions(sites)):
+            if row is None:
+                output.write(_format_missing(chr, pos))
+            else:
+                output.write(_format_row(row))
+                n_found += 1
+
+    if bed is not None:
+        for row in db_adapter.query_bed(bed):
+            output.write(_format_row(row))
+            n_found += 1
+
+    cache = db_adapter.cache
+    logging.info(f"Found {n_found} variants, {cache.misses} windows fetched and {cache.hits} served from the cache.")
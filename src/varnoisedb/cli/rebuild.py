@@ -0,0 +1,33 @@
+import click
+import logging
+import os
+from varnoisedb.cli.context import get_config
+from varnoisedb.parallel import DEFAULT_SHARD_SIZE
+from varnoisedb.rebuild import DEFAULT_GROUP_SIZE, rebuild_variants
+
+logging.basicConfig(level=logging.INFO)
+
+@click.command()
+@click.option('--workers', default=os.cpu_count() or 1, show_default='number of CPUs', type=click.IntRange(min=1),
+              help='Number of worker processes parsing and merging the parts')
+@click.option('--batch-size', default=1000, help='Number of variants to process in each batch')
+@click.option('--group-size', default=DEFAULT_GROUP_SIZE, show_default=True, type=click.IntRange(min=1),
+              help='Number of samples parsed together by one part')
+@click.option('--shard-size', default=DEFAULT_SHARD_SIZE, show_default=True, type=click.IntRange(min=1),
+              help='Size in bp of the genomic regions of the parts, if all GVCF files are indexed')
+@click.pass_context
+def rebuild(ctx, workers, batch_size, group_size, shard_size):
+    """Recompute the variants table from the GVCF files of all samples.
+
+    The samples are parsed in parallel into partial statistics, which are
+    merged into a fresh table that replaces the variants table at the end.
+    Do not load or remove samples while the rebuild runs.
+    """
+    config = get_config(ctx)
+    db_config = config['database']
+    
+    try:
+        (n_samples, n_parts, n_variants) = rebuild_variants(db_config, workers, batch_size, group_size, shard_size)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    logging.info(f"Rebuilt {n_variants} variants of {n_samples} samples from {n_parts} parts.")
@@ -1,31 +1,35 @@
 import click
 import logging
 import os
-from varnoisedb.database import DatabaseAdapter
+from varnoisedb.cli.context import get_config, get_db_adapter
+from varnoisedb.cli.instrument import instrument_options, instrumented
+from varnoisedb.contributions import has_contributions
 from varnoisedb.updater import Updater
 from varnoisedb.gvcf_parser import GVCFParser
+from varnoisedb.metrics import Metrics
 from varnoisedb.models import Sample
+from varnoisedb.targets import Targets
 
 logging.basicConfig(level=logging.INFO)
 
 @click.command()
 @click.argument('sample_name')
 @click.option('--gvcf', type=click.Path(exists=True), help='Path to the .gvcf file')
+@click.option('--targets', type=click.Path(exists=True, dir_okay=False),
+              help='Path to the BED file of targets the sample was loaded with, if it has moved')
+@instrument_options
 @click.pass_context
-def remove(ctx, sample_name, gvcf):
-    """Remove a sample and its variants from the database."""
-    config = ctx.obj['CONFIG']
+def remove(ctx, sample_name, gvcf, targets, metrics_out, profile, sql_timing):
+    """Remove a sample and its variants from the database.
+
+    If the contributions of the sample are stored in the database, no GVCF
+    file is needed. A sample loaded with targets is removed with the same
+    targets, read from the recorded BED file unless --targets is given.
+    """
+    config = get_config(ctx)
     db_config = config['database']
     
-    # Connect to database
-    db_adapter = DatabaseAdapter(
-        db_type=db_config['type'],
-        db_name=db_config['name'],
-        host=db_config.get('host'),
-        port=db_config.get('port'),
-        user=db_config.get('user'),
-        password=db_config.get('password')
-    )
+    db_adapter = get_db_adapter(ctx)
     
     session = db_adapter.get_session()
     
@@ -35,27 +39,43 @@ def remove(ctx, sample_name, gvcf):
     if not existing_sample:
         logging.warning(f"Sample '{sample_name}' does not exist in the database.")
         session.close()
-        db_adapter.close()
-        raise click.Abort()
-    
-    # Use provided GVCF or find the GVCF path from the samples table
-    gvcf_path = gvcf if gvcf else existing_sample.gvcf_path
-    
-    if not os.path.exists(gvcf_path):
-        logging.warning(f"GVCF file '{gvcf_path}' does not exist.")
-        session.close()
-        db_adapter.close()
         raise click.Abort()
     
-    logging.info(f"Removing data for sample '{sample_name}' using GVCF file '{gvcf_path}'...")
-    
-    # Parse the GVCF file
-    gvcf_parser = GVCFParser(gvcf_path)
+    if has_contributions(session, existing_sample.id):
+        # The stored contributions are subtracted instead of parsing the GVCF
+        gvcf_parser = None
+        logging.info(f"Removing data for sample '{sample_name}' using its stored contributions...")
+    else:
+        # Use provided GVCF or find the GVCF path from the samples table
+        gvcf_path = gvcf if gvcf else existing_sample.gvcf_path
+        
+        if not os.path.exists(gvcf_path):
+            logging.warning(f"GVCF file '{gvcf_path}' does not exist.")
+            session.close()
+            raise click.Abort()
+        
+        # Use provided targets or the targets the sample was loaded with
+        targets_path = targets if targets else existing_sample.targets_path
+        if targets_path is not None and not os.path.exists(targets_path):
+            logging.warning(f"Targets file '{targets_path}' the sample was loaded with does not exist.")
+            session.close()
+            raise click.Abort()
+        
+        logging.info(f"Removing data for sample '{sample_name}' using GVCF file '{gvcf_path}'...")
+        
+        # Parse the GVCF file
+        gvcf_parser = GVCFParser(gvcf_path, targets=None if targets_path is None else Targets.from_bed(targets_path))
     
     # Remove the sample and its variants
-    updater = Updater(db_adapter, gvcf_parser, batch_size=1000)
-    updater.remove_sample()
+    metrics = Metrics()
+    updater = Updater(
+        db_adapter, gvcf_parser, batch_size=1000, reference_blocks=db_config.get('reference_blocks', False), metrics=metrics
+    )
+    with instrumented('remove', metrics, db_adapter.engine, metrics_out, profile, sql_timing):
+        updater.remove_sample(sample_name)
+        if gvcf_parser is not None:
+            metrics.count('skipped_without_non_ref', gvcf_parser.records_skipped)
+            metrics.count('skipped_duplicate_position', gvcf_parser.records_duplicate)
     
     session.close()
-    db_adapter.close()
     logging.info(f"Data removal for sample '{sample_name}' complete.")
@@ -0,0 +1,59 @@
+import click
+import logging
+import os
+from varnoisedb.cli.context import get_db_adapter
+from varnoisedb.snapshot import Snapshot, update_snapshot, write_snapshot
+
+@click.command()
+@click.argument('directory', type=click.Path(file_okay=False))
+@click.option('--force', is_flag=True, help='Replace an existing snapshot in the directory')
+@click.option('--check', is_flag=True, help='Only check whether an existing snapshot is up to date with the samples table')
+@click.option('--update', is_flag=True,
+              help='Bring an existing snapshot up to date, rewriting only the contigs changed since it was written')
+@click.option('--chunk-size', default=100000, show_default=True, type=click.IntRange(min=1),
+              help='Number of variants fetched from the database at a time')
+@click.pass_context
+def snapshot(ctx, directory, force, check, update, chunk_size):
+    """Freeze the variants table into a read-only columnar snapshot in DIRECTORY.
+
+    The snapshot holds memory-mappable NumPy files per contig and can be used
+    for lookups without a database connection, for example by annotate
+    --snapshot.
+    """
+    if check and update:
+        raise click.UsageError("--check and --update cannot be combined.")
+    if check or update:
+        if not os.path.isdir(directory):
+            raise click.BadParameter(f"No snapshot in '{directory}'.", param_hint='DIRECTORY')
+    if check:
+        snapshot = Snapshot(directory)
+    elif os.path.exists(directory) and not force and not update:
+        logging.warning(f"'{directory}' already exists. Use --force to replace it.")
+        raise click.Abort()
+    
+    session = get_db_adapter(ctx).get_session()
+    try:
+        if check:
+            stale = snapshot.is_stale(session)
+        elif update:
+            logging.info(f"Updating the snapshot in {directory}...")
+            try:
+                manifest = update_snapshot(session, directory, chunk_size)
+            except ValueError as e:
+                raise click.ClickException(str(e))
+        else:
+            logging.info(f"Writing a snapshot of the variants table to {directory}...")
+            manifest = write_snapshot(session, directory, chunk_size)
+    finally:
+        session.close()
+    
+    if check:
+        if stale:
+            click.echo(f"Snapshot {directory} is stale, samples were added or removed after it was taken.")
+            ctx.exit(1)
+        click.echo(f"Snapshot {directory} is up to date.")
+        return
+    
+    n_variants = sum(contig['variants'] for contig in manifest['contigs'].values())
+    logging.info(f"Snapshot complete. Wrote {n_variants} variants on {len(manifest['contigs'])} contigs to {directory}")
+    click.echo(f"Wrote a snapshot of {n_variants} variants to {directory}")
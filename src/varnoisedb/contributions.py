@@ -0,0 +1,204 @@
+"""
+This module stores the values each sample contributed to the statistics, so
+that a sample can be removed exactly without its GVCF file. Every parsed batch
+of a sample is packed into one row of the sample_contributions table: the
+positions as int32 deltas, the lengths of reference blocks and the float32
+allele frequencies and depths, compressed together with zlib.
+"""
+
+import zlib
+import numpy as np
+from sqlalchemy import and_, or_, select
+
+from varnoisedb.gvcf_parser import VariantBatch
+from varnoisedb.models import SampleContribution
+
+_DTYPES = ('<i4', '<i4', '<f4', '<f4')
+
+# Contribution rows are inserted this many at a time
+_FLUSH_ROWS = 100
+
+def pack_batch(batch: VariantBatch):
+    """Pack the positions, block ends, allele frequencies and depths of a batch into bytes."""
+    pos = batch.pos.astype(np.int64)
+    columns = (
+        np.diff(pos, prepend=0),
+        batch.end - pos,
+        batch.non_ref_af,
+        batch.dp,
+    )
+    return zlib.compress(b''.join(np.ascontiguousarray(column, dtype=dtype).tobytes() for column, dtype in zip(columns, _DTYPES)))
+
+def unpack_batch(chr, n_records, data, sample_name):
+    """Unpack bytes written by pack_batch into a VariantBatch."""
+    raw = zlib.decompress(data)
+    columns = []
+    offset = 0
+    for dtype in _DTYPES:
+        size = n_records * np.dtype(dtype).itemsize
+        columns.append(np.frombuffer(raw, dtype=dtype, count=n_records, offset=offset))
+        offset += size
+    deltas, spans, non_ref_af, dp = columns
+    pos = np.cumsum(deltas, dtype=np.int64).astype(np.int32)
+    return VariantBatch(chr, pos, non_ref_af.astype(np.float32), dp.astype(np.float32), sample_name, pos + spans)
+
+class ContributionWriter:
+    """Pack batches of samples and insert them into sample_contributions.
+
+    sample_ids maps the sample names of the batches to their id in the
+    samples table. Call flush() after the last batch. With deferred set, the
+    batches are kept until flush() is called with a checkpoint, and only the
+    records up to it are written then, for loads that commit in chunks while
+    the parser reads ahead of the written statistics.
+    """
+    def __init__(self, session, sample_ids, deferred=False):
+        self.session = session
+        self.sample_ids = sample_ids
+        self.deferred = deferred
+        self._rows = []
+        self._pending = []
+        # Rank of the chromosomes in file order
+        self._contigs = {}
+
+    def add(self, batch: VariantBatch):
+        if not len(batch):
+            return
+        self._contigs.setdefault(batch.chr, len(self._contigs))
+        if self.deferred:
+            self._pending.append(batch)
+            return
+        self._add_row(batch)
+        if len(self._rows) >= _FLUSH_ROWS:
+            self._write()
+
+    def flush(self, chr=None, pos=None):
+        """Write the pending batches, or with a checkpoint only their records up to chr:pos in file order."""
+        pending = self._pending
+        self._pending = []
+        for batch in pending:
+            if chr is None or self._contigs[batch.chr] < self._contigs[chr]:
+                self._add_row(batch)
+            elif batch.chr == chr:
+                written = batch.pos <= pos
+                self._add_row(batch.take(written))
+                if not written.all():
+                    self._pending.append(batch.take(~written))
+            else:
+                self._pending.append(batch)
+            if len(self._rows) >= _FLUSH_ROWS:
+                self._write()
+        self._write()
+
+    def _add_row(self, batch: VariantBatch):
+        if not len(batch):
+            return
+        self._rows.append({
+            'sample_id': self.sample_ids[batch.sample_name],
+            'chr': batch.chr,
+            'first_pos': int(batch.pos[0]),
+            'last_pos': int(batch.end.max()),
+            'n_records': len(batch),
+            'data': pack_batch(batch),
+        })
+
+    def _write(self):
+        if self._rows:
+            self.session.execute(SampleContribution.__table__.insert(), self._rows)
+            self._rows = []
+
+def has_contributions(session, sample_id):
+    return session.execute(
+        select(SampleContribution.sample_id).where(SampleContribution.sample_id == sample_id).limit(1)
+    ).first() is not None
+
+def read_contributions(session, sample_id, sample_name, chunk_size=100):
+    """Yield the stored batches of a sample in (chr, position) order.
+
+    The rows are read in pages of chunk_size with keyset pagination, every
+    page is fetched completely, so the session can be written to between the
+    yielded batches.
+    """
+    stmt = select(
+        SampleContribution.chr, SampleContribution.first_pos, SampleContribution.n_records, SampleContribution.data
+    ).where(SampleContribution.sample_id == sample_id).order_by(
+        SampleContribution.chr, SampleContribution.first_pos
+    ).limit(chunk_size)
+    page = session.execute(stmt).all()
+    while page:
+        for chr, _, n_records, data in page:
+            yield unpack_batch(chr, n_records, data, sample_name)
+        last_chr, last_pos = page[-1][:2]
+        page = session.execute(stmt.where(or_(
+            SampleContribution.chr > last_chr,
+            and_(SampleContribution.chr == last_chr, SampleContribution.first_pos > last_pos)
+        ))).all()
+
+def read_overlapping(session, chr, start, end, chunk_size=100):
+    """Yield the stored batches of all samples on chr that overlap start to end.
+
+    The batches are labeled with the id of their sample instead of its name,
+    as stored in the min/max sample columns of the variants table. They come
+    in the order the samples were added, so that of equal values the min/max
+    goes to the sample added first, as when loading. The rows are streamed,
+    so the session must not be used until all batches have been consumed.
+    """
+    stmt = select(SampleContribution.sample_id, SampleContribution.n_records, SampleContribution.data).where(
+        SampleContribution.chr == chr,
+        SampleContribution.first_pos <= end,
+        SampleContribution.last_pos >= start
+    ).order_by(SampleContribution.sample_id)
+    for sample_id, n_records, data in session.execute(stmt.execution_options(yield_per=chunk_size)):
+        yield unpack_batch(chr, n_records, data, sample_id)
+
+def recompute_stats(batches, positions):
+    """Recompute the statistics at sorted positions from the contributions of all samples.
+
+    batches must hold only the records counted in the variants table, so
+    without the reference blocks if those are stored as intervals. Returns a
+    dict of columns for the positions, with number_of_samples 0 where no
+    sample contributed.
+    """
+    n = len(positions)
+    count = np.zeros(n, dtype=np.int64)
+    total = np.zeros(n)
+    total_sq = np.zeros(n)
+    depth = np.zeros(n)
+    max_af = np.full(n, -np.inf)
+    min_af = np.full(n, np.inf)
+    max_sample = np.full(n, None, dtype=object)
+    min_sample = np.full(n, None, dtype=object)
+
+    for batch in batches:
+        idx = np.minimum(np.searchsorted(positions, batch.pos), n - 1)
+        hit = positions[idx] == batch.pos
+        if not hit.any():
+            continue
+        # Contributions stored before the parser dropped records sharing a position
+        # can repeat one, of which only the first counts, as the parser keeps it
+        idx, first = np.unique(idx[hit], return_index=True)
+        af = batch.non_ref_af[hit][first].astype(np.float64)
+        count[idx] += 1
+        total[idx] += af
+        total_sq[idx] += af * af
+        depth[idx] += batch.dp[hit][first]
+        is_max = af > max_af[idx]
+        max_af[idx[is_max]] = af[is_max]
+        max_sample[idx[is_max]] = batch.sample_name
+        is_min = af < min_af[idx]
+        min_af[idx[is_min]] = af[is_min]
+        min_sample[idx[is_min]] = batch.sample_name
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = total / count
+        sd = np.sqrt(np.maximum(total_sq / count - mean * mean, 0.0))
+    return {
+        'pos': positions,
+        'mean_non_ref_af': mean,
+        'sd_non_ref_af': sd,
+        'max_non_ref_af': max_af,
+        'min_non_ref_af': min_af,
+        'total_depth': depth,
+        'number_of_samples': count,
+        'max_non_ref_af_sample': max_sample,
+        'min_non_ref_af_sample': min_sample,
+    }
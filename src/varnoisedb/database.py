@@ -3,12 +3,137 @@ This module handles database connections and operations for VarNoiseDB.
 It should support SQLite, PostgreSQL, and MySQL.
 """
 
-from sqlalchemy import create_engine, Index
-from sqlalchemy.orm import sessionmaker
-from varnoisedb.models import Base, Variant, Sample
+import bisect
+import contextlib
+import functools
+import hashlib
+import io
+import math
+import re
+from sqlalchemy import create_engine, event, exc, func, inspect, literal, or_, select, text, Column, Index, MetaData, Table
+from sqlalchemy.orm import aliased, sessionmaker
+from varnoisedb.models import Base, Contig, Variant, Sample, ReferenceBlock
+from varnoisedb.query import WindowCache, merge_blocks, read_bed
+from varnoisedb.upsert import dialect_insert
+
+def _sqlite_sqrt(value):
+    return math.sqrt(value) if value is not None else None
+
+def _register_sqlite_functions(dbapi_connection, connection_record):
+    """Make sure math functions used in SQL expressions exist on SQLite builds without them."""
+    dbapi_connection.create_function('sqrt', 1, _sqlite_sqrt, deterministic=True)
+
+# Used for SQLite in bulk load mode. WAL lets readers continue during a load,
+# synchronous=OFF skips fsync, so an OS crash or power loss during or shortly
+# after a load can corrupt the database file, an application crash cannot.
+SQLITE_BULK_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'OFF',
+    'cache_size': -262144,  # in KiB, 256 MiB
+    'mmap_size': 2 ** 30,
+    'temp_store': 'MEMORY',
+}
+
+# Tables whose secondary indexes are dropped during bulk loads
+_BULK_LOAD_TABLES = ('variants', 'reference_blocks', 'sample_contributions')
+
+def _sqlite_pragmas_listener(pragmas):
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f"PRAGMA {name}={value}")
+        cursor.close()
+    return set_pragmas
+
+def partition_name(chr):
+    """Return the name of the variants partition of a contig, readable and unique for any contig name."""
+    readable = re.sub(r'[^a-z0-9_]', '_', chr.lower())[:32]
+    return f"variants_{readable}_{hashlib.sha1(chr.encode()).hexdigest()[:8]}"
+
+@functools.cache
+def _partitioned_variants():
+    """The variants table partitioned by contig on PostgreSQL, created instead of the plain table.
+
+    Built on first use, as the PostgreSQL option imports the PostgreSQL dialect.
+    """
+    return Table(
+        'variants',
+        MetaData(),
+        *[Column(column.name, column.type, primary_key=column.primary_key) for column in Variant.__table__.c],
+        Index('idx_variants_generation', 'generation'),
+        postgresql_partition_by='LIST (contig_id)',
+    )
+
+# The statistics columns of the variants and reference_blocks tables, read back with sample names
+_STAT_COLUMNS = (
+    'mean_non_ref_af', 'sd_non_ref_af', 'max_non_ref_af', 'min_non_ref_af', 'total_depth', 'number_of_samples',
+)
+
+def variants_select(chr, contig_id):
+    """Select the variants on a contig with the columns of the variants table, the contig and samples by name."""
+    max_sample = aliased(Sample)
+    min_sample = aliased(Sample)
+    return select(
+        literal(chr).label('chr'),
+        Variant.pos,
+        *[getattr(Variant, column) for column in _STAT_COLUMNS],
+        max_sample.name.label('max_non_ref_af_sample'),
+        min_sample.name.label('min_non_ref_af_sample'),
+    ).outerjoin(max_sample, max_sample.id == Variant.max_non_ref_af_sample).outerjoin(
+        min_sample, min_sample.id == Variant.min_non_ref_af_sample
+    ).where(Variant.contig_id == contig_id)
+
+def reference_blocks_select(contig_id, start, end):
+    """Select the reference block intervals on a contig overlapping start to end, with the min/max samples by name."""
+    max_sample = aliased(Sample)
+    min_sample = aliased(Sample)
+    return DatabaseAdapter.reference_blocks_statement(contig_id, start, end).with_only_columns(
+        ReferenceBlock.start,
+        ReferenceBlock.end,
+        *[getattr(ReferenceBlock, column) for column in _STAT_COLUMNS],
+        max_sample.name.label('max_non_ref_af_sample'),
+        min_sample.name.label('min_non_ref_af_sample'),
+    ).outerjoin(max_sample, max_sample.id == ReferenceBlock.max_non_ref_af_sample).outerjoin(
+        min_sample, min_sample.id == ReferenceBlock.min_non_ref_af_sample
+    )
+
+class _ChunkStream(io.TextIOBase):
+    """A read-only file object over an iterator of text chunks, used as COPY input."""
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buffer = ''
+    
+    def readable(self):
+        return True
+    
+    def read(self, size=-1):
+        while size < 0 or len(self._buffer) < size:
+            try:
+                self._buffer += next(self._chunks)
+            except StopIteration:
+                break
+        if size < 0:
+            size = len(self._buffer)
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
 
 class DatabaseAdapter:
-    def __init__(self, db_type='sqlite', db_name='variants.db', host=None, port=None, user=None, password=None):
+    def __init__(self, db_type='sqlite', db_name='variants.db', host=None, port=None, user=None, password=None,
+                 bulk_load=False, partition_by_contig=False, reference_blocks=False):
+        """Connect to a database.
+
+        With reference_blocks set, the lookups also read the reference block
+        intervals, see query_region.
+        """
+        if bulk_load and db_type != 'sqlite':
+            raise ValueError(f"Bulk load mode is only supported for SQLite, not {db_type}")
+        if partition_by_contig and db_type != 'postgresql':
+            raise ValueError(f"Partitioning by contig is only supported for PostgreSQL, not {db_type}")
+        self.bulk_load = bulk_load
+        self.partition_by_contig = partition_by_contig
+        self.reference_blocks = reference_blocks
+        self._partitions = set()
+        self._contig_ids = {}
         self.db_type = db_type
         self.db_name = db_name
         self.host = host or 'localhost'
@@ -17,10 +142,30 @@ class DatabaseAdapter:
         self.password = password
         self.engine = self._create_engine()
         self.Session = sessionmaker(bind=self.engine)
+        self.cache = WindowCache(self.fetch_variants)
+    
+    @classmethod
+    def from_config(cls, db_config):
+        """Create an adapter from the database section of a validated configuration."""
+        return cls(
+            db_type=db_config['type'],
+            db_name=db_config['name'],
+            host=db_config.get('host'),
+            port=db_config.get('port'),
+            user=db_config.get('user'),
+            password=db_config.get('password'),
+            bulk_load=db_config.get('bulk_load', False),
+            partition_by_contig=db_config.get('partition_by_contig', False),
+            reference_blocks=db_config.get('reference_blocks', False)
+        )
     
     def _create_engine(self):
         if self.db_type == 'sqlite':
-            return create_engine(f'sqlite:///{self.db_name}')
+            engine = create_engine(f'sqlite:///{self.db_name}')
+            event.listen(engine, 'connect', _register_sqlite_functions)
+            if self.bulk_load:
+                event.listen(engine, 'connect', _sqlite_pragmas_listener(SQLITE_BULK_PRAGMAS))
+            return engine
         elif self.db_type == 'postgresql':
             return create_engine(f'postgresql://{self.user}:{self.password}@{self.host}:{self.port}/{self.db_name}')
         elif self.db_type == 'mysql':
@@ -29,11 +174,249 @@ class DatabaseAdapter:
             raise ValueError(f"Unsupported database type: {self.db_type}")
     
     def create_tables(self):
-        Base.metadata.create_all(self.engine)
+        if not self.partition_by_contig:
+            Base.metadata.create_all(self.engine)
+            return
+        # The partitions are added per contig by ensure_partitions
+        _partitioned_variants().create(self.engine, checkfirst=True)
+        Base.metadata.create_all(self.engine, tables=[
+            table for table in Base.metadata.sorted_tables if table is not Variant.__table__
+        ])
+    
+    def ensure_partitions(self, contigs):
+        """Create the partitions of the variants table for the contigs that have none yet.
+
+        Does nothing unless the table is partitioned by contig. Every partition
+        is created as a table and attached in its own transaction. Attaching
+        does not conflict with writes to the other partitions (PostgreSQL 12
+        or later), so this can be called while loads are running, also from a
+        process whose own transaction has written to the table.
+        """
+        if not self.partition_by_contig:
+            return
+        missing = [chr for chr in dict.fromkeys(contigs) if chr not in self._partitions]
+        contig_ids = self.contig_ids(missing)
+        for chr in missing:
+            name = partition_name(chr)
+            try:
+                with self.engine.begin() as connection:
+                    if not inspect(connection).has_table(name):
+                        connection.execute(text(f'CREATE TABLE "{name}" (LIKE variants INCLUDING DEFAULTS INCLUDING CONSTRAINTS)'))
+                        connection.execute(text(f'ALTER TABLE variants ATTACH PARTITION "{name}" FOR VALUES IN ({contig_ids[chr]:d})'))
+            except exc.DBAPIError:
+                # Another loader may have created the partition at the same time
+                if not inspect(self.engine).has_table(name):
+                    raise
+            self._partitions.add(chr)
     
-    def create_indices(self):
+    def contig_ids(self, names, session=None):
+        """Return the ids of contigs by name, adding the contigs missing from the contigs table.
+
+        Missing contigs are added in a transaction of their own, so that the
+        ids are valid for any later transaction and can be cached. SQLite
+        allows only one writer, so if session is given there, they are added
+        within its transaction instead and are not cached, as a rollback of
+        the session removes them again.
+        """
+        names = list(dict.fromkeys(names))
+        missing = [name for name in names if name not in self._contig_ids]
+        if not missing:
+            return {name: self._contig_ids[name] for name in names}
+        if session is not None and self.db_type == 'sqlite':
+            return {**{name: self._contig_ids[name] for name in names if name in self._contig_ids},
+                    **self._add_contigs(session, missing)}
+        with self.engine.begin() as connection:
+            self._contig_ids.update(self._add_contigs(connection, missing))
+        return {name: self._contig_ids[name] for name in names}
+    
+    def _add_contigs(self, connection, names):
+        stmt = dialect_insert(self.db_type)(Contig.__table__)
+        if self.db_type == 'mysql':
+            stmt = stmt.prefix_with('IGNORE')
+        else:
+            # Another load may add the same contigs at the same time
+            stmt = stmt.on_conflict_do_nothing()
+        connection.execute(stmt, [{'name': name} for name in names])
+        return dict(connection.execute(select(Contig.name, Contig.id).where(Contig.name.in_(names))).all())
+    
+    @staticmethod
+    def contig_names(session):
+        """Return the names of all contigs by id."""
+        return dict(session.execute(select(Contig.id, Contig.name)).all())
+    
+    def lock_contig(self, session, contig_id):
+        """Lock a contig until the transaction of session ends.
+
+        Writers that read and rewrite ranges of a contig, like the intervals
+        of the reference_blocks table, take this lock first, so that
+        concurrent loads and removals cannot overwrite each other's changes.
+        The lock is a row lock on the row of the contig in the contigs table.
+        SQLite allows only one writer at a time, so nothing is locked there.
+        """
+        if self.db_type == 'sqlite':
+            return
+        session.execute(select(Contig.id).where(Contig.id == contig_id).with_for_update())
+    
+    def drop_secondary_indexes(self):
+        """Drop the secondary indexes of the tables written by loads and return them for restore_indexes."""
+        existing = set(inspect(self.engine).get_table_names())
+        metadata = MetaData()
+        metadata.reflect(self.engine, only=[table for table in _BULK_LOAD_TABLES if table in existing])
+        indexes = [index for table in metadata.tables.values() for index in table.indexes]
+        with self.engine.begin() as connection:
+            for index in indexes:
+                index.drop(connection)
+        return indexes
+    
+    def restore_indexes(self, indexes):
+        with self.engine.begin() as connection:
+            for index in indexes:
+                index.create(connection)
+    
+    @contextlib.contextmanager
+    def deferred_indexes(self):
+        """Drop the secondary indexes for the duration of a bulk load and rebuild them afterwards.
+
+        Building an index once over the loaded rows is much faster than
+        updating it row by row. On SQLite the write-ahead log is checkpointed
+        into the database file afterwards.
+        """
+        indexes = self.drop_secondary_indexes()
+        try:
+            yield indexes
+        finally:
+            self.restore_indexes(indexes)
+            if self.db_type == 'sqlite':
+                with self.engine.connect() as connection:
+                    connection.execute(text("PRAGMA wal_checkpoint(TRUNCATE)"))
+    
+    def copy_from(self, session, table_name, columns, chunks):
+        """Stream tab separated rows into a table with a single COPY FROM STDIN.
+
+        chunks is an iterable of text holding complete, newline terminated rows.
+        The COPY runs on the connection of the session, inside its transaction.
+        Only supported for PostgreSQL.
+        """
+        if self.db_type != 'postgresql':
+            raise ValueError(f"COPY is not supported for database type: {self.db_type}")
+        cursor = session.connection().connection.cursor()
+        try:
+            cursor.copy_expert(f"COPY {table_name} ({', '.join(columns)}) FROM STDIN", _ChunkStream(chunks))
+        finally:
+            cursor.close()
+    
+    @staticmethod
+    def reference_blocks_statement(contig_id, start, end=None):
+        """Build a select of the reference blocks on a contig overlapping start to end, ordered by start.
+
+        Without end, the block covering the single position start is selected.
+        Blocks never overlap, so the only block starting before start that can
+        reach it is the last one, and both lookups are primary key range scans.
+        """
+        end = start if end is None else end
+        last_before = select(func.max(ReferenceBlock.start)).where(
+            ReferenceBlock.contig_id == contig_id,
+            ReferenceBlock.start <= start
+        ).scalar_subquery()
+        return select(ReferenceBlock).where(
+            ReferenceBlock.contig_id == contig_id,
+            or_(ReferenceBlock.start == last_before, ReferenceBlock.start.between(start, end)),
+            ReferenceBlock.end >= start
+        ).order_by(ReferenceBlock.start)
+    
+    def get_reference_blocks(self, chr, start, end=None):
+        """Return the reference blocks on chr overlapping start to end, or covering start if end is omitted."""
+        session = self.get_session()
+        try:
+            contig_id = session.scalar(select(Contig.id).where(Contig.name == chr))
+            if contig_id is None:
+                return []
+            return session.scalars(self.reference_blocks_statement(contig_id, start, end)).all()
+        finally:
+            session.close()
+    
+    def fetch_variants(self, chr, start, end):
+        """Fetch the variants on chr from start to end, ordered by position, with a primary key range scan.
+
+        The rows have the columns of the variants table with the contig and
+        the min/max samples by name.
+        """
         with self.engine.connect() as connection:
-            Index('idx_variants_chr_pos', Variant.chr, Variant.pos).create(connection)
+            if chr not in self._contig_ids:
+                contig_id = connection.scalar(select(Contig.id).where(Contig.name == chr))
+                if contig_id is None:
+                    return []
+                self._contig_ids[chr] = contig_id
+            stmt = variants_select(chr, self._contig_ids[chr]).where(Variant.pos.between(start, end)).order_by(Variant.pos)
+            return connection.execute(stmt).all()
+    
+    def fetch_reference_blocks(self, chr, start, end):
+        """Fetch the reference block intervals on chr overlapping start to end, ordered by start.
+
+        The rows have start and end followed by the statistics columns, with the min/max samples by name.
+        """
+        with self.engine.connect() as connection:
+            contig_id = connection.scalar(select(Contig.id).where(Contig.name == chr))
+            if contig_id is None:
+                return []
+            return connection.execute(reference_blocks_select(contig_id, start, end)).all()
+    
+    def query_region(self, chr, start, end):
+        """Return the variants on chr from start to end, both inclusive, ordered by position.
+
+        Rows have the columns of the variants table as attributes. Lookups are
+        served from a cache of recently fetched windows, call clear_cache()
+        after changing the database through another adapter or process.
+
+        With reference_blocks set, every position covered by a reference
+        block interval is returned too, with the statistics of the interval
+        combined with those of the variant at the position. The intervals are
+        not cached.
+        """
+        rows = self.cache.region(chr, start, end)
+        if not self.reference_blocks:
+            return rows
+        return merge_blocks(chr, start, end, rows, self.fetch_reference_blocks(chr, start, end))
+    
+    def query_positions(self, positions):
+        """Return the variant at each (chr, pos) in positions, or None where there is none, in input order.
+
+        With reference_blocks set, positions covered by a reference block
+        interval are combined with it as in query_region.
+        """
+        positions = list(positions)
+        by_chr = {}
+        for i, (chr, pos) in enumerate(positions):
+            by_chr.setdefault(chr, []).append(i)
+        found = [None] * len(positions)
+        for chr, indices in by_chr.items():
+            chr_positions = [positions[i][1] for i in indices]
+            rows = self.cache.positions(chr, chr_positions)
+            if self.reference_blocks:
+                rows = self._with_blocks(chr, chr_positions, rows)
+            for i, row in zip(indices, rows):
+                found[i] = row
+        return found
+    
+    def _with_blocks(self, chr, positions, rows):
+        """Combine the rows found at positions on chr with the intervals covering them."""
+        blocks = self.fetch_reference_blocks(chr, min(positions), max(positions))
+        starts = [block.start for block in blocks]
+        combined = []
+        for pos, row in zip(positions, rows):
+            i = bisect.bisect_right(starts, pos) - 1
+            if i >= 0 and blocks[i].end >= pos:
+                row = merge_blocks(chr, pos, pos, [] if row is None else [row], [blocks[i]])[0]
+            combined.append(row)
+        return combined
+    
+    def query_bed(self, bed_file):
+        """Yield the variants in every region of an open BED file, region by region."""
+        for chr, start, end in read_bed(bed_file):
+            yield from self.query_region(chr, start, end)
+    
+    def clear_cache(self):
+        self.cache.clear()
     
     def get_session(self):
         return self.Session()
@@ -0,0 +1,94 @@
+"""
+This module tracks the changes to the variants table, so that exports and
+snapshots can be brought up to date with only the positions changed since
+they were written. Every load, removal and rebuild is a generation with an
+increasing id in the generations table. The rows of the variants table it
+writes are stamped with its id, and the positions it deletes are recorded as
+tombstones in the variant_tombstones table.
+
+A generation is added in a transaction of its own before it writes and is
+marked finished when it can no longer write. An export covers all changes up
+to the last generation before the oldest unfinished one, as rows of
+unfinished generations may still be committed later. Ids are committed in
+increasing order, so a reader that sees a generation sees all before it.
+"""
+
+from datetime import datetime, timezone
+from sqlalchemy import and_, func, select, text, update
+
+from varnoisedb.models import Generation, Variant, VariantTombstone
+from varnoisedb.upsert import tombstones_upsert
+
+def start_generation(db_adapter, operation):
+    """Add a generation for an operation, such as 'load', and return its id."""
+    with db_adapter.engine.begin() as connection:
+        # Serializes adding generations until the commit, SQLite has a single writer anyway
+        if db_adapter.db_type == 'postgresql':
+            connection.execute(text("LOCK TABLE generations IN SHARE ROW EXCLUSIVE MODE"))
+        elif db_adapter.db_type == 'mysql':
+            connection.execute(select(func.max(Generation.id)).with_for_update())
+        return connection.execute(Generation.__table__.insert().values(operation=operation)).inserted_primary_key[0]
+
+def finish_generations(session, generations):
+    """Mark generations as finished, within the transaction of session."""
+    generations = [generation for generation in generations if generation is not None]
+    if generations:
+        session.execute(
+            update(Generation).where(Generation.id.in_(generations), Generation.finished.is_(None))
+            .values(finished=datetime.now(timezone.utc))
+        )
+
+def finish_generation(db_adapter, generation):
+    """Mark a generation as finished in a transaction of its own."""
+    with db_adapter.engine.begin() as connection:
+        finish_generations(connection, [generation])
+
+def exported_generation(session):
+    """Return the generation up to which all changes are committed, 0 before the first generation."""
+    oldest_open = session.execute(select(func.min(Generation.id)).where(Generation.finished.is_(None))).scalar()
+    if oldest_open is not None:
+        return oldest_open - 1
+    return session.execute(select(func.coalesce(func.max(Generation.id), 0))).scalar()
+
+def open_generations(session):
+    """Return the unfinished generations as (id, operation, started) rows."""
+    stmt = select(Generation.id, Generation.operation, Generation.started).where(Generation.finished.is_(None))
+    return session.execute(stmt.order_by(Generation.id)).all()
+
+def rebuilt_since(session, since):
+    """Return the last rebuild after generation since, None if there was none.
+
+    A rebuild rewrites every row of the variants table without recording the
+    deleted positions, so changes across it cannot be exported.
+    """
+    stmt = select(func.max(Generation.id)).where(Generation.operation == 'rebuild', Generation.id > since)
+    return session.execute(stmt).scalar()
+
+class SinceError(ValueError):
+    """Raised when the changes after a generation cannot be exported."""
+
+def check_since(session, since, generation):
+    """Raise SinceError if the changes from generation since to generation cannot be exported."""
+    if since > generation:
+        raise SinceError(f"Generation {since} is newer than the database, which is at generation {generation}")
+    rebuilt = rebuilt_since(session, since)
+    if rebuilt is not None:
+        raise SinceError(f"The variants were rebuilt in generation {rebuilt}, export all of them instead")
+
+def record_tombstones(session, contig_id, positions, generation):
+    """Record positions on a contig as deleted by generation."""
+    rows = [{'contig_id': contig_id, 'pos': pos, 'generation': generation} for pos in positions]
+    if rows:
+        session.execute(tombstones_upsert(session.get_bind().dialect.name), rows)
+
+def deleted_statement(since, contig_ids=None):
+    """Select the contig id and position of the positions deleted after generation since and not written again."""
+    written = select(Variant.pos).where(
+        and_(Variant.contig_id == VariantTombstone.contig_id, Variant.pos == VariantTombstone.pos)
+    ).exists()
+    stmt = select(VariantTombstone.contig_id, VariantTombstone.pos).where(
+        VariantTombstone.generation > since, ~written
+    ).order_by(VariantTombstone.contig_id, VariantTombstone.pos)
+    if contig_ids is not None:
+        stmt = stmt.where(VariantTombstone.contig_id.in_(contig_ids))
+    return stmt
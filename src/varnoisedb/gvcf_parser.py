@@ -1,8 +1,260 @@
+import collections
+import os
+import numpy as np
 from cyvcf2 import VCF
 
+from varnoisedb.utils import combine_stats, update_multiple_stats
+
+# The largest position a tabix index can address
+MAX_TABIX_POSITION = 2 ** 29 - 1
+
+# Yielded by parse_stats with checkpoints set: all records up to pos on chr in
+# file order have been yielded and none after it
+Checkpoint = collections.namedtuple('Checkpoint', ['chr', 'pos'])
+
+def next_batch_size(batch_size):
+    """Return the number of records of the next batch, batch_size is a number or a BatchSizer adapting it."""
+    return getattr(batch_size, 'size', batch_size)
+
+def has_index(gvcf_file):
+    """Check whether a tabix or CSI index exists next to the GVCF file."""
+    return any(os.path.exists(gvcf_file + suffix) for suffix in ('.tbi', '.csi'))
+
+class VariantBatch:
+    """A columnar batch of parsed GVCF records from a single chromosome.
+
+    Positions are stored as int32 and allele frequencies and depths as float32.
+    The chromosome and sample name are stored once for the whole batch. end
+    holds the last position covered by each record, which is past pos only for
+    reference blocks.
+    """
+    def __init__(self, chr, pos, non_ref_af, dp, sample_name, end=None):
+        self.chr = chr
+        self.pos = pos
+        self.non_ref_af = non_ref_af
+        self.dp = dp
+        self.sample_name = sample_name
+        self.end = pos if end is None else end
+
+    def __len__(self):
+        return len(self.pos)
+
+    def __repr__(self):
+        return f"<VariantBatch(chr='{self.chr}', n={len(self)}, sample_name='{self.sample_name}')>"
+
+    def take(self, index):
+        """Return a new batch with the records selected by an index or boolean mask."""
+        return VariantBatch(
+            self.chr,
+            self.pos[index],
+            self.non_ref_af[index],
+            self.dp[index],
+            self.sample_name,
+            self.end[index],
+        )
+
+    def split_blocks(self):
+        """Split the batch into its reference blocks and its single-position records."""
+        is_block = self.end > self.pos
+        return self.take(is_block), self.take(~is_block)
+
+    def to_stats(self, intervals=False):
+        """Return the batch as single-sample statistics.
+
+        With intervals set, the statistics cover the records from pos to end,
+        otherwise only their start positions.
+        """
+        n = len(self)
+        non_ref_af = self.non_ref_af.astype(np.float64)
+        sample_names = np.full(n, self.sample_name, dtype=object)
+        return StatsBatch(
+            self.chr,
+            self.pos,
+            non_ref_af,
+            np.zeros(n),
+            non_ref_af,
+            non_ref_af,
+            self.dp.astype(np.float64),
+            np.ones(n, dtype=np.int64),
+            sample_names,
+            sample_names,
+            end=self.end if intervals else None,
+        )
+
+class StatsBatch:
+    """Per-position statistics for a batch of positions on a single chromosome.
+
+    Holds one array per column of the variants table, named after the columns,
+    so that it can be merged into the database by any of the write modes. If
+    end is given, the statistics describe the intervals from pos to end instead
+    of single positions.
+    """
+    def __init__(self, chr, pos, mean_non_ref_af, sd_non_ref_af, max_non_ref_af, min_non_ref_af,
+                 total_depth, number_of_samples, max_non_ref_af_sample, min_non_ref_af_sample, end=None):
+        self.chr = chr
+        self.pos = pos
+        self.mean_non_ref_af = mean_non_ref_af
+        self.sd_non_ref_af = sd_non_ref_af
+        self.max_non_ref_af = max_non_ref_af
+        self.min_non_ref_af = min_non_ref_af
+        self.total_depth = total_depth
+        self.number_of_samples = number_of_samples
+        self.max_non_ref_af_sample = max_non_ref_af_sample
+        self.min_non_ref_af_sample = min_non_ref_af_sample
+        self.end = end
+
+    def __len__(self):
+        return len(self.pos)
+
+    def __repr__(self):
+        return f"<StatsBatch(chr='{self.chr}', n={len(self)})>"
+
+    def take(self, index):
+        """Return a new batch with the positions selected by an index or boolean mask."""
+        return StatsBatch(
+            self.chr,
+            self.pos[index],
+            self.mean_non_ref_af[index],
+            self.sd_non_ref_af[index],
+            self.max_non_ref_af[index],
+            self.min_non_ref_af[index],
+            self.total_depth[index],
+            self.number_of_samples[index],
+            self.max_non_ref_af_sample[index],
+            self.min_non_ref_af_sample[index],
+            end=None if self.end is None else self.end[index],
+        )
+
+    def merge(self, other):
+        """Return these statistics combined with those of another batch for the same positions.
+
+        Missing (NaN) min/max values are always replaced by the other batch.
+        """
+        mean, sd, number = combine_stats(
+            self.mean_non_ref_af,
+            self.sd_non_ref_af,
+            self.number_of_samples,
+            other.mean_non_ref_af,
+            other.sd_non_ref_af,
+            other.number_of_samples,
+        )
+        # NaN comparisons are False, so missing min/max values are always replaced
+        is_new_max = ~(other.max_non_ref_af <= self.max_non_ref_af)
+        is_new_min = ~(other.min_non_ref_af >= self.min_non_ref_af)
+        return StatsBatch(
+            self.chr,
+            self.pos,
+            mean,
+            sd,
+            np.where(is_new_max, other.max_non_ref_af, self.max_non_ref_af),
+            np.where(is_new_min, other.min_non_ref_af, self.min_non_ref_af),
+            self.total_depth + other.total_depth,
+            number,
+            np.where(is_new_max, other.max_non_ref_af_sample, self.max_non_ref_af_sample),
+            np.where(is_new_min, other.min_non_ref_af_sample, self.min_non_ref_af_sample),
+            end=self.end,
+        )
+
+    def remove(self, non_ref_af, dp, sample_name):
+        """Return these statistics with one sample's value at every position removed.
+
+        If the removed sample held the min or max, that information is lost and
+        set to NaN and None.
+        """
+        mean, sd, number = update_multiple_stats(
+            self.mean_non_ref_af,
+            self.sd_non_ref_af,
+            self.number_of_samples,
+            non_ref_af,
+            operation='remove'
+        )
+        lost_max = self.max_non_ref_af_sample == sample_name
+        lost_min = self.min_non_ref_af_sample == sample_name
+        return StatsBatch(
+            self.chr,
+            self.pos,
+            mean,
+            sd,
+            np.where(lost_max, np.nan, self.max_non_ref_af),
+            np.where(lost_min, np.nan, self.min_non_ref_af),
+            self.total_depth - dp,
+            number,
+            np.where(lost_max, None, self.max_non_ref_af_sample),
+            np.where(lost_min, None, self.min_non_ref_af_sample),
+            end=self.end,
+        )
+
+def _aggregate(chr, pos, non_ref_af, dp, sample_index, sample_names):
+    """Aggregate records from several samples into per-position statistics.
+
+    Of samples with equal values, the min/max goes to the first one, as when
+    the samples are loaded one after another.
+    """
+    # Sorting by AF and sample within each position puts the min first and the max last
+    order = np.lexsort((sample_index, non_ref_af, pos))
+    pos = pos[order]
+    non_ref_af = non_ref_af[order].astype(np.float64)
+    dp = dp[order].astype(np.float64)
+    sample_index = sample_index[order]
+
+    starts = np.flatnonzero(np.r_[True, pos[1:] != pos[:-1]])
+    ends = np.r_[starts[1:], len(pos)]
+    number = ends - starts
+    mean = np.add.reduceat(non_ref_af, starts) / number
+    m2 = np.add.reduceat((non_ref_af - np.repeat(mean, number)) ** 2, starts)
+    max_af = non_ref_af[ends - 1]
+    # The values equal to the max are the last of each position, the first of them is the first sample.
+    # NaN values, of records without depth, sort last and count as equal.
+    group_max = np.repeat(max_af, number)
+    is_max = (non_ref_af == group_max) | (np.isnan(non_ref_af) & np.isnan(group_max))
+    is_start = np.zeros(len(pos), dtype=bool)
+    is_start[starts] = True
+    first_max = np.flatnonzero(is_max & (is_start | np.r_[True, ~is_max[:-1]]))
+    first_max = first_max[np.searchsorted(first_max, starts)]
+    return StatsBatch(
+        chr,
+        pos[starts],
+        mean,
+        np.sqrt(m2 / number),
+        max_af,
+        non_ref_af[starts],
+        np.add.reduceat(dp, starts),
+        number.astype(np.int64),
+        sample_names[sample_index[first_max]],
+        sample_names[sample_index[starts]],
+    )
+
+def _observe(batches, on_batch):
+    """Pass batches through, calling on_batch with each of them if given."""
+    if on_batch is None:
+        yield from batches
+        return
+    for batch in batches:
+        on_batch(batch)
+        yield batch
+
 class GVCFParser:
-    def __init__(self, gvcf_file):
+    def __init__(self, gvcf_file, regions=None, targets=None):
+        """Parse a GVCF file.
+
+        regions is an optional list of (chr, start, end) tuples, 1-based and
+        inclusive, that restricts parse_columnar and parse_stats to records
+        starting within them. It requires a tabix or CSI index of the file.
+        targets is an optional varnoisedb.targets.Targets that the records of
+        parse_columnar and parse_stats are clipped to, read through the index
+        if the file has one.
+
+        records_parsed and records_skipped count the records parse_columnar
+        has read with and without a <NON_REF> allele, records_duplicate the
+        records it dropped for sharing the position of the previous record.
+        """
         self.gvcf_file = gvcf_file
+        self.regions = regions
+        self.targets = targets
+        self.after = None
+        self.records_parsed = 0
+        self.records_skipped = 0
+        self.records_duplicate = 0
         self._sample_name = None
     
     def get_sample_name(self):
@@ -12,41 +264,294 @@ class GVCFParser:
             self._sample_name = vcf.samples[0] if vcf.samples else "unknown"
         return self._sample_name
     
-    def parse(self):
-        vcf = VCF(self.gvcf_file)
-        sample_name = vcf.samples[0]
-        self._sample_name = sample_name  # Store for future use
-        
-        for record in vcf:
-            chr = record.CHROM
-            pos = record.POS
-            ad = record.format('AD')[0]
-            dp = record.format('DP')[0]
-            alt_alleles = record.ALT
-            non_ref_index = alt_alleles.index('<NON_REF>') + 1 if '<NON_REF>' in alt_alleles else None
-            if non_ref_index:
-                non_ref_af = ad[non_ref_index] / dp
-                yield chr, pos, non_ref_af, dp, sample_name
+    def samples(self):
+        """Get the (name, path) of the sample in the GVCF file."""
+        return [(self.get_sample_name(), self.gvcf_file)]
     
-    def parse_batch(self, batch_size):
+    def contigs(self):
+        """Get the names of the contigs in the header of the GVCF file."""
+        return list(VCF(self.gvcf_file).seqnames)
+    
+    def skip_to(self, chr, pos):
+        """Restrict parse_columnar and parse_stats to the records after chr:pos in file order.
+
+        This resumes an interrupted load from its checkpoint. Indexed files
+        are queried from the checkpoint on, others are read from the start.
+        """
+        if self.regions is not None:
+            raise ValueError("A parser restricted to regions cannot skip to a position")
+        if self.targets is not None:
+            # Records overlapping the targets after the position are clipped to them
+            self.targets = self.targets.after(self.contigs(), chr, pos)
+            return
+        self.after = (chr, pos)
+    
+    def parse_columnar(self, batch_size):
+        """Parse the GVCF file into columnar batches of at most batch_size records.
+
+        A new batch is started whenever the chromosome changes, so every batch
+        covers a single chromosome. batch_size can be a BatchSizer, whose size
+        is read at the start of every batch. The non-ref allele frequency is
+        computed for the whole batch at once instead of per record. A sample
+        has one value per position, so of several records at one position only
+        the first is kept, also across batches. With
+        targets, the records are clipped to them, which can split a batch into
+        more records.
+        """
+        for batch in self._read_columnar(batch_size):
+            if self.targets is not None:
+                batch = self.targets.clip(batch)
+            if len(batch):
+                yield batch
+
+    def _read_columnar(self, batch_size):
         vcf = VCF(self.gvcf_file)
         sample_name = vcf.samples[0]
         self._sample_name = sample_name  # Store for future use
-        
-        batch = []
-        for record in vcf:
-            chr = record.CHROM
-            pos = record.POS
-            ad = record.format('AD')[0]
-            dp = record.format('DP')[0]
+
+        chr = None
+        last_pos = None
+        size = next_batch_size(batch_size)
+        pos, end, non_ref_ad, dp = self._allocate(size)
+        n = 0
+        for record in self._records(vcf):
             alt_alleles = record.ALT
-            non_ref_index = alt_alleles.index('<NON_REF>') + 1 if '<NON_REF>' in alt_alleles else None
-            if non_ref_index:
-                non_ref_af = ad[non_ref_index] / dp
-                batch.append((chr, pos, non_ref_af, dp, sample_name))
-                if len(batch) >= batch_size:
-                    yield batch
-                    batch = []
-        
-        if batch:
-            yield batch
+            try:
+                non_ref_index = alt_alleles.index('<NON_REF>') + 1
+            except ValueError:
+                self.records_skipped += 1
+                continue
+            # Records sharing a position are adjacent in a sorted file
+            if record.CHROM == chr and record.POS == last_pos:
+                self.records_duplicate += 1
+                continue
+
+            if record.CHROM != chr or n >= size:
+                if n:
+                    self.records_parsed += n
+                    yield self._make_batch(chr, pos, end, non_ref_ad, dp, n, sample_name)
+                    size = next_batch_size(batch_size)
+                    pos, end, non_ref_ad, dp = self._allocate(size)
+                    n = 0
+                chr = record.CHROM
+
+            pos[n] = last_pos = record.POS
+            # Only reference-only records can be reference blocks, a longer REF is a deletion
+            end[n] = record.end if len(alt_alleles) == 1 else record.POS
+            non_ref_ad[n] = record.format('AD')[0, non_ref_index]
+            dp[n] = record.format('DP')[0, 0]
+            n += 1
+
+        if n:
+            self.records_parsed += n
+            yield self._make_batch(chr, pos, end, non_ref_ad, dp, n, sample_name)
+
+    def _records(self, vcf):
+        """Iterate over all records, or over the records of the regions through the index."""
+        if self.targets is not None:
+            yield from self._target_records(vcf)
+            return
+        regions = self.regions
+        if self.after is not None:
+            regions = self._regions_after(vcf)
+            if regions is None:
+                yield from self._records_after(vcf)
+                return
+        if regions is None:
+            yield from vcf
+            return
+        # The regions of a cohort can cover contigs that are not in the header of every file
+        contigs = set(vcf.seqnames)
+        for chr, start, end in regions:
+            if chr not in contigs:
+                continue
+            for record in vcf(f"{chr}:{start}-{end}"):
+                # Region queries also return records that start before the region and overlap it
+                if record.POS >= start:
+                    yield record
+
+    def _target_records(self, vcf):
+        """Iterate over the records overlapping the targets, through the index if the file has one."""
+        if not has_index(self.gvcf_file):
+            for record in vcf:
+                if self.targets.overlaps(record.CHROM, record.POS, record.end):
+                    yield record
+            return
+        (last_chr, last_end) = (None, 0)
+        for chr, start, end in self.targets.regions(vcf.seqnames):
+            for record in vcf(f"{chr}:{start}-{end}"):
+                # A record overlapping several regions is returned for each of them. The regions
+                # are sorted and apart, so a record starting in or before the previous region was
+                # already returned for it, and records sharing a position are all kept
+                if chr == last_chr and record.POS <= last_end:
+                    continue
+                yield record
+            (last_chr, last_end) = (chr, end)
+
+    def _regions_after(self, vcf):
+        """Return the regions following the skip_to position, or None if the file cannot be queried by region."""
+        chr, pos = self.after
+        contigs = list(vcf.seqnames)
+        if not has_index(self.gvcf_file) or chr not in contigs:
+            return None
+        following = contigs[contigs.index(chr) + 1:]
+        return [(chr, pos + 1, MAX_TABIX_POSITION)] + [(contig, 1, MAX_TABIX_POSITION) for contig in following]
+
+    def _records_after(self, vcf):
+        """Iterate over the records after the skip_to position by reading the file from the start."""
+        chr, pos = self.after
+        reached = False
+        for record in vcf:
+            if not reached:
+                if record.CHROM != chr:
+                    continue
+                reached = True
+            if record.CHROM == chr and record.POS <= pos:
+                continue
+            yield record
+
+    @staticmethod
+    def _allocate(batch_size):
+        """Allocate the column arrays for one batch."""
+        return (
+            np.empty(batch_size, dtype=np.int32),
+            np.empty(batch_size, dtype=np.int32),
+            np.empty(batch_size, dtype=np.float32),
+            np.empty(batch_size, dtype=np.float32),
+        )
+
+    @staticmethod
+    def _make_batch(chr, pos, end, non_ref_ad, dp, n, sample_name):
+        """Trim the column arrays to n records and wrap them in a VariantBatch."""
+        dp = dp[:n]
+        non_ref_af = non_ref_ad[:n] / dp
+        return VariantBatch(chr, pos[:n], non_ref_af, dp, sample_name, end[:n])
+
+    def parse_stats(self, batch_size, reference_blocks=False, on_batch=None, checkpoints=False):
+        """Parse the GVCF file into columnar single-sample statistics batches.
+
+        With reference_blocks set, reference blocks are yielded as separate
+        interval batches, otherwise they count for their start position only.
+        on_batch is called with every VariantBatch read from the file. With
+        checkpoints set, a Checkpoint is yielded after the batches of every
+        VariantBatch.
+        """
+        for batch in _observe(self.parse_columnar(batch_size), on_batch):
+            last_pos = int(batch.pos[-1])
+            if reference_blocks:
+                blocks, batch = batch.split_blocks()
+                if len(blocks):
+                    yield blocks.to_stats(intervals=True)
+            if len(batch):
+                yield batch.to_stats()
+            if checkpoints:
+                yield Checkpoint(batch.chr, last_pos)
+
+class CohortParser:
+    """Merge several coordinate sorted GVCF files into per-position statistics.
+
+    The files are merged with a streaming k-way merge by (chr, pos), so every
+    position is aggregated across all samples in memory before it is written.
+    Chromosomes are ordered as in the header of the first file.
+    """
+    def __init__(self, gvcf_files, regions=None, targets=None):
+        self.parsers = [GVCFParser(gvcf_file, regions, targets) for gvcf_file in gvcf_files]
+        self.targets = targets
+
+    def get_sample_names(self):
+        """Get the names of the samples in the GVCF files."""
+        return [parser.get_sample_name() for parser in self.parsers]
+
+    def samples(self):
+        """Get the (name, path) of the samples in the GVCF files."""
+        return [sample for parser in self.parsers for sample in parser.samples()]
+
+    def contigs(self):
+        """Get the names of the contigs in the headers of the GVCF files, in the order of the first file."""
+        return list(dict.fromkeys(contig for parser in self.parsers for contig in parser.contigs()))
+
+    def skip_to(self, chr, pos):
+        """Restrict parse_stats to the records after chr:pos in file order, see GVCFParser.skip_to."""
+        for parser in self.parsers:
+            parser.skip_to(chr, pos)
+
+    @property
+    def records_parsed(self):
+        return sum(parser.records_parsed for parser in self.parsers)
+
+    @property
+    def records_skipped(self):
+        return sum(parser.records_skipped for parser in self.parsers)
+
+    @property
+    def records_duplicate(self):
+        return sum(parser.records_duplicate for parser in self.parsers)
+
+    def parse_stats(self, batch_size, reference_blocks=False, on_batch=None, checkpoints=False):
+        """Merge the GVCF files into columnar statistics batches.
+
+        Each file is read in columnar batches of batch_size records, so memory
+        use is bounded by the number of files times batch_size. With
+        reference_blocks set, the reference blocks of each sample are yielded
+        unmerged as separate interval batches. on_batch is called with every
+        VariantBatch read from any of the files. With checkpoints set, a
+        Checkpoint is yielded whenever all records up to a position have been
+        merged.
+        """
+        sample_names = np.array(self.get_sample_names(), dtype=object)
+        contig_rank = {chr: i for i, chr in enumerate(VCF(self.parsers[0].gvcf_file).seqnames)}
+        streams = [_observe(parser.parse_columnar(batch_size), on_batch) for parser in self.parsers]
+        heads = [next(stream, None) for stream in streams]
+
+        while any(head is not None for head in heads):
+            chr = min(
+                (head.chr for head in heads if head is not None),
+                key=lambda chr: (contig_rank.get(chr, len(contig_rank)), chr),
+            )
+            yield from self._merge_contig(chr, streams, heads, sample_names, reference_blocks, checkpoints)
+
+    def _merge_contig(self, chr, streams, heads, sample_names, reference_blocks, checkpoints):
+        """Merge the records of all samples on one chromosome.
+
+        Every stream holds at most one buffered batch. Records up to the
+        smallest last buffered position among the streams that may still have
+        more records on the chromosome are complete and can be aggregated.
+        Everything up to such a position is yielded before anything after it,
+        the reference blocks of each sample first and then the aggregated
+        positions.
+        """
+        pending = {}
+        while True:
+            for i in range(len(heads)):
+                if i not in pending and heads[i] is not None and heads[i].chr == chr:
+                    pending[i] = heads[i]
+                    heads[i] = next(streams[i], None)
+            if not pending:
+                return
+
+            open_ends = [batch.pos[-1] for i, batch in pending.items() if heads[i] is not None and heads[i].chr == chr]
+            frontier = min(open_ends) if open_ends else None
+
+            pieces = []
+            last_pos = None
+            for i, batch in list(pending.items()):
+                cut = len(batch) if frontier is None else int(np.searchsorted(batch.pos, frontier, side='right'))
+                if cut == 0:
+                    continue
+                head = batch.take(slice(None, cut))
+                last_pos = max(last_pos or 0, int(head.pos[-1]))
+                if cut == len(batch):
+                    del pending[i]
+                else:
+                    pending[i] = batch.take(slice(cut, None))
+                if reference_blocks:
+                    blocks, head = head.split_blocks()
+                    if len(blocks):
+                        yield blocks.to_stats(intervals=True)
+                if len(head):
+                    pieces.append((head.pos, head.non_ref_af, head.dp, np.full(len(head), i, dtype=np.intp)))
+
+            if pieces:
+                yield _aggregate(chr, *(np.concatenate(column) for column in zip(*pieces)), sample_names)
+            if checkpoints and last_pos is not None:
+                yield Checkpoint(chr, last_pos)
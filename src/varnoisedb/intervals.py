@@ -0,0 +1,177 @@
+"""
+This module merges the statistics of reference blocks stored as intervals.
+Stored intervals never overlap. When a sample with different block boundaries
+is added or removed, the intervals are split at all boundaries, the statistics
+of every piece are updated, and neighbouring pieces with identical statistics
+are joined again, so that the intervals stay run-length encoded.
+"""
+
+import numpy as np
+
+from varnoisedb.gvcf_parser import StatsBatch
+
+_COLUMNS = (
+    'mean_non_ref_af',
+    'sd_non_ref_af',
+    'max_non_ref_af',
+    'min_non_ref_af',
+    'total_depth',
+    'number_of_samples',
+    'max_non_ref_af_sample',
+    'min_non_ref_af_sample',
+)
+
+def covering(starts, ends, points):
+    """Find the interval covering each point.
+
+    starts must be sorted and the intervals must not overlap. Returns the index
+    of the covering interval of each point and a boolean mask of the points
+    that are covered at all.
+    """
+    idx = np.searchsorted(starts, points, side='right') - 1
+    idx = np.maximum(idx, 0)
+    if len(starts) == 0:
+        return idx, np.zeros(len(points), dtype=bool)
+    covered = (starts[idx] <= points) & (ends[idx] >= points)
+    return idx, covered
+
+def _pieces(*batches):
+    """Split the union of the intervals of several batches at all their boundaries.
+
+    Returns the start and end of every piece, gaps between intervals included.
+    """
+    bounds = np.unique(np.concatenate(
+        [batch.pos for batch in batches] + [batch.end + 1 for batch in batches]
+    ).astype(np.int64))
+    return bounds[:-1], bounds[1:] - 1
+
+def _select(mask, a, b, pos, end):
+    """Build a batch over the given pieces with columns from a where mask is set and from b elsewhere."""
+    columns = [np.where(mask, getattr(a, column), getattr(b, column)) for column in _COLUMNS]
+    return StatsBatch(a.chr, pos, *columns, end=end)
+
+def _coalesce(batch):
+    """Join neighbouring intervals with identical statistics."""
+    if len(batch) < 2:
+        return batch
+    same = batch.end[:-1] + 1 == batch.pos[1:]
+    for column in _COLUMNS:
+        values = getattr(batch, column)
+        equal = values[:-1] == values[1:]
+        if values.dtype != object:
+            # Missing min/max values are NaN and equal to each other here
+            equal |= np.isnan(values[:-1]) & np.isnan(values[1:])
+        same &= equal
+    first = np.flatnonzero(np.concatenate(([True], ~same)))
+    last = np.concatenate((first[1:] - 1, [len(batch) - 1]))
+    coalesced = batch.take(first)
+    coalesced.end = batch.end[last]
+    return coalesced
+
+def merge_intervals(existing, incoming):
+    """Merge the statistics of incoming intervals into existing intervals.
+
+    Both are StatsBatch objects with end set, sorted by position and each
+    without overlapping intervals. Returns the merged intervals covering the
+    union of both.
+    """
+    if len(existing) == 0:
+        return _coalesce(incoming)
+    if len(incoming) == 0:
+        return _coalesce(existing)
+
+    pos, end = _pieces(existing, incoming)
+    existing_idx, in_existing = covering(existing.pos, existing.end, pos)
+    incoming_idx, in_incoming = covering(incoming.pos, incoming.end, pos)
+    keep = in_existing | in_incoming
+    pos, end = pos[keep], end[keep]
+    in_existing, in_incoming = in_existing[keep], in_incoming[keep]
+    old = existing.take(existing_idx[keep])
+    new = incoming.take(incoming_idx[keep])
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        merged = old.merge(new)
+    merged = _select(in_incoming, merged, old, pos, end)
+    return _coalesce(_select(in_existing, merged, new, pos, end))
+
+def subtract_intervals(existing, removed):
+    """Remove the values of one sample's reference blocks from existing intervals.
+
+    existing is a StatsBatch with end set and removed a VariantBatch of the
+    blocks of the sample, both sorted and without overlaps. Returns the
+    remaining intervals, without those left with no samples.
+    """
+    if len(existing) == 0 or len(removed) == 0:
+        return existing
+
+    pos, end = _pieces(existing, removed)
+    existing_idx, in_existing = covering(existing.pos, existing.end, pos)
+    removed_idx, in_removed = covering(removed.pos, removed.end, pos)
+    pos, end = pos[in_existing], end[in_existing]
+    in_removed = in_removed[in_existing]
+    old = existing.take(existing_idx[in_existing])
+    blocks = removed.take(removed_idx[in_existing])
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        remaining = old.remove(
+            blocks.non_ref_af.astype(np.float64),
+            np.where(in_removed, blocks.dp.astype(np.float64), 0.0),
+            removed.sample_name,
+        )
+    remaining = _select(in_removed, remaining, old, pos, end)
+    return _coalesce(remaining.take(remaining.number_of_samples > 0))
+
+def _overlapping(batch, intervals):
+    """Return a mask of the records of a batch overlapping any of the sorted, non-overlapping intervals."""
+    first = np.searchsorted(intervals.end, batch.pos, side='left')
+    last = np.searchsorted(intervals.pos, batch.end, side='right')
+    return first < last
+
+def _concatenate(a, b):
+    """Join two batches of intervals that do not overlap into one sorted by position."""
+    order = np.argsort(np.concatenate((a.pos, b.pos)), kind='stable')
+    columns = [np.concatenate((getattr(a, column), getattr(b, column)))[order] for column in ('pos',) + _COLUMNS]
+    return StatsBatch(a.chr, *columns, end=np.concatenate((a.end, b.end))[order])
+
+def recompute_extremes(existing, batches):
+    """Recompute the min/max values of intervals that lost them from the reference blocks of all samples.
+
+    existing is a StatsBatch with end set, sorted and without overlaps, whose
+    intervals with a missing min or max value are recomputed. batches yields
+    VariantBatch objects with the reference blocks of every remaining sample,
+    labeled like the min/max sample columns. Returns all intervals, split
+    where the sample holding the min or max value changes.
+    """
+    lost = np.isnan(existing.max_non_ref_af) | np.isnan(existing.min_non_ref_af)
+    if not lost.any():
+        return existing
+    targets = existing.take(lost)
+    blocks = [batch.take(_overlapping(batch, targets)) for batch in batches]
+    blocks = [batch for batch in blocks if len(batch)]
+
+    pos, end = _pieces(targets, *blocks)
+    idx, inside = covering(targets.pos, targets.end, pos)
+    pieces = targets.take(idx[inside])
+    pieces.pos, pieces.end = pos[inside], end[inside]
+
+    n = len(pieces)
+    max_af = np.full(n, -np.inf)
+    min_af = np.full(n, np.inf)
+    max_sample = np.full(n, None, dtype=object)
+    min_sample = np.full(n, None, dtype=object)
+    for batch in blocks:
+        block_idx, covered = covering(batch.pos, batch.end, pieces.pos)
+        af = batch.non_ref_af[block_idx].astype(np.float64)
+        is_max = covered & (af > max_af)
+        max_af[is_max] = af[is_max]
+        max_sample[is_max] = batch.sample_name
+        is_min = covered & (af < min_af)
+        min_af[is_min] = af[is_min]
+        min_sample[is_min] = batch.sample_name
+
+    # Pieces no remaining sample covers keep their missing values
+    pieces.max_non_ref_af = np.where(np.isfinite(max_af), max_af, np.nan)
+    pieces.min_non_ref_af = np.where(np.isfinite(min_af), min_af, np.nan)
+    pieces.max_non_ref_af_sample = max_sample
+    pieces.min_non_ref_af_sample = min_sample
+    return _coalesce(_concatenate(existing.take(~lost), pieces))
@@ -0,0 +1,201 @@
+"""
+This module keeps a queue of GVCF files to load in the load_jobs table, so that
+loads can be submitted from any machine at any time and are taken up by worker
+processes, which may run on several machines against the same database.
+
+A worker claims the oldest pending job with a conditional update that only one
+worker can win. On PostgreSQL and MySQL the candidate is selected with FOR
+UPDATE SKIP LOCKED, so claiming workers do not wait for each other. The loads
+of several workers are merged safely by the Updater, see its documentation.
+
+Jobs load with checkpoints. A job that fails with a database error, for
+example a deadlock detected between two workers, is returned to the queue up
+to max_attempts times and continues from the checkpoint of the failed attempt.
+"""
+
+import logging
+import os
+import socket
+import time
+from datetime import datetime, timezone
+from sqlalchemy import exc, func, select, update
+
+from varnoisedb.gvcf_parser import GVCFParser
+from varnoisedb.models import LoadJob, Sample
+from varnoisedb.progress import read_progress
+from varnoisedb.updater import Updater
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+STATUSES = (PENDING, RUNNING, DONE, FAILED)
+
+def default_worker_name():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+def submit_jobs(session, gvcf_paths):
+    """Queue GVCF files for loading and return the ids of the new jobs.
+
+    Raises ValueError for files whose sample is already in the database or
+    queued by a pending or running job.
+    """
+    sample_names = [GVCFParser(path).get_sample_name() for path in gvcf_paths]
+    duplicates = sorted({name for name in sample_names if sample_names.count(name) > 1})
+    if duplicates:
+        raise ValueError(f"Samples {', '.join(duplicates)} occur in more than one GVCF file")
+    loaded = session.scalars(select(Sample.name).where(Sample.name.in_(sample_names))).all()
+    if loaded:
+        raise ValueError(f"Samples {', '.join(sorted(loaded))} are already in the database")
+    queued = session.scalars(select(LoadJob.sample_name).where(
+        LoadJob.sample_name.in_(sample_names),
+        LoadJob.status.in_([PENDING, RUNNING])
+    )).all()
+    if queued:
+        raise ValueError(f"Samples {', '.join(sorted(queued))} are already queued")
+
+    jobs = [LoadJob(gvcf_path=path, sample_name=name, status=PENDING) for path, name in zip(gvcf_paths, sample_names)]
+    session.add_all(jobs)
+    session.commit()
+    return [job.id for job in jobs]
+
+def claim_job(session, worker):
+    """Claim the oldest pending job for worker and return it, or None if no job is pending.
+
+    The claim is committed before the job is returned.
+    """
+    while True:
+        job_id = session.execute(
+            select(LoadJob.id).where(LoadJob.status == PENDING).order_by(LoadJob.id).limit(1).with_for_update(skip_locked=True)
+        ).scalar()
+        if job_id is None:
+            session.commit()
+            return None
+        # Only one worker can change the status from pending, on SQLite the select does not lock
+        claimed = session.execute(update(LoadJob).where(LoadJob.id == job_id, LoadJob.status == PENDING).values(
+            status=RUNNING, worker=worker, attempts=LoadJob.attempts + 1, error=None,
+            started=datetime.now(timezone.utc), finished=None
+        )).rowcount
+        session.commit()
+        if claimed:
+            return session.get(LoadJob, job_id)
+
+def finish_job(session, job_id, error=None, retry=False):
+    """Mark a job as done, or as failed with an error message.
+
+    With retry set, a failed job is returned to the queue instead.
+    """
+    if error is None:
+        status = DONE
+    else:
+        status = PENDING if retry else FAILED
+    session.execute(update(LoadJob).where(LoadJob.id == job_id).values(
+        status=status, error=error, finished=datetime.now(timezone.utc)
+    ))
+    session.commit()
+
+def requeue_jobs(session, job_ids=None, statuses=(FAILED,)):
+    """Return the jobs with one of the statuses, only those in job_ids if given, to the queue and return their number.
+
+    The attempts of the jobs are reset. Running jobs should only be requeued
+    when their worker is known to have stopped.
+    """
+    stmt = update(LoadJob).where(LoadJob.status.in_(statuses))
+    if job_ids:
+        stmt = stmt.where(LoadJob.id.in_(job_ids))
+    n_jobs = session.execute(stmt.values(status=PENDING, attempts=0, worker=None)).rowcount
+    session.commit()
+    return n_jobs
+
+def list_jobs(session, statuses=None):
+    """Return the jobs, optionally only those with one of the statuses, ordered by id."""
+    stmt = select(LoadJob).order_by(LoadJob.id)
+    if statuses:
+        stmt = stmt.where(LoadJob.status.in_(statuses))
+    return session.scalars(stmt).all()
+
+def count_jobs(session):
+    """Return the number of jobs by status."""
+    return dict(session.execute(select(LoadJob.status, func.count()).group_by(LoadJob.status)).all())
+
+def run_job(db_adapter, gvcf_path, batch_size=1000, write_mode='upsert', reference_blocks=False, contributions=False,
+            checkpoint_interval=100, prefetch=0):
+    """Load the GVCF file of a job and return the number of written variants.
+
+    A job whose sample was left unfinished by an earlier attempt is resumed
+    from its checkpoint.
+    """
+    gvcf_parser = GVCFParser(gvcf_path)
+    sample_name = gvcf_parser.get_sample_name()
+    session = db_adapter.get_session()
+    try:
+        loaded = session.scalars(select(Sample.name).where(Sample.name == sample_name)).first() is not None
+        resume = sample_name in read_progress(session, [sample_name])
+    finally:
+        session.close()
+    if loaded and not resume:
+        raise ValueError(f"Sample '{sample_name}' is already in the database")
+
+    db_adapter.ensure_partitions(gvcf_parser.contigs())
+    updater = Updater(
+        db_adapter, gvcf_parser, batch_size, write_mode=write_mode,
+        reference_blocks=reference_blocks, contributions=contributions,
+        checkpoint_interval=checkpoint_interval, prefetch=prefetch
+    )
+    (tot_inserted, tot_updated) = updater.insert_sample(resume=resume)
+    if updater.sizer is not None:
+        logging.info(f"Settled on a batch size of {updater.sizer.size} records")
+    return tot_inserted + (tot_updated or 0)
+
+def run_worker(db_adapter, worker=None, max_jobs=None, poll_interval=10, exit_when_empty=False, max_attempts=3, **load_options):
+    """Claim and run jobs until max_jobs jobs are run, or the queue is empty with exit_when_empty set.
+
+    Otherwise the queue is polled every poll_interval seconds. load_options
+    are passed to run_job. Returns the number of jobs run and the number of
+    those that failed.
+    """
+    worker = worker or default_worker_name()
+    n_jobs = 0
+    n_failed = 0
+    while max_jobs is None or n_jobs < max_jobs:
+        session = db_adapter.get_session()
+        try:
+            job = claim_job(session, worker)
+            if job is None:
+                if exit_when_empty:
+                    break
+                time.sleep(poll_interval)
+                continue
+            (job_id, gvcf_path, attempts) = (job.id, job.gvcf_path, job.attempts)
+        finally:
+            session.close()
+
+        logging.info(f"Worker {worker} loading job {job_id}: {gvcf_path} (attempt {attempts})...")
+        error = None
+        retry = False
+        try:
+            n_variants = run_job(db_adapter, gvcf_path, **load_options)
+        except exc.DBAPIError as e:
+            # Deadlocks and lost connections are worth another attempt
+            error = str(e.orig)
+            retry = attempts < max_attempts
+        except (ValueError, OSError) as e:
+            error = str(e)
+        except Exception as e:
+            # Any other error, like a malformed GVCF file, fails the job too, instead
+            # of stopping the worker and leaving the job running
+            logging.exception(f"Job {job_id} failed with an unexpected error")
+            error = f"{type(e).__name__}: {e}"
+        n_jobs += 1
+
+        session = db_adapter.get_session()
+        try:
+            finish_job(session, job_id, error, retry)
+        finally:
+            session.close()
+        if error is None:
+            logging.info(f"Job {job_id} complete, wrote {n_variants} variants.")
+        else:
+            n_failed += 1
+            logging.error(f"Job {job_id} failed{', returned to the queue' if retry else ''}: {error}")
+    return (n_jobs, n_failed)
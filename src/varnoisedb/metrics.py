@@ -0,0 +1,96 @@
+"""
+This module collects the metrics of a load, removal or export: the seconds
+spent per stage, counts such as the number of parsed and written rows, and
+optionally the number of executions and seconds per kind of SQL statement.
+The metrics are reported as a dict that is written as JSON, together with
+the throughput of every count over the wall time of the command.
+"""
+
+import collections
+import contextlib
+import re
+import time
+from sqlalchemy import event
+
+from varnoisedb.pipeline import StageTimings
+
+_STATEMENT_VERB = re.compile(r'\s*(\w+)')
+_STATEMENT_TABLE = re.compile(r'\b(?:FROM|INTO|UPDATE|TABLE)\s+[`"]?(\w+)', re.IGNORECASE)
+
+def statement_kind(statement):
+    """Return the verb and the first table of an SQL statement, like 'INSERT variants'."""
+    verb = _STATEMENT_VERB.match(statement)
+    table = _STATEMENT_TABLE.search(statement)
+    kind = verb.group(1).upper() if verb else '?'
+    return f"{kind} {table.group(1)}" if table else kind
+
+class Metrics(StageTimings):
+    """Stage timings with counts and SQL statement timings.
+
+    Stages are timed with add() or the timer() context manager, counts
+    added with count() and other values, such as the batch size a load
+    settled on, recorded with set(). After time_statements(engine), every statement
+    executed on the engine is timed by kind, an executemany counting as one
+    execution.
+    """
+    def __init__(self):
+        super().__init__()
+        self.counts = collections.defaultdict(int)
+        self.values = {}
+        self.statements = collections.defaultdict(lambda: [0, 0.0])
+
+    def count(self, name, n=1):
+        self.counts[name] += int(n)
+
+    def set(self, name, value):
+        self.values[name] = value
+
+    @contextlib.contextmanager
+    def timer(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - start)
+
+    def time_statements(self, engine):
+        """Time the SQL statements executed on engine from now on."""
+        def before(connection, cursor, statement, parameters, context, executemany):
+            connection.info.setdefault('metrics_start', []).append(time.perf_counter())
+
+        def after(connection, cursor, statement, parameters, context, executemany):
+            seconds = time.perf_counter() - connection.info['metrics_start'].pop()
+            entry = self.statements[statement_kind(statement)]
+            entry[0] += 1
+            entry[1] += seconds
+
+        def failed(context):
+            starts = context.connection.info.get('metrics_start') if context.connection is not None else None
+            if starts:
+                starts.pop()
+
+        event.listen(engine, 'before_cursor_execute', before)
+        event.listen(engine, 'after_cursor_execute', after)
+        event.listen(engine, 'handle_error', failed)
+
+    def to_dict(self, wall_seconds=None):
+        """Return the metrics as a dict of plain values, with the throughput of the counts if wall_seconds is given."""
+        metrics = {
+            'wall_seconds': wall_seconds,
+            'stages': dict(self.seconds),
+            'counts': dict(self.counts),
+        }
+        if self.values:
+            metrics['values'] = dict(self.values)
+        if wall_seconds:
+            metrics['throughput'] = {f"{name}_per_second": n / wall_seconds for name, n in self.counts.items()}
+        if self.statements:
+            metrics['statements'] = {
+                kind: {'executions': executions, 'seconds': seconds}
+                for kind, (executions, seconds) in sorted(self.statements.items(), key=lambda item: -item[1][1])
+            }
+        return metrics
+
+    def __str__(self):
+        counts = ', '.join(f"{name} {n}" for name, n in self.counts.items())
+        return f"{super().__str__()}; {counts}" if counts else super().__str__()
@@ -0,0 +1,101 @@
+"""
+This module migrates the schema of existing databases to the one of this
+version of VarNoiseDB with the Alembic migrations in varnoisedb/migrations.
+The revision of a database is recorded in its alembic_version table. init
+records the latest revision, databases created before migrations were
+introduced have no revision recorded and are detected from their schema.
+"""
+
+import contextlib
+import logging
+from sqlalchemy import inspect
+
+# Alembic logs every step of its setup at the INFO level, starting on import
+logging.getLogger('alembic').setLevel(logging.WARNING)
+
+from alembic import command
+from alembic.config import Config
+from alembic.runtime.migration import MigrationContext
+from alembic.script import ScriptDirectory
+
+# The revision of the schema before migrations were introduced
+BASELINE = '0001'
+
+def _config(connection):
+    config = Config()
+    config.set_main_option('script_location', 'varnoisedb:migrations')
+    config.attributes['connection'] = connection
+    return config
+
+def _current_revision(connection):
+    return MigrationContext.configure(connection).get_current_revision()
+
+def _detect_revision(connection, config):
+    """Return the revision of a database without a recorded one, from its schema."""
+    inspector = inspect(connection)
+    if not inspector.has_table('variants'):
+        raise ValueError("The database has no variants table, initialize it with init")
+    if inspector.has_table('generations'):
+        if any(index['name'] == 'idx_variants_chr_pos' for index in inspector.get_indexes('variants')):
+            return '0004'
+        return ScriptDirectory.from_config(config).get_current_head()
+    if 'targets_path' in {column['name'] for column in inspector.get_columns('samples')}:
+        return '0003'
+    if 'contig_id' in {column['name'] for column in inspector.get_columns('variants')}:
+        return '0002'
+    return BASELINE
+
+@contextlib.contextmanager
+def _transaction(db_adapter):
+    """Connect in a transaction that a migration runs in, rolled back if it fails.
+
+    The sqlite3 module commits before every DDL statement in its default
+    mode, so on SQLite the transaction is begun and ended explicitly, with
+    the DDL statements inside it. MySQL commits every DDL statement anyway.
+    """
+    if db_adapter.db_type != 'sqlite':
+        with db_adapter.engine.begin() as connection:
+            yield connection
+        return
+    with db_adapter.engine.connect() as connection:
+        connection = connection.execution_options(isolation_level='AUTOCOMMIT')
+        connection.exec_driver_sql('BEGIN')
+        try:
+            yield connection
+        except BaseException:
+            connection.exec_driver_sql('ROLLBACK')
+            raise
+        connection.exec_driver_sql('COMMIT')
+
+def current_revision(db_adapter):
+    """Return the recorded revision of the database, None if it has none."""
+    with db_adapter.engine.connect() as connection:
+        return _current_revision(connection)
+
+def stamp(db_adapter):
+    """Record the revision of a database that has none, detected from its schema, and return it."""
+    with db_adapter.engine.begin() as connection:
+        revision = _current_revision(connection)
+        if revision is None:
+            config = _config(connection)
+            revision = _detect_revision(connection, config)
+            command.stamp(config, revision)
+    return revision
+
+def upgrade(db_adapter, revision='head'):
+    """Migrate the database up to revision, the latest by default.
+
+    The revision of a database without a recorded one is detected first.
+    Returns the revisions before and after the migration.
+    """
+    before = stamp(db_adapter)
+    with _transaction(db_adapter) as connection:
+        command.upgrade(_config(connection), revision)
+        return (before, _current_revision(connection))
+
+def downgrade(db_adapter, revision):
+    """Migrate the database down to revision and return the revisions before and after the migration."""
+    before = stamp(db_adapter)
+    with _transaction(db_adapter) as connection:
+        command.downgrade(_config(connection), revision)
+        return (before, _current_revision(connection))
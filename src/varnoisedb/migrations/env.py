@@ -0,0 +1,16 @@
+"""
+Alembic environment of the VarNoiseDB migrations, run by varnoisedb.migrate
+on the connection passed in the 'connection' attribute of the config.
+"""
+
+from alembic import context
+
+from varnoisedb.models import Base
+
+if context.is_offline_mode():
+    raise RuntimeError("The VarNoiseDB migrations run on a database connection, not in offline mode")
+
+connection = context.config.attributes['connection']
+context.configure(connection=connection, target_metadata=Base.metadata)
+with context.begin_transaction():
+    context.run_migrations()
@@ -0,0 +1,20 @@
+"""The schema before migrations, with contigs and samples stored by name in the variants tables
+
+Databases created before migrations were introduced are stamped with this
+revision, see varnoisedb.migrate.
+
+Revision ID: 0001
+Revises:
+Create Date: 2026-10-18
+"""
+
+revision = '0001'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+def upgrade():
+    pass
+
+def downgrade():
+    pass
@@ -0,0 +1,136 @@
+"""Store contigs and samples by integer id in the variants and reference_blocks tables
+
+Adds the contigs table and rewrites the variants and reference_blocks tables
+with the id of the contig instead of its name, the ids of the samples with
+the highest and lowest allele frequency instead of their names, and the
+allele frequencies in single precision. Each table is copied to a new table
+in one statement, so the migration needs the disk space of a second copy of
+the largest table. The contig_locks table is dropped, loads lock the rows of
+the contigs table instead.
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-18
+"""
+
+import hashlib
+import re
+from alembic import op
+import sqlalchemy as sa
+
+revision = '0002'
+down_revision = '0001'
+branch_labels = None
+depends_on = None
+
+_AF_COLUMNS = ('mean_non_ref_af', 'sd_non_ref_af', 'max_non_ref_af', 'min_non_ref_af')
+
+_contigs = sa.table('contigs', sa.column('id'), sa.column('name'))
+_samples = sa.table('samples', sa.column('id'), sa.column('name'))
+
+def _partition_name(chr):
+    # As varnoisedb.database.partition_name, copied so that the migration does not change with it
+    readable = re.sub(r'[^a-z0-9_]', '_', chr.lower())[:32]
+    return f"variants_{readable}_{hashlib.sha1(chr.encode()).hexdigest()[:8]}"
+
+def _stats_table(name, kind, by_id, metadata, **kwargs):
+    """Return a variants or reference_blocks table, with the contigs and samples by id or by name."""
+    if by_id:
+        columns = [sa.Column('contig_id', sa.SmallInteger, primary_key=True)]
+        (af_type, sample_type) = (sa.Float(precision=24), sa.Integer)
+    else:
+        columns = [sa.Column('chr', sa.String(50), primary_key=True)]
+        (af_type, sample_type) = (sa.Float, sa.String(255))
+    if kind == 'variants':
+        columns.append(sa.Column('pos', sa.Integer, primary_key=True))
+    else:
+        columns += [sa.Column('start', sa.Integer, primary_key=True), sa.Column('end', sa.Integer, nullable=False)]
+    columns += [sa.Column(column, af_type) for column in _AF_COLUMNS]
+    columns += [
+        sa.Column('total_depth', sa.Float),
+        sa.Column('number_of_samples', sa.Integer),
+        sa.Column('max_non_ref_af_sample', sample_type),
+        sa.Column('min_non_ref_af_sample', sample_type),
+    ]
+    return sa.Table(name, metadata, *columns, **kwargs)
+
+def _is_partitioned(bind, table):
+    if bind.dialect.name != 'postgresql':
+        return False
+    return bind.execute(sa.text(
+        "SELECT count(*) FROM pg_partitioned_table p JOIN pg_class c ON c.oid = p.partrelid WHERE c.relname = :name"
+    ), {'name': table}).scalar() > 0
+
+def _rename_table(bind, old, new):
+    op.rename_table(old, new)
+    if bind.dialect.name == 'postgresql':
+        # Index names are unique per schema on PostgreSQL, the primary key keeps the name of the old table
+        op.execute(f'ALTER INDEX "{old}_pkey" RENAME TO "{new}_pkey"')
+
+def _rewrite(bind, table, by_id):
+    """Rewrite the variants or reference_blocks table with the contigs and samples by id, or by name if by_id is False."""
+    metadata = sa.MetaData()
+    source = _stats_table(table, table, not by_id, metadata)
+    partitioned = _is_partitioned(bind, table)
+    kwargs = {'postgresql_partition_by': f"LIST ({'contig_id' if by_id else 'chr'})"} if partitioned else {}
+    target = _stats_table(f"{table}_new", table, by_id, metadata, **kwargs)
+    indexes = [index for index in sa.inspect(bind).get_indexes(table) if index['name'] == 'idx_variants_chr_pos']
+    target.create(bind)
+
+    contigs = bind.execute(sa.select(_contigs.c.id, _contigs.c.name)).all()
+    if partitioned:
+        for (contig_id, name) in contigs:
+            value = contig_id if by_id else "'" + name.replace("'", "''") + "'"
+            op.execute(f'CREATE TABLE "{_partition_name(name)}_new" PARTITION OF "{table}_new" FOR VALUES IN ({value})')
+
+    (key, value) = ('name', 'id') if by_id else ('id', 'name')
+    max_sample = _samples.alias('max_sample')
+    min_sample = _samples.alias('min_sample')
+    source_contig = source.c.chr if by_id else source.c.contig_id
+    rows = sa.select(
+        _contigs.c[value],
+        *[source.c[column.name] for column in list(target.c)[1:-2]],
+        max_sample.c[value],
+        min_sample.c[value],
+    ).select_from(
+        source.join(_contigs, _contigs.c[key] == source_contig)
+        .outerjoin(max_sample, max_sample.c[key] == source.c.max_non_ref_af_sample)
+        .outerjoin(min_sample, min_sample.c[key] == source.c.min_non_ref_af_sample)
+    )
+    op.execute(target.insert().from_select([column.name for column in target.c], rows))
+
+    op.drop_table(table)
+    _rename_table(bind, f"{table}_new", table)
+    if partitioned:
+        for (_, name) in contigs:
+            _rename_table(bind, f"{_partition_name(name)}_new", _partition_name(name))
+    for index in indexes:
+        op.create_index(index['name'], table, ['contig_id' if by_id else 'chr', 'pos'])
+
+def upgrade():
+    bind = op.get_bind()
+    tables = [table for table in ('variants', 'reference_blocks') if sa.inspect(bind).has_table(table)]
+    op.create_table(
+        'contigs',
+        sa.Column('id', sa.SmallInteger().with_variant(sa.Integer, 'sqlite'), primary_key=True, autoincrement=True),
+        sa.Column('name', sa.String(50), nullable=False, unique=True),
+    )
+    names = set()
+    for table in tables:
+        names.update(bind.execute(sa.text(f"SELECT DISTINCT chr FROM {table}")).scalars())
+    # Ids in name order, which keeps the order of exports, sorted by contig name before this revision
+    if names:
+        op.bulk_insert(_contigs, [{'name': name} for name in sorted(names)])
+
+    for table in tables:
+        _rewrite(bind, table, by_id=True)
+    if sa.inspect(bind).has_table('contig_locks'):
+        op.drop_table('contig_locks')
+
+def downgrade():
+    bind = op.get_bind()
+    for table in ('variants', 'reference_blocks'):
+        if sa.inspect(bind).has_table(table):
+            _rewrite(bind, table, by_id=False)
+    op.create_table('contig_locks', sa.Column('chr', sa.String(50), primary_key=True))
+    op.drop_table('contigs')
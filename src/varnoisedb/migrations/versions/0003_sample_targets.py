@@ -0,0 +1,25 @@
+"""Record the BED file of targets that samples were loaded with
+
+Adds the nullable targets_path column to the samples table, see
+varnoisedb.targets. Samples loaded before have no targets.
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-18
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+revision = '0003'
+down_revision = '0002'
+branch_labels = None
+depends_on = None
+
+def upgrade():
+    op.add_column('samples', sa.Column('targets_path', sa.String(1024), nullable=True))
+
+def downgrade():
+    # SQLite drops columns by copying the table
+    with op.batch_alter_table('samples') as batch_op:
+        batch_op.drop_column('targets_path')
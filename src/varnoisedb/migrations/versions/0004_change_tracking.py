@@ -0,0 +1,52 @@
+"""Track the changes to the variants table by generation
+
+Adds the generations and variant_tombstones tables, the generation column of
+the variants table with an index, and the generation column of the
+load_progress table, see varnoisedb.generations. The existing variants have
+no generation, they are older than any change tracked from now on. Databases
+created before loads had checkpoints have no load_progress table, which is
+created with the generation column by migrate after the migrations.
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2026-10-18
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+revision = '0004'
+down_revision = '0003'
+branch_labels = None
+depends_on = None
+
+def upgrade():
+    op.create_table(
+        'generations',
+        sa.Column('id', sa.Integer, primary_key=True, autoincrement=True),
+        sa.Column('operation', sa.String(20), nullable=False),
+        sa.Column('started', sa.DateTime),
+        sa.Column('finished', sa.DateTime),
+    )
+    op.create_table(
+        'variant_tombstones',
+        sa.Column('contig_id', sa.SmallInteger, primary_key=True),
+        sa.Column('pos', sa.Integer, primary_key=True),
+        sa.Column('generation', sa.Integer, nullable=False),
+    )
+    op.create_index('idx_variant_tombstones_generation', 'variant_tombstones', ['generation'])
+    op.add_column('variants', sa.Column('generation', sa.Integer, nullable=True))
+    op.create_index('idx_variants_generation', 'variants', ['generation'])
+    if sa.inspect(op.get_bind()).has_table('load_progress'):
+        op.add_column('load_progress', sa.Column('generation', sa.Integer, nullable=True))
+
+def downgrade():
+    # SQLite drops columns by copying the table
+    if sa.inspect(op.get_bind()).has_table('load_progress'):
+        with op.batch_alter_table('load_progress') as batch_op:
+            batch_op.drop_column('generation')
+    op.drop_index('idx_variants_generation', table_name='variants')
+    with op.batch_alter_table('variants') as batch_op:
+        batch_op.drop_column('generation')
+    op.drop_table('variant_tombstones')
+    op.drop_table('generations')
@@ -0,0 +1,29 @@
+"""Drop the idx_variants_chr_pos index of the variants table
+
+The index covers the columns of the primary key of the variants table in the
+same order, so it only slowed down writes. Databases created without it are
+left unchanged.
+
+Revision ID: 0005
+Revises: 0004
+Create Date: 2026-10-18
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+revision = '0005'
+down_revision = '0004'
+branch_labels = None
+depends_on = None
+
+def _has_index(name):
+    return any(index['name'] == name for index in sa.inspect(op.get_bind()).get_indexes('variants'))
+
+def upgrade():
+    if _has_index('idx_variants_chr_pos'):
+        op.drop_index('idx_variants_chr_pos', table_name='variants')
+
+def downgrade():
+    if not _has_index('idx_variants_chr_pos'):
+        op.create_index('idx_variants_chr_pos', 'variants', ['contig_id', 'pos'])
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Float, Text, MetaData, DateTime
+from sqlalchemy import Column, Integer, SmallInteger, String, Float, Text, MetaData, DateTime, ForeignKey, Index, LargeBinary
 from sqlalchemy.ext.declarative import declarative_base
 from datetime import datetime, timezone
 
@@ -6,19 +6,57 @@ from datetime import datetime, timezone
 metadata = MetaData()
 Base = declarative_base(metadata=metadata)
 
+# Allele frequencies are stored in single precision where the backend has it (4 bytes on
+# PostgreSQL and MySQL), SQLite always stores 8 byte floats
+AlleleFrequency = Float(precision=24)
+
+class Contig(Base):
+    __tablename__ = 'contigs'
+    
+    # The variants tables refer to contigs by this small id instead of by name. SQLite only
+    # assigns ids to INTEGER primary keys
+    id = Column(SmallInteger().with_variant(Integer, 'sqlite'), primary_key=True, autoincrement=True)
+    name = Column(String(50), unique=True, nullable=False)
+
 class Variant(Base):
     __tablename__ = 'variants'
     
-    chr = Column(String(50), primary_key=True)
+    # The min/max sample columns hold ids of the samples table. They are not declared as
+    # foreign keys, which would need an index on each of them or a scan of the table for
+    # every removed sample
+    contig_id = Column(SmallInteger, primary_key=True)
     pos = Column(Integer, primary_key=True)
-    mean_non_ref_af = Column(Float)
-    sd_non_ref_af = Column(Float)
-    max_non_ref_af = Column(Float)
-    min_non_ref_af = Column(Float)
+    mean_non_ref_af = Column(AlleleFrequency)
+    sd_non_ref_af = Column(AlleleFrequency)
+    max_non_ref_af = Column(AlleleFrequency)
+    min_non_ref_af = Column(AlleleFrequency)
     total_depth = Column(Float)
     number_of_samples = Column(Integer)
-    max_non_ref_af_sample = Column(String(255))
-    min_non_ref_af_sample = Column(String(255))
+    max_non_ref_af_sample = Column(Integer)
+    min_non_ref_af_sample = Column(Integer)
+    # The generation that last changed the row, see varnoisedb.generations. Rows written
+    # before changes were tracked have none
+    generation = Column(Integer)
+    
+    # The primary key serves the lookups by contig and position, the only secondary index
+    # finds the rows changed since a generation
+    __table_args__ = (Index('idx_variants_generation', 'generation'),)
+
+class ReferenceBlock(Base):
+    __tablename__ = 'reference_blocks'
+    
+    # Statistics of the reference block records covering start to end, both inclusive
+    contig_id = Column(SmallInteger, primary_key=True)
+    start = Column(Integer, primary_key=True)
+    end = Column(Integer, nullable=False)
+    mean_non_ref_af = Column(AlleleFrequency)
+    sd_non_ref_af = Column(AlleleFrequency)
+    max_non_ref_af = Column(AlleleFrequency)
+    min_non_ref_af = Column(AlleleFrequency)
+    total_depth = Column(Float)
+    number_of_samples = Column(Integer)
+    max_non_ref_af_sample = Column(Integer)
+    min_non_ref_af_sample = Column(Integer)
 
 class Sample(Base):
     __tablename__ = 'samples'
@@ -26,7 +64,69 @@ class Sample(Base):
     id = Column(Integer, primary_key=True, autoincrement=True)
     name = Column(String(255), unique=True, nullable=False)
     gvcf_path = Column(String(1024), nullable=False)
+    # The BED file of the targets the sample was loaded with, see varnoisedb.targets
+    targets_path = Column(String(1024))
     date_added = Column(DateTime, default=lambda: datetime.now(timezone.utc))
     
     def __repr__(self):
         return f"<Sample(name='{self.name}', gvcf_path='{self.gvcf_path}')>"
+
+class SampleContribution(Base):
+    __tablename__ = 'sample_contributions'
+    
+    # One chunk of the records of a sample on one chromosome, packed by varnoisedb.contributions
+    sample_id = Column(Integer, ForeignKey('samples.id', ondelete='CASCADE'), primary_key=True)
+    chr = Column(String(50), primary_key=True)
+    first_pos = Column(Integer, primary_key=True)
+    last_pos = Column(Integer, nullable=False)
+    n_records = Column(Integer, nullable=False)
+    data = Column(LargeBinary(2 ** 32 - 1), nullable=False)
+    
+    __table_args__ = (Index('idx_sample_contributions_chr_pos', 'chr', 'first_pos'),)
+
+class Generation(Base):
+    __tablename__ = 'generations'
+    
+    # One load, removal or rebuild, whose id is stamped on the variants it changes. finished is
+    # empty while it can still write, see varnoisedb.generations
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    operation = Column(String(20), nullable=False)
+    started = Column(DateTime, default=lambda: datetime.now(timezone.utc))
+    finished = Column(DateTime)
+
+class VariantTombstone(Base):
+    __tablename__ = 'variant_tombstones'
+    
+    # A position deleted from the variants table, by the generation that deleted it last
+    contig_id = Column(SmallInteger, primary_key=True)
+    pos = Column(Integer, primary_key=True)
+    generation = Column(Integer, nullable=False)
+    
+    __table_args__ = (Index('idx_variant_tombstones_generation', 'generation'),)
+
+class LoadProgress(Base):
+    __tablename__ = 'load_progress'
+    
+    # Checkpoint of an unfinished load: the records up to chr:pos in file order are written,
+    # chr and pos are empty until the first checkpoint
+    sample_id = Column(Integer, ForeignKey('samples.id', ondelete='CASCADE'), primary_key=True)
+    chr = Column(String(50))
+    pos = Column(Integer)
+    # The generation of the load, closed when it is resumed or the sample removed
+    generation = Column(Integer)
+    updated = Column(DateTime, default=lambda: datetime.now(timezone.utc))
+
+class LoadJob(Base):
+    __tablename__ = 'load_jobs'
+    
+    # A GVCF file queued for loading by the workers of the jobs command, see varnoisedb.jobs
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    gvcf_path = Column(String(1024), nullable=False)
+    sample_name = Column(String(255), nullable=False)
+    status = Column(String(20), nullable=False, default='pending', index=True)
+    attempts = Column(Integer, nullable=False, default=0)
+    worker = Column(String(255))
+    error = Column(Text)
+    submitted = Column(DateTime, default=lambda: datetime.now(timezone.utc))
+    started = Column(DateTime)
+    finished = Column(DateTime)
@@ -0,0 +1,214 @@
+"""
+This module loads GVCF files in parallel. The files are split into genomic
+regions through their tabix or CSI index, and the regions are parsed by a pool
+of worker processes. On PostgreSQL and MySQL the workers also write their
+regions concurrently. SQLite allows only one writer, so there the workers only
+parse and the main process writes all regions in a single transaction.
+"""
+
+import collections
+import itertools
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from cyvcf2 import VCF
+
+from varnoisedb.batching import BatchSizer, max_batch_size
+from varnoisedb.database import DatabaseAdapter
+from varnoisedb.generations import finish_generation, start_generation
+from varnoisedb.gvcf_parser import MAX_TABIX_POSITION, CohortParser, GVCFParser
+from varnoisedb.updater import Updater
+
+# Contigs are split into regions of this many bp by default
+DEFAULT_SHARD_SIZE = 10_000_000
+
+def _contig_lengths(gvcf_file):
+    vcf = VCF(gvcf_file)
+    try:
+        lengths = vcf.seqlens
+    except AttributeError:
+        lengths = [None] * len(vcf.seqnames)
+    return zip(vcf.seqnames, lengths)
+
+def shard_regions(gvcf_files, shard_size=DEFAULT_SHARD_SIZE):
+    """Split the contigs of GVCF files into (chr, start, end) regions of at most shard_size bp.
+
+    The contigs are those in the header of any of the files, in the order of
+    CohortParser.contigs(), with the largest length given for them. Contigs
+    without a length in the headers, or all contigs if shard_size is None,
+    become a single region.
+    """
+    lengths = {}
+    for gvcf_file in gvcf_files:
+        for chr, length in _contig_lengths(gvcf_file):
+            lengths[chr] = max(lengths.get(chr) or 0, length or 0)
+
+    regions = []
+    for chr, length in lengths.items():
+        if not shard_size or not length:
+            regions.append((chr, 1, MAX_TABIX_POSITION))
+            continue
+        for start in range(1, length + 1, shard_size):
+            regions.append((chr, start, min(start + shard_size - 1, length)))
+    return regions
+
+def interleave_contigs(regions):
+    """Reorder regions so that consecutive regions are on different contigs where possible.
+
+    Regions taken up by concurrent workers then go to different partitions of
+    a variants table partitioned by contig. The regions of every contig stay
+    in order.
+    """
+    by_contig = collections.defaultdict(list)
+    for region in regions:
+        by_contig[region[0]].append(region)
+    return [region for regions in itertools.zip_longest(*by_contig.values()) for region in regions if region is not None]
+
+def make_parser(gvcf_files, regions=None):
+    if len(gvcf_files) == 1:
+        return GVCFParser(gvcf_files[0], regions)
+    return CohortParser(gvcf_files, regions)
+
+# The BatchSizer of a worker process with batch size 'auto', adapted across the regions it loads
+_worker_sizer = None
+
+def _worker_batch_size(db_adapter, batch_size, n_files):
+    global _worker_sizer
+    if batch_size != 'auto':
+        return batch_size
+    if _worker_sizer is None:
+        _worker_sizer = BatchSizer(max_batch_size(db_adapter), n_files)
+    return _worker_sizer
+
+def _load_shard(db_config, gvcf_files, region, batch_size, write_mode, generation):
+    """Parse one region and merge it into the database from a worker process as part of generation."""
+    db_adapter = DatabaseAdapter.from_config(db_config)
+    try:
+        updater = Updater(
+            db_adapter, make_parser(gvcf_files, [region]), _worker_batch_size(db_adapter, batch_size, len(gvcf_files)),
+            write_mode=write_mode,
+            reference_blocks=db_config.get('reference_blocks', False),
+            contributions=db_config.get('contributions', False), generation=generation
+        )
+        return updater.insert_sample(update_samples=False)
+    finally:
+        db_adapter.close()
+
+def _parse_shard(gvcf_files, region, batch_size, reference_blocks, keep_batches):
+    """Parse one region in a worker process.
+
+    Returns its statistics batches and, with keep_batches set, the parsed
+    batches of the single samples.
+    """
+    sample_batches = []
+    on_batch = sample_batches.append if keep_batches else None
+    parser = make_parser(gvcf_files, [region])
+    return (list(parser.parse_stats(batch_size, reference_blocks=reference_blocks, on_batch=on_batch)), sample_batches)
+
+class _ShardedParser:
+    """A parser for Updater that parses the regions of the GVCF files in a process pool."""
+    def __init__(self, gvcf_files, regions, pool, workers):
+        self.gvcf_files = gvcf_files
+        self.regions = regions
+        self.pool = pool
+        self.workers = workers
+        # Loads restricted to targets are not parallelized
+        self.targets = None
+        self._parser = make_parser(gvcf_files)
+
+    def samples(self):
+        return self._parser.samples()
+
+    def contigs(self):
+        return self._parser.contigs()
+
+    def parse_stats(self, batch_size, reference_blocks=False, on_batch=None, checkpoints=False):
+        if checkpoints:
+            raise ValueError("Parallel loads do not support checkpoints")
+        arguments = [(self.gvcf_files, region, batch_size, reference_blocks, on_batch is not None) for region in self.regions]
+        for stats, sample_batches in bounded_map(self.pool, _parse_shard, arguments, 2 * self.workers):
+            for batch in sample_batches:
+                on_batch(batch)
+            yield from stats
+
+def bounded_map(pool, fn, arguments, limit):
+    """Like pool.map, but with at most limit tasks in flight so that results do not pile up."""
+    arguments = iter(arguments)
+    pending = collections.deque(pool.submit(fn, *args) for args in itertools.islice(arguments, limit))
+    try:
+        while pending:
+            result = pending.popleft().result()
+            for args in itertools.islice(arguments, 1):
+                pending.append(pool.submit(fn, *args))
+            yield result
+    finally:
+        for future in pending:
+            future.cancel()
+
+def _sum_counts(counts):
+    tot_inserted = sum(inserted for inserted, _ in counts)
+    updated = [updated for _, updated in counts]
+    tot_updated = None if any(n is None for n in updated) else sum(updated)
+    return (tot_inserted, tot_updated)
+
+def load_parallel(db_config, gvcf_files, workers, batch_size=1000, write_mode='upsert', shard_size=DEFAULT_SHARD_SIZE):
+    """Load one GVCF file, or a cohort of them, with a pool of worker processes.
+
+    The files must be bgzipped and indexed. The regions cover the contigs in
+    the headers of all files. The workers refer to the samples by id, so on
+    PostgreSQL and MySQL the samples are registered before the regions are
+    written. Every region is committed by its worker, so a failed load can
+    leave the samples registered with only some of their regions written.
+    On SQLite the load is a single transaction. Reference blocks stored as
+    intervals can span several regions, so with reference_blocks enabled in
+    db_config only SQLite is supported. With a variants table partitioned by
+    contig, the workers take up regions of different contigs, and so of
+    different partitions, where possible.
+
+    Returns the number of inserted and updated variants like Updater.insert_sample.
+    """
+    reference_blocks = db_config.get('reference_blocks', False)
+    if reference_blocks and db_config['type'] != 'sqlite':
+        raise ValueError("Parallel loading of reference blocks is only supported for SQLite")
+    
+    regions = shard_regions(gvcf_files, shard_size)
+    logging.info(f"Loading {len(regions)} regions with {workers} worker processes...")
+
+    contributions = db_config.get('contributions', False)
+    db_adapter = DatabaseAdapter.from_config(db_config)
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            if db_adapter.db_type == 'sqlite':
+                updater = Updater(
+                    db_adapter, _ShardedParser(gvcf_files, regions, pool, workers), batch_size, write_mode=write_mode,
+                    reference_blocks=reference_blocks, contributions=contributions
+                )
+                return updater.insert_sample()
+            
+            parser = make_parser(gvcf_files)
+            updater = Updater(db_adapter, parser, batch_size, write_mode=write_mode)
+            # Added up front, so that the workers do not wait for each other adding them
+            db_adapter.contig_ids(parser.contigs())
+            if db_adapter.partition_by_contig:
+                db_adapter.ensure_partitions(parser.contigs())
+                regions = interleave_contigs(regions)
+            updater.register_samples()
+
+            # The workers write as one generation, finished when all of them have stopped
+            generation = start_generation(db_adapter, 'load')
+            try:
+                futures = [
+                    pool.submit(_load_shard, db_config, gvcf_files, region, batch_size, write_mode, generation)
+                    for region in regions
+                ]
+                try:
+                    counts = [future.result() for future in futures]
+                except Exception:
+                    for future in futures:
+                        future.cancel()
+                    pool.shutdown(wait=True)
+                    raise
+            finally:
+                finish_generation(db_adapter, generation)
+        return _sum_counts(counts)
+    finally:
+        db_adapter.close()
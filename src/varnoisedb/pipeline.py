@@ -0,0 +1,103 @@
+"""
+This module overlaps parsing with writing. prefetch() reads an iterable of
+parsed batches in a reader thread and hands them over through a bounded
+queue, so that the next batches are decoded while the database executes the
+previous ones, and the reader blocks when it is max_pending batches ahead.
+cyvcf2 and the database drivers release the GIL while they work, so a thread
+suffices for the overlap.
+
+The time spent in each stage is collected in StageTimings.
+"""
+
+import collections
+import queue
+import threading
+import time
+
+# How often a blocked reader checks whether the consumer has stopped, in seconds
+_POLL_INTERVAL = 0.1
+
+_ITEM, _DONE, _ERROR = range(3)
+
+class StageTimings:
+    """Seconds spent per stage of a load.
+
+    parse is the time spent reading and parsing batches, write the time spent
+    writing them. With a reader thread, wait is the time the writer waited
+    for parsed batches and blocked the time the reader waited for space in
+    the queue.
+    """
+    def __init__(self):
+        self.seconds = collections.defaultdict(float)
+
+    def add(self, stage, seconds):
+        self.seconds[stage] += seconds
+
+    def __str__(self):
+        return ', '.join(f"{stage} {seconds:.2f}s" for stage, seconds in self.seconds.items())
+
+def timed(items, timings, stage):
+    """Iterate over items, adding the time spent producing each of them to a stage."""
+    items = iter(items)
+    while True:
+        start = time.perf_counter()
+        try:
+            item = next(items)
+        except StopIteration:
+            return
+        finally:
+            timings.add(stage, time.perf_counter() - start)
+        yield item
+
+def _put(pending, entry, stop, timings):
+    """Put an entry into the queue unless the consumer stopped, return whether it was put."""
+    start = time.perf_counter()
+    try:
+        while not stop.is_set():
+            try:
+                pending.put(entry, timeout=_POLL_INTERVAL)
+                return True
+            except queue.Full:
+                continue
+        return False
+    finally:
+        timings.add('blocked', time.perf_counter() - start)
+
+def prefetch(items, max_pending, timings=None):
+    """Iterate over items read ahead by a reader thread, at most max_pending at a time.
+
+    Exceptions raised while reading are raised again from this generator.
+    When the generator is closed early, the reader stops at its next batch.
+    """
+    if timings is None:
+        timings = StageTimings()
+    pending = queue.Queue(maxsize=max_pending)
+    stop = threading.Event()
+
+    def read():
+        try:
+            for item in timed(items, timings, 'parse'):
+                if not _put(pending, (_ITEM, item), stop, timings):
+                    return
+            _put(pending, (_DONE, None), stop, timings)
+        except BaseException as e:
+            _put(pending, (_ERROR, e), stop, timings)
+        finally:
+            if hasattr(items, 'close'):
+                items.close()
+
+    reader = threading.Thread(target=read, name='varnoisedb-reader', daemon=True)
+    reader.start()
+    try:
+        while True:
+            start = time.perf_counter()
+            kind, value = pending.get()
+            timings.add('wait', time.perf_counter() - start)
+            if kind == _DONE:
+                return
+            if kind == _ERROR:
+                raise value
+            yield value
+    finally:
+        stop.set()
+        reader.join()
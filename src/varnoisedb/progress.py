@@ -0,0 +1,49 @@
+"""
+This module records the progress of loads in the load_progress table. A load
+with checkpoints registers its samples first and commits its writes in
+chunks. With every commit it stores the position in file order up to which all
+records are written, so that an interrupted load can be resumed from there
+without counting any position twice. The rows are deleted when the load
+completes, so samples with a row have not been loaded completely.
+"""
+
+from datetime import datetime, timezone
+from sqlalchemy import select
+
+from varnoisedb.models import LoadProgress, Sample
+
+def start_progress(session, sample_ids, generation=None):
+    """Mark the samples as being loaded by generation, without a checkpoint yet."""
+    session.execute(LoadProgress.__table__.insert(), [
+        {'sample_id': sample_id, 'generation': generation} for sample_id in sample_ids
+    ])
+
+def progress_generations(session, sample_ids):
+    """Return the generations of the unfinished loads of the samples."""
+    stmt = select(LoadProgress.generation).where(LoadProgress.sample_id.in_(sample_ids)).distinct()
+    return [generation for (generation,) in session.execute(stmt) if generation is not None]
+
+def resume_progress(session, sample_ids, generation):
+    """Continue the unfinished loads of the samples as generation and return the generations they were started by."""
+    previous = progress_generations(session, sample_ids)
+    session.query(LoadProgress).filter(LoadProgress.sample_id.in_(sample_ids)).update(
+        {'generation': generation}, synchronize_session=False
+    )
+    return previous
+
+def save_progress(session, sample_ids, chr, pos):
+    """Store chr:pos as the checkpoint of the samples."""
+    session.query(LoadProgress).filter(LoadProgress.sample_id.in_(sample_ids)).update(
+        {'chr': chr, 'pos': pos, 'updated': datetime.now(timezone.utc)}, synchronize_session=False
+    )
+
+def clear_progress(session, sample_ids):
+    """Mark the samples as completely loaded."""
+    session.query(LoadProgress).filter(LoadProgress.sample_id.in_(sample_ids)).delete(synchronize_session=False)
+
+def read_progress(session, sample_names=None):
+    """Return the checkpoint (chr, pos) of every unfinished sample by name, (None, None) before the first checkpoint."""
+    stmt = select(Sample.name, LoadProgress.chr, LoadProgress.pos).join(Sample, Sample.id == LoadProgress.sample_id)
+    if sample_names is not None:
+        stmt = stmt.where(Sample.name.in_(sample_names))
+    return {name: (chr, pos) for name, chr, pos in session.execute(stmt)}
@@ -0,0 +1,206 @@
+"""
+This module reads variant statistics back from the database. Lookups are
+served from fixed size genomic windows that are fetched with a range scan on
+the (contig_id, pos) primary key and kept in a bounded LRU cache, so that many
+lookups close to each other, or repeated, need few queries.
+"""
+
+import collections
+import numpy as np
+
+from varnoisedb.utils import combine_stats
+
+# Windows of this many bp are fetched and cached as a unit by default
+DEFAULT_WINDOW_SIZE = 10_000
+DEFAULT_CACHE_WINDOWS = 1024
+
+# Used as the end of regions without one
+MAX_POSITION = 2 ** 31 - 1
+
+# A lookup result at a position covered by a reference block interval, with the columns of the variant rows
+QueryRow = collections.namedtuple('QueryRow', [
+    'chr', 'pos', 'mean_non_ref_af', 'sd_non_ref_af', 'max_non_ref_af', 'min_non_ref_af',
+    'total_depth', 'number_of_samples', 'max_non_ref_af_sample', 'min_non_ref_af_sample',
+])
+
+def _merge_block(chr, pos, row, block):
+    """Combine the statistics of a variant row, or None, with those of the interval covering its position.
+
+    The samples of a variant and of a reference block at one position are
+    distinct, as the records of a GVCF file do not overlap. Of equal values the
+    min/max stays with the variant row.
+    """
+    if row is None:
+        return QueryRow(chr, pos, *block[2:])
+    (mean, sd, number) = combine_stats(
+        [row.mean_non_ref_af], [row.sd_non_ref_af], [row.number_of_samples],
+        [block.mean_non_ref_af], [block.sd_non_ref_af], [block.number_of_samples],
+    )
+    # Missing min/max values are left behind by removals and are always replaced
+    is_new_max = block.max_non_ref_af is not None and (row.max_non_ref_af is None or block.max_non_ref_af > row.max_non_ref_af)
+    is_new_min = block.min_non_ref_af is not None and (row.min_non_ref_af is None or block.min_non_ref_af < row.min_non_ref_af)
+    return QueryRow(
+        chr, pos, float(mean[0]), float(sd[0]),
+        block.max_non_ref_af if is_new_max else row.max_non_ref_af,
+        block.min_non_ref_af if is_new_min else row.min_non_ref_af,
+        row.total_depth + block.total_depth,
+        int(number[0]),
+        block.max_non_ref_af_sample if is_new_max else row.max_non_ref_af_sample,
+        block.min_non_ref_af_sample if is_new_min else row.min_non_ref_af_sample,
+    )
+
+def merge_blocks(chr, start, end, rows, blocks):
+    """Merge the reference block intervals from start to end into the variant rows, ordered by position.
+
+    rows are the variant rows from start to end and blocks the intervals
+    overlapping them, both ordered by position, with the start and end of the
+    interval in place of chr and pos. Every position covered by an interval
+    gets a row, with the statistics of the variant row and the interval combined.
+    """
+    merged = []
+    rows = iter(rows)
+    row = next(rows, None)
+    for block in blocks:
+        for pos in range(max(block.start, start), min(block.end, end) + 1):
+            while row is not None and row.pos < pos:
+                merged.append(row)
+                row = next(rows, None)
+            if row is not None and row.pos == pos:
+                merged.append(_merge_block(chr, pos, row, block))
+                row = next(rows, None)
+            else:
+                merged.append(_merge_block(chr, pos, None, block))
+    while row is not None:
+        merged.append(row)
+        row = next(rows, None)
+    return merged
+
+def _parse_span(region, span):
+    """Parse pos or start-end into 1-based inclusive positions, or return None if span is not numeric."""
+    start, _, end = span.replace(',', '').partition('-')
+    try:
+        start = int(start)
+        end = int(end) if end else start
+    except ValueError:
+        return None
+    if start < 1 or end < start:
+        raise ValueError(f"Invalid region: {region}")
+    return (start, end)
+
+def parse_region(region, contigs=None):
+    """Parse chr, chr:pos or chr:start-end into a (chr, start, end) tuple with 1-based inclusive positions.
+
+    Contig names containing ':' can be braced as {chr}, {chr}:pos or
+    {chr}:start-end, as in samtools. Unbraced, the whole region is taken as
+    the contig name if the part after its last ':' is not a span, or if it is
+    in contigs, a collection of the known contig names, and the part before
+    is not. A region that is ambiguous with contigs is an error.
+    """
+    if region.startswith('{'):
+        chr, brace, span = region[1:].partition('}')
+        if not brace or not chr or (span and not span.startswith(':')):
+            raise ValueError(f"Invalid region: {region}")
+        if not span:
+            return (chr, 1, MAX_POSITION)
+        positions = _parse_span(region, span[1:])
+        if positions is None:
+            raise ValueError(f"Invalid region: {region}")
+        return (chr,) + positions
+
+    chr, _, span = region.rpartition(':')
+    if not chr:
+        return (region, 1, MAX_POSITION)
+    positions = _parse_span(region, span)
+    if positions is None:
+        # Not a span, so part of the contig name
+        return (region, 1, MAX_POSITION)
+    if contigs is not None and region in contigs:
+        if chr in contigs:
+            raise ValueError(f"Ambiguous region: {region}, write {{{chr}}}:{span} or {{{region}}}")
+        return (region, 1, MAX_POSITION)
+    return (chr,) + positions
+
+def read_bed(bed_file):
+    """Yield (chr, start, end) regions with 1-based inclusive positions from an open BED file."""
+    for line in bed_file:
+        if not line.strip() or line.startswith(('#', 'track', 'browser')):
+            continue
+        fields = line.split('\t') if '\t' in line else line.split()
+        yield (fields[0], int(fields[1]) + 1, int(fields[2]))
+
+def read_positions(positions_file):
+    """Yield (chr, pos) tuples from an open file with a chromosome and a position on each line."""
+    for line in positions_file:
+        if not line.strip() or line.startswith('#'):
+            continue
+        fields = line.split()
+        yield (fields[0], int(fields[1]))
+
+class WindowCache:
+    """A bounded LRU cache of the variants in fixed size windows of the genome.
+
+    fetch(chr, start, end) must return the rows with positions from start to
+    end ordered by position. The cache holds the database contents at the time
+    each window was fetched, call clear() after writing to the database.
+    """
+    def __init__(self, fetch, window_size=DEFAULT_WINDOW_SIZE, max_windows=DEFAULT_CACHE_WINDOWS):
+        self.fetch = fetch
+        self.window_size = window_size
+        self.max_windows = max_windows
+        self.hits = 0
+        self.misses = 0
+        self._windows = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._windows)
+
+    def clear(self):
+        self._windows.clear()
+
+    def window(self, chr, window):
+        """Return the positions as an array and the rows in a window."""
+        key = (chr, window)
+        cached = self._windows.get(key)
+        if cached is not None:
+            self.hits += 1
+            self._windows.move_to_end(key)
+            return cached
+
+        self.misses += 1
+        start = window * self.window_size + 1
+        rows = self.fetch(chr, start, start + self.window_size - 1)
+        cached = (np.fromiter((row.pos for row in rows), dtype=np.int64, count=len(rows)), rows)
+        self._windows[key] = cached
+        if len(self._windows) > self.max_windows:
+            self._windows.popitem(last=False)
+        return cached
+
+    def region(self, chr, start, end):
+        """Return the rows from start to end, fetching regions larger than the cache directly."""
+        first = (start - 1) // self.window_size
+        last = (end - 1) // self.window_size
+        if last - first + 1 > self.max_windows:
+            return self.fetch(chr, start, end)
+
+        rows = []
+        for window in range(first, last + 1):
+            positions, window_rows = self.window(chr, window)
+            lo, hi = np.searchsorted(positions, [start, end + 1])
+            rows.extend(window_rows[lo:hi])
+        return rows
+
+    def positions(self, chr, positions):
+        """Return the row at every position on chr, or None where there is none."""
+        positions = np.asarray(positions, dtype=np.int64)
+        found = [None] * len(positions)
+        windows = (positions - 1) // self.window_size
+        for window in np.unique(windows).tolist():
+            selected = np.flatnonzero(windows == window)
+            window_positions, rows = self.window(chr, window)
+            if not len(rows):
+                continue
+            idx = np.minimum(np.searchsorted(window_positions, positions[selected]), len(rows) - 1)
+            for i, j, matched in zip(selected.tolist(), idx.tolist(), (window_positions[idx] == positions[selected]).tolist()):
+                if matched:
+                    found[i] = rows[j]
+        return found
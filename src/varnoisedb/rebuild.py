@@ -0,0 +1,220 @@
+"""
+This module recomputes the variants table from the GVCF files of the samples
+table, for example after the allele frequency definition or the statistics
+changed. The samples are split into groups and, if all GVCF files are indexed,
+the genome into regions. A pool of worker processes parses every group in
+every region into partial statistics, which are merged into a fresh table by
+the upsert. The upsert combines the moments with the pairwise update of Chan
+et al., so the parts can be merged in any order. Once all parts are merged,
+the fresh table replaces the variants table in one transaction, so readers
+see either the old or the new statistics.
+"""
+
+import functools
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from sqlalchemy import Column, Index, MetaData, Table, func, inspect, select, text
+
+from varnoisedb.database import DatabaseAdapter
+from varnoisedb.generations import finish_generation, start_generation
+from varnoisedb.gvcf_parser import has_index
+from varnoisedb.models import SampleContribution, Sample, Variant
+from varnoisedb.parallel import DEFAULT_SHARD_SIZE, bounded_map, make_parser, shard_regions
+from varnoisedb.progress import read_progress
+from varnoisedb.snapshot import samples_fingerprint
+from varnoisedb.updater import to_mappings, with_sample_ids
+from varnoisedb.upsert import dialect_insert, upsert_statement
+
+# Samples parsed together by one task, bounds the number of files open per worker
+DEFAULT_GROUP_SIZE = 100
+
+REBUILD_TABLE = 'variants_rebuild'
+_OLD_TABLE = 'variants_old'
+
+# The fresh table, with the columns of variants
+_rebuild_table = Table(
+    REBUILD_TABLE,
+    MetaData(),
+    *[Column(column.name, column.type, primary_key=column.primary_key) for column in Variant.__table__.c],
+)
+
+@functools.lru_cache(maxsize=None)
+def _rebuild_upsert(dialect_name):
+    return upsert_statement(dialect_name, dialect_insert(dialect_name)(_rebuild_table), _rebuild_table)
+
+def plan_parts(gvcf_files, group_size=DEFAULT_GROUP_SIZE, shard_size=DEFAULT_SHARD_SIZE):
+    """Split the GVCF files into groups and, if all are indexed, the genome into regions.
+
+    Returns a list of (files, region) parts, region None for whole files. The
+    parts are ordered by group first, so that parts processed at the same time
+    cover different regions and rarely write the same rows.
+    """
+    groups = [gvcf_files[i:i + group_size] for i in range(0, len(gvcf_files), group_size)]
+    if shard_size and all(has_index(path) for path in gvcf_files):
+        regions = shard_regions(gvcf_files, shard_size)
+    else:
+        regions = [None]
+    return [(group, region) for group in groups for region in regions]
+
+def _parse_part(gvcf_files, region, batch_size):
+    """Parse one part into statistics batches in a worker process."""
+    parser = make_parser(gvcf_files, None if region is None else [region])
+    return list(parser.parse_stats(batch_size))
+
+def _sample_ids(session):
+    return dict(session.execute(select(Sample.name, Sample.id)).all())
+
+def _write_part(db_adapter, session, batches, sample_ids, generation):
+    """Merge the statistics batches of a part into the fresh table, stamped with generation, and return the number of written rows."""
+    upsert = _rebuild_upsert(session.get_bind().dialect.name)
+    n_rows = 0
+    for batch in batches:
+        contig_id = db_adapter.contig_ids([batch.chr], session)[batch.chr]
+        rows = to_mappings(with_sample_ids(batch, sample_ids), contig_id, generation)
+        if rows:
+            session.execute(upsert, rows)
+        n_rows += len(rows)
+    return n_rows
+
+def _rebuild_part(db_config, gvcf_files, region, batch_size, generation):
+    """Parse one part and merge it into the fresh table from a worker process."""
+    db_adapter = DatabaseAdapter.from_config(db_config)
+    session = db_adapter.get_session()
+    try:
+        parser = make_parser(gvcf_files, None if region is None else [region])
+        n_rows = _write_part(db_adapter, session, parser.parse_stats(batch_size), _sample_ids(session), generation)
+        session.commit()
+        return n_rows
+    finally:
+        session.close()
+        db_adapter.close()
+
+def _log_progress(n_done, n_parts):
+    # About every 5%
+    if n_done == n_parts or n_done % max(n_parts // 20, 1) == 0:
+        logging.info(f"Merged {n_done} of {n_parts} parts.")
+
+def _check_samples(session):
+    """Return the GVCF files of the samples, raising ValueError if the variants cannot be rebuilt from them."""
+    samples = session.execute(select(Sample.name, Sample.gvcf_path).order_by(Sample.id)).all()
+    if not samples:
+        raise ValueError("There are no samples in the database")
+    unfinished = read_progress(session)
+    if unfinished:
+        raise ValueError(f"Loading samples {', '.join(sorted(unfinished))} was interrupted, resume or remove them first")
+    targeted = session.execute(select(Sample.name).where(Sample.targets_path.is_not(None))).scalars().all()
+    if targeted:
+        raise ValueError(f"Samples {', '.join(targeted)} were loaded with targets, which rebuilds do not support")
+    gvcf_files = [path for _, path in samples]
+    missing = [path for path in gvcf_files if not os.path.exists(path)]
+    if missing:
+        raise ValueError(f"GVCF files of the samples are missing: {', '.join(missing)}")
+    shared = sorted({path for path in gvcf_files if gvcf_files.count(path) > 1})
+    if shared:
+        raise ValueError(f"GVCF files are registered for more than one sample: {', '.join(shared)}")
+    return gvcf_files
+
+def replace_variants(db_adapter, fingerprint):
+    """Replace the variants table with the fresh table in one transaction.
+
+    Raises ValueError, leaving the variants table unchanged, if the samples
+    table no longer matches fingerprint. The secondary indexes of the
+    variants table are created again on the fresh table. On MySQL the two
+    tables are swapped in a single RENAME TABLE statement.
+    """
+    indexes = inspect(db_adapter.engine).get_indexes('variants')
+    with db_adapter.engine.begin() as connection:
+        if samples_fingerprint(connection) != fingerprint:
+            raise ValueError("Samples were added or removed during the rebuild")
+        if db_adapter.db_type == 'mysql':
+            connection.execute(text(f"RENAME TABLE variants TO {_OLD_TABLE}, {REBUILD_TABLE} TO variants"))
+        else:
+            connection.execute(text(f"ALTER TABLE variants RENAME TO {_OLD_TABLE}"))
+            connection.execute(text(f"ALTER TABLE {REBUILD_TABLE} RENAME TO variants"))
+        connection.execute(text(f"DROP TABLE {_OLD_TABLE}"))
+        # Indexes on the columns of the model would be added to its table and created again by create_tables
+        variants = Table('variants', MetaData(), *[Column(column.name, column.type) for column in Variant.__table__.c])
+        for index in indexes:
+            Index(
+                index['name'], *[variants.c[name] for name in index['column_names']], unique=index['unique']
+            ).create(connection)
+
+def rebuild_variants(db_config, workers, batch_size=1000, group_size=DEFAULT_GROUP_SIZE, shard_size=DEFAULT_SHARD_SIZE):
+    """Recompute the variants table from the GVCF files of all samples with a pool of worker processes.
+
+    On PostgreSQL and MySQL the workers merge their parts into the fresh
+    table themselves. SQLite allows only one writer, so there the workers
+    only parse and the main process writes. Without indexes every part is a
+    whole group of files, which on SQLite is held in memory until written.
+    A failed rebuild drops the fresh table and leaves the variants table
+    unchanged. Reference blocks stored as intervals and tables partitioned
+    by contig are not supported. The rebuild is a generation that changes
+    every row, see varnoisedb.generations.
+
+    Returns the number of samples, the number of parts and the number of
+    variants in the rebuilt table.
+    """
+    if db_config.get('reference_blocks', False):
+        raise ValueError("Rebuilding databases with reference blocks stored as intervals is not supported")
+    db_adapter = DatabaseAdapter.from_config(db_config)
+    try:
+        if db_adapter.partition_by_contig:
+            raise ValueError("Rebuilding a variants table partitioned by contig is not supported")
+        session = db_adapter.get_session()
+        try:
+            gvcf_files = _check_samples(session)
+            sample_ids = _sample_ids(session)
+            fingerprint = samples_fingerprint(session)
+            if session.execute(select(SampleContribution.sample_id).limit(1)).first() is not None:
+                logging.warning("The stored sample contributions are not rebuilt and keep the values of the original loads.")
+        finally:
+            session.close()
+
+        parts = plan_parts(gvcf_files, group_size, shard_size)
+        logging.info(f"Rebuilding the variants of {len(gvcf_files)} samples in {len(parts)} parts with {workers} worker processes...")
+
+        engine = db_adapter.engine
+        # Left behind by a rebuild that was killed
+        _rebuild_table.drop(engine, checkfirst=True)
+        _rebuild_table.create(engine)
+        generation = start_generation(db_adapter, 'rebuild')
+        try:
+            n_done = 0
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                if db_adapter.db_type == 'sqlite':
+                    arguments = [(files, region, batch_size) for files, region in parts]
+                    for batches in bounded_map(pool, _parse_part, arguments, 2 * workers):
+                        session = db_adapter.get_session()
+                        try:
+                            _write_part(db_adapter, session, batches, sample_ids, generation)
+                            session.commit()
+                        finally:
+                            session.close()
+                        n_done += 1
+                        _log_progress(n_done, len(parts))
+                else:
+                    futures = [
+                        pool.submit(_rebuild_part, db_config, files, region, batch_size, generation) for files, region in parts
+                    ]
+                    try:
+                        for future in as_completed(futures):
+                            future.result()
+                            n_done += 1
+                            _log_progress(n_done, len(parts))
+                    except Exception:
+                        for future in futures:
+                            future.cancel()
+                        raise
+            replace_variants(db_adapter, fingerprint)
+        except BaseException:
+            _rebuild_table.drop(engine, checkfirst=True)
+            raise
+        finally:
+            finish_generation(db_adapter, generation)
+
+        with engine.connect() as connection:
+            n_variants = connection.execute(select(func.count()).select_from(Variant.__table__)).scalar()
+        return (len(gvcf_files), len(parts), n_variants)
+    finally:
+        db_adapter.close()
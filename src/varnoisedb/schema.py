@@ -8,6 +8,10 @@ schema = {
             'port': {'type': 'integer', 'required': False},
             'user': {'type': 'string', 'required': False},
             'password': {'type': 'string', 'required': False},
+            'reference_blocks': {'type': 'boolean', 'required': False, 'default': False},
+            'contributions': {'type': 'boolean', 'required': False, 'default': False},
+            'bulk_load': {'type': 'boolean', 'required': False, 'default': False},
+            'partition_by_contig': {'type': 'boolean', 'required': False, 'default': False},
         }
     }
 }
@@ -19,6 +23,10 @@ def validate_config(config):
         raise ValueError(f"Invalid configuration: {v.errors}")
     
     db_type = config['database']['type']
+    if config['database'].get('bulk_load') and db_type != 'sqlite':
+        raise ValueError("Invalid configuration: bulk_load is only supported for sqlite databases")
+    if config['database'].get('partition_by_contig') and db_type != 'postgresql':
+        raise ValueError("Invalid configuration: partition_by_contig is only supported for postgresql databases")
     if db_type in ['postgresql', 'mysql']:
         required_fields = ['host', 'port', 'user', 'password']
         defaults = {
@@ -0,0 +1,342 @@
+"""
+This module freezes the variants table into a read-only columnar snapshot and
+answers lookups from it. A snapshot is a directory with one subdirectory of
+.npy files per contig, sorted int32 positions and float32/int32 statistics,
+and a manifest.json. The files are memory-mapped when read, so opening a
+snapshot is nearly free and lookups need no database connection.
+
+The manifest records a fingerprint of the samples table, so that a snapshot
+that no longer matches the database can be detected, and the generation of
+the database the snapshot covers, so that it can be brought up to date with
+the changes after it, see varnoisedb.generations.
+"""
+
+import collections
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+from datetime import datetime, timezone
+import numpy as np
+from sqlalchemy import func, select
+
+from varnoisedb.generations import deleted_statement, exported_generation, rebuilt_since
+from varnoisedb.gvcf_parser import StatsBatch
+from varnoisedb.models import Contig, Sample, Variant
+
+SNAPSHOT_FORMAT = 1
+MANIFEST = 'manifest.json'
+
+# Column name, dtype and variants column of every snapshot file
+_COLUMNS = [
+    ('pos', np.int32, Variant.pos),
+    ('mean_non_ref_af', np.float32, Variant.mean_non_ref_af),
+    ('sd_non_ref_af', np.float32, Variant.sd_non_ref_af),
+    ('max_non_ref_af', np.float32, Variant.max_non_ref_af),
+    ('min_non_ref_af', np.float32, Variant.min_non_ref_af),
+    ('total_depth', np.float32, Variant.total_depth),
+    ('number_of_samples', np.int32, Variant.number_of_samples),
+    ('max_non_ref_af_sample', np.int32, Variant.max_non_ref_af_sample),
+    ('min_non_ref_af_sample', np.int32, Variant.min_non_ref_af_sample),
+]
+
+# Variant rows read from a snapshot, with the attributes of the variants table
+SnapshotRow = collections.namedtuple('SnapshotRow', ['chr'] + [name for name, _, _ in _COLUMNS])
+
+def samples_fingerprint(session):
+    """Return a hash of the samples in the database and when they were added."""
+    digest = hashlib.sha256()
+    for name, date_added in session.execute(select(Sample.name, Sample.date_added).order_by(Sample.name)):
+        digest.update(f"{name}\t{date_added}\n".encode())
+    return digest.hexdigest()
+
+def _encode_samples(values, codes):
+    """Replace sample ids with their index in the snapshot sample list, -1 for none."""
+    return np.fromiter(
+        (-1 if value is None else codes.setdefault(value, len(codes)) for value in values),
+        dtype=np.int32, count=len(values)
+    )
+
+def write_snapshot(session, directory, chunk_size=100000):
+    """Write the variants table as a snapshot to directory and return its manifest.
+
+    The snapshot is written to a temporary directory next to directory and
+    renamed into place when complete, replacing an existing snapshot only
+    then. Memory use is bounded by chunk_size rows.
+    """
+    parent = os.path.dirname(os.path.abspath(directory))
+    tmp_directory = tempfile.mkdtemp(prefix='.snapshot-', dir=parent)
+    try:
+        # Loads running concurrently can change the table between these statements,
+        # which is detected below when a contig does not have the counted size
+        generation = exported_generation(session)
+        fingerprint = samples_fingerprint(session)
+        names = dict(session.execute(select(Contig.id, Contig.name)).all())
+        counts = session.execute(select(Variant.contig_id, func.count()).group_by(Variant.contig_id)).all()
+        counts = sorted(((names[contig_id], contig_id, count) for contig_id, count in counts))
+
+        contigs = {}
+        sample_codes = {}
+        for i, (chr, contig_id, count) in enumerate(counts):
+            contig_directory = f"contig_{i:05d}"
+            os.mkdir(os.path.join(tmp_directory, contig_directory))
+            arrays = {
+                name: np.lib.format.open_memmap(
+                    os.path.join(tmp_directory, contig_directory, f"{name}.npy"), mode='w+', dtype=dtype, shape=(count,)
+                )
+                for name, dtype, _ in _COLUMNS
+            }
+            stmt = select(*[column for _, _, column in _COLUMNS]).where(Variant.contig_id == contig_id).order_by(Variant.pos)
+            n = 0
+            for rows in session.execute(stmt.execution_options(yield_per=chunk_size)).partitions():
+                if n + len(rows) > count:
+                    raise ValueError(f"The variants on {chr} changed while the snapshot was written")
+                for (name, dtype, _), values in zip(_COLUMNS, zip(*rows)):
+                    if name.endswith('_sample'):
+                        arrays[name][n:n + len(rows)] = _encode_samples(values, sample_codes)
+                    else:
+                        # None becomes NaN in the float columns
+                        arrays[name][n:n + len(rows)] = np.array(values, dtype=np.float64)
+                n += len(rows)
+            if n != count:
+                raise ValueError(f"The variants on {chr} changed while the snapshot was written")
+            for array in arrays.values():
+                array.flush()
+            contigs[chr] = {'directory': contig_directory, 'variants': n}
+
+        sample_names = dict(session.execute(select(Sample.id, Sample.name)).all())
+        manifest = {
+            'format': SNAPSHOT_FORMAT,
+            'created': datetime.now(timezone.utc).isoformat(),
+            'generation': generation,
+            'samples_fingerprint': fingerprint,
+            'samples': [sample_names.get(id) for id in sorted(sample_codes, key=sample_codes.get)],
+            'contigs': contigs,
+        }
+        _finish(tmp_directory, directory, manifest)
+    except BaseException:
+        shutil.rmtree(tmp_directory, ignore_errors=True)
+        raise
+    return manifest
+
+def _finish(tmp_directory, directory, manifest):
+    """Write the manifest of the snapshot in tmp_directory and move it to directory, replacing any snapshot there."""
+    with open(os.path.join(tmp_directory, MANIFEST), 'w') as file:
+        json.dump(manifest, file, indent=2)
+    if os.path.exists(directory):
+        old_directory = tempfile.mkdtemp(prefix='.snapshot-old-', dir=os.path.dirname(tmp_directory))
+        os.rename(directory, os.path.join(old_directory, 'snapshot'))
+        os.rename(tmp_directory, directory)
+        shutil.rmtree(old_directory)
+    else:
+        os.rename(tmp_directory, directory)
+
+def _link_or_copy(source, destination):
+    """Hard link a file of the old snapshot into the new one, or copy it where links are not supported."""
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copyfile(source, destination)
+
+def _changed_by_contig(session, since, chunk_size):
+    """Return the rows of the variants changed after generation since, grouped by contig id."""
+    stmt = select(Variant.contig_id, *[column for _, _, column in _COLUMNS]).where(
+        Variant.generation > since
+    ).order_by(Variant.contig_id, Variant.pos)
+    changed = collections.defaultdict(list)
+    for rows in session.execute(stmt.execution_options(yield_per=chunk_size)).partitions():
+        for row in rows:
+            changed[row[0]].append(tuple(row[1:]))
+    return changed
+
+def _patch_contig(source, destination, rows, deleted, encode):
+    """Write the columns of a contig with rows replacing and deleted removing positions of the old columns.
+
+    source is the directory of the contig in the old snapshot, None for a new
+    contig. rows are the sorted changed rows with their sample ids encoded
+    by encode. Returns the number of variants. The columns are patched one
+    at a time, so memory use is bounded by a single column of the contig.
+    """
+    os.mkdir(destination)
+    old_pos = np.load(os.path.join(source, 'pos.npy'), mmap_mode='r') if source else np.empty(0, dtype=np.int32)
+    new_pos = np.array([row[0] for row in rows], dtype=np.int64)
+    keep = ~np.isin(old_pos, np.concatenate((new_pos, np.asarray(deleted, dtype=np.int64))))
+    n_kept = int(keep.sum())
+    # Positions of the changed rows among the kept and changed rows
+    changed_at = np.searchsorted(old_pos[keep], new_pos) + np.arange(len(new_pos))
+    is_changed = np.zeros(n_kept + len(new_pos), dtype=bool)
+    is_changed[changed_at] = True
+    for i, (name, dtype, _) in enumerate(_COLUMNS):
+        values = [row[i] for row in rows]
+        column = np.lib.format.open_memmap(
+            os.path.join(destination, f"{name}.npy"), mode='w+', dtype=dtype, shape=(len(is_changed),)
+        )
+        if n_kept:
+            column[~is_changed] = np.load(os.path.join(source, f"{name}.npy"), mmap_mode='r')[keep]
+        if name.endswith('_sample'):
+            column[is_changed] = encode(values)
+        else:
+            # None becomes NaN in the float columns
+            column[is_changed] = np.array(values, dtype=np.float64)
+        column.flush()
+    return len(is_changed)
+
+def update_snapshot(session, directory, chunk_size=100000):
+    """Bring the snapshot in directory up to date with the changes to the variants table and return its manifest.
+
+    Only the contigs with variants changed or deleted after the generation
+    of the snapshot are rewritten, the files of the other contigs are hard
+    linked into the new snapshot. The changed rows are held in memory. The
+    new snapshot replaces the old one when complete. A snapshot taken before a rebuild is written again in full.
+    Raises ValueError for snapshots without a generation.
+    """
+    manifest = Snapshot(directory).manifest
+    since = manifest.get('generation')
+    if since is None:
+        raise ValueError(f"The snapshot in {directory} was written before changes were tracked, write it again")
+    rebuilt = rebuilt_since(session, since)
+    if rebuilt is not None:
+        logging.info(f"The variants were rebuilt in generation {rebuilt}, writing the snapshot in full")
+        return write_snapshot(session, directory, chunk_size)
+
+    parent = os.path.dirname(os.path.abspath(directory))
+    tmp_directory = tempfile.mkdtemp(prefix='.snapshot-', dir=parent)
+    try:
+        generation = exported_generation(session)
+        fingerprint = samples_fingerprint(session)
+        names = dict(session.execute(select(Contig.id, Contig.name)).all())
+        deleted = collections.defaultdict(list)
+        for contig_id, pos in session.execute(deleted_statement(since)):
+            deleted[contig_id].append(pos)
+        changed = _changed_by_contig(session, since, chunk_size)
+
+        sample_names = dict(session.execute(select(Sample.id, Sample.name)).all())
+        samples = list(manifest['samples'])
+        codes = {name: code for code, name in enumerate(samples)}
+        def encode(ids):
+            # Samples removed since have no name and are stored as -1 like missing samples
+            encoded = []
+            for id in ids:
+                name = sample_names.get(id)
+                if name is not None and name not in codes:
+                    codes[name] = len(samples)
+                    samples.append(name)
+                encoded.append(-1 if name is None else codes[name])
+            return np.array(encoded, dtype=np.int32)
+
+        contigs = dict(manifest['contigs'])
+        touched = {names[contig_id] for contig_id in set(changed) | set(deleted)}
+        n_directories = len(contigs)
+        for chr, contig in contigs.items():
+            if chr not in touched:
+                os.mkdir(os.path.join(tmp_directory, contig['directory']))
+                for name, _, _ in _COLUMNS:
+                    file_name = os.path.join(contig['directory'], f"{name}.npy")
+                    _link_or_copy(os.path.join(directory, file_name), os.path.join(tmp_directory, file_name))
+        contig_ids = {name: contig_id for contig_id, name in names.items()}
+        for chr in sorted(touched):
+            contig = contigs.get(chr)
+            if contig is None:
+                contig = {'directory': f"contig_{n_directories:05d}"}
+                n_directories += 1
+                source = None
+            else:
+                source = os.path.join(directory, contig['directory'])
+            contig_id = contig_ids[chr]
+            n = _patch_contig(
+                source, os.path.join(tmp_directory, contig['directory']),
+                changed.get(contig_id, []), deleted.get(contig_id, []), encode
+            )
+            contigs[chr] = {'directory': contig['directory'], 'variants': n}
+
+        manifest = {
+            'format': SNAPSHOT_FORMAT,
+            'created': datetime.now(timezone.utc).isoformat(),
+            'generation': generation,
+            'samples_fingerprint': fingerprint,
+            'samples': samples,
+            'contigs': contigs,
+        }
+        _finish(tmp_directory, directory, manifest)
+    except BaseException:
+        shutil.rmtree(tmp_directory, ignore_errors=True)
+        raise
+    return manifest
+
+class Snapshot:
+    """A read-only, memory-mapped snapshot of the variants table.
+
+    Columns are mapped on first use per contig. Lookups use binary search on
+    the sorted positions and return statistics as a StatsBatch.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, MANIFEST)) as file:
+            self.manifest = json.load(file)
+        if self.manifest.get('format') != SNAPSHOT_FORMAT:
+            raise ValueError(f"Unsupported snapshot format in {directory}: {self.manifest.get('format')}")
+        self.sample_names = np.array(self.manifest['samples'] + [None], dtype=object)
+        self._contigs = {}
+
+    @property
+    def contigs(self):
+        return list(self.manifest['contigs'])
+
+    def is_stale(self, session):
+        """Check whether samples were added to or removed from the database after the snapshot was taken."""
+        return samples_fingerprint(session) != self.manifest['samples_fingerprint']
+
+    def _columns(self, chr):
+        columns = self._contigs.get(chr)
+        if columns is None:
+            contig = self.manifest['contigs'].get(chr)
+            if contig is None:
+                return None
+            path = os.path.join(self.directory, contig['directory'])
+            columns = {name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode='r') for name, _, _ in _COLUMNS}
+            self._contigs[chr] = columns
+        return columns
+
+    def _batch(self, chr, columns, index):
+        values = {name: columns[name][index] for name, _, _ in _COLUMNS}
+        for name in ('max_non_ref_af_sample', 'min_non_ref_af_sample'):
+            # -1 selects the trailing None
+            values[name] = self.sample_names[values[name]]
+        return StatsBatch(chr, **values)
+
+    def _empty(self, chr):
+        return StatsBatch(chr, **{name: np.empty(0, dtype=dtype if not name.endswith('_sample') else object)
+                                  for name, dtype, _ in _COLUMNS})
+
+    def query_region(self, chr, start, end):
+        """Return the statistics of the variants on chr from start to end, both inclusive."""
+        columns = self._columns(chr)
+        if columns is None:
+            return self._empty(chr)
+        lo, hi = np.searchsorted(columns['pos'], [start, end + 1])
+        return self._batch(chr, columns, slice(lo, hi))
+
+    def query_positions(self, chr, positions):
+        """Look up positions on chr.
+
+        Returns the statistics of the positions found and a boolean mask of
+        the positions that were found.
+        """
+        positions = np.asarray(positions, dtype=np.int64)
+        columns = self._columns(chr)
+        if columns is None or not len(columns['pos']):
+            return self._empty(chr), np.zeros(len(positions), dtype=bool)
+        idx = np.minimum(np.searchsorted(columns['pos'], positions), len(columns['pos']) - 1)
+        found = columns['pos'][idx] == positions
+        return self._batch(chr, columns, idx[found]), found
+
+    def fetch_variants(self, chr, start, end):
+        """Return the variants on chr from start to end as rows, like DatabaseAdapter.fetch_variants."""
+        batch = self.query_region(chr, start, end)
+        values = [
+            [None if value != value else value for value in getattr(batch, name).tolist()]
+            for name, _, _ in _COLUMNS
+        ]
+        return [SnapshotRow(chr, *row) for row in zip(*values)]
@@ -0,0 +1,97 @@
+"""
+This module restricts loads and removals to target regions, such as the
+regions of a gene panel, read from a BED file. The regions are merged and
+sorted per contig. Indexed GVCF files are read only at the regions, through
+tabix or CSI region queries, other files are read in full and filtered while
+they are read.
+
+Records are clipped to the regions: a record overlapping a region is kept
+for the part inside it. A reference block that starts before a region so
+counts from the first position of the region, and a block spanning several
+regions is split into one record per region.
+"""
+
+import bisect
+import collections
+import numpy as np
+
+from varnoisedb.query import read_bed
+
+class Targets:
+    """Merged target regions per contig, 1-based and inclusive."""
+    def __init__(self, regions, path=None):
+        by_contig = collections.defaultdict(list)
+        for chr, start, end in regions:
+            if end < start:
+                raise ValueError(f"Invalid target region {chr}:{start}-{end}")
+            by_contig[chr].append((start, end))
+        self.path = path
+        self.starts = {}
+        self.ends = {}
+        for chr, intervals in by_contig.items():
+            merged = []
+            for start, end in sorted(intervals):
+                # Overlapping and adjacent regions are joined
+                if merged and start <= merged[-1][1] + 1:
+                    merged[-1][1] = max(merged[-1][1], end)
+                else:
+                    merged.append([start, end])
+            self.starts[chr] = [start for start, _ in merged]
+            self.ends[chr] = [end for _, end in merged]
+
+    @classmethod
+    def from_bed(cls, path):
+        with open(path) as bed_file:
+            return cls(read_bed(bed_file), path)
+
+    def __len__(self):
+        return sum(len(starts) for starts in self.starts.values())
+
+    @property
+    def size(self):
+        """The number of bp covered by the regions."""
+        return sum(end - start + 1 for chr in self.starts for start, end in zip(self.starts[chr], self.ends[chr]))
+
+    def regions(self, contigs):
+        """Yield the (chr, start, end) regions on contigs, in the order of contigs."""
+        for chr in contigs:
+            yield from ((chr, start, end) for start, end in zip(self.starts.get(chr, ()), self.ends.get(chr, ())))
+
+    def after(self, contigs, chr, pos):
+        """Return the targets after chr:pos, with the contigs ordered as in contigs."""
+        if chr not in contigs:
+            raise ValueError(f"Contig {chr} is not in the header of the GVCF file")
+        following = contigs[contigs.index(chr) + 1:]
+        regions = [(chr, max(start, pos + 1), end) for _, start, end in self.regions([chr]) if end > pos]
+        return Targets(regions + list(self.regions(following)), self.path)
+
+    def overlaps(self, chr, start, end):
+        """Check whether start to end on chr overlaps a region."""
+        starts = self.starts.get(chr)
+        if starts is None:
+            return False
+        i = bisect.bisect_right(starts, end) - 1
+        return i >= 0 and self.ends[chr][i] >= start
+
+    def clip(self, batch):
+        """Clip the records of a VariantBatch to the regions.
+
+        Returns a batch with a record for every overlap of a record with a
+        region, covering the overlapping part. Records outside the regions
+        are dropped.
+        """
+        if batch.chr not in self.starts:
+            return batch.take(slice(0, 0))
+        starts = np.array(self.starts[batch.chr], dtype=np.int64)
+        ends = np.array(self.ends[batch.chr], dtype=np.int64)
+        # Regions first to last - 1 overlap a record
+        first = np.searchsorted(ends, batch.pos, side='left')
+        last = np.searchsorted(starts, batch.end, side='right')
+        counts = np.maximum(last - first, 0)
+        records = np.repeat(np.arange(len(batch)), counts)
+        offsets = np.arange(len(records)) - np.repeat(np.cumsum(counts) - counts, counts)
+        regions = np.repeat(first, counts) + offsets
+        clipped = batch.take(records)
+        clipped.pos = np.maximum(clipped.pos, starts[regions]).astype(batch.pos.dtype)
+        clipped.end = np.minimum(clipped.end, ends[regions]).astype(batch.end.dtype)
+        return clipped
@@ -3,211 +3,749 @@ This module updates the database with parsed gvcf data.
 It calculates and updates the mean, max, and min allele frequencies.
 """
 
-import json
-from sqlalchemy import tuple_
+import collections
+import contextlib
+import functools
+import itertools
+import logging
+import os
+import time
+import numpy as np
+from sqlalchemy import Column, MetaData, Table, bindparam, insert, select, update
 from sqlalchemy.orm import Session
 
-from varnoisedb.models import Variant, Sample
-from varnoisedb.utils import update_stats
+from varnoisedb.batching import BatchSizer, max_batch_size
+from varnoisedb.contributions import ContributionWriter, has_contributions, read_contributions, read_overlapping, recompute_stats
+from varnoisedb.generations import finish_generation, finish_generations, record_tombstones, start_generation
+from varnoisedb.gvcf_parser import Checkpoint, StatsBatch, VariantBatch
+from varnoisedb.intervals import merge_intervals, recompute_extremes, subtract_intervals
+from varnoisedb.models import Contig, ReferenceBlock, SampleContribution, Variant, Sample
+from varnoisedb.metrics import Metrics
+from varnoisedb.pipeline import StageTimings, prefetch, timed
+from varnoisedb.progress import clear_progress, progress_generations, read_progress, resume_progress, save_progress, start_progress
+from varnoisedb.upsert import dialect_insert, upsert_statement, variants_upsert
+
+# 'orm' reads the existing rows and merges the statistics in Python,
+# 'upsert' merges them in the database with one statement per batch and
+# 'copy' streams all batches into a staging table with COPY and merges them
+# with one set-based statement (PostgreSQL only).
+WRITE_MODES = ('orm', 'upsert', 'copy')
+
+@functools.cache
+def staging_table():
+    """The staging table of the copy write mode, built on first use as it imports the PostgreSQL dialect."""
+    # Temporary tables are never WAL-logged and this one is dropped on commit
+    return Table(
+        'variants_staging',
+        MetaData(),
+        *[Column(column.name, column.type) for column in Variant.__table__.c],
+        prefixes=['TEMPORARY'],
+        postgresql_on_commit='DROP',
+    )
+
+_STAT_COLUMNS = (
+    'pos',
+    'mean_non_ref_af',
+    'sd_non_ref_af',
+    'max_non_ref_af',
+    'min_non_ref_af',
+    'total_depth',
+    'number_of_samples',
+    'max_non_ref_af_sample',
+    'min_non_ref_af_sample',
+)
+
+# Stages timed within the write stage, which gets the rest of its time
+_NESTED_STAGES = ('fetch', 'compute', 'commit')
+
+# A VariantBatch passed through the prefetch queue to the on_batch callback of the writer
+_Observed = collections.namedtuple('_Observed', ['batch'])
+
+def _to_list(values):
+    """Convert an array to a list of Python scalars, with NaN as None."""
+    if values.dtype == object:
+        return values.tolist()
+    return [None if value != value else value for value in values.tolist()]
+
+# Prepared statements executed once per batch with a list of rows (executemany)
+_insert_variant = insert(Variant.__table__)
+_update_variant = update(Variant.__table__).where(
+    Variant.__table__.c.contig_id == bindparam('b_contig_id'),
+    Variant.__table__.c.pos == bindparam('b_pos')
+).values({column: bindparam(column) for column in _STAT_COLUMNS[1:] + ('generation',)})
+
+def _update_rows(session: Session, rows):
+    """Update the statistics of existing variants from mappings with an executemany."""
+    for row in rows:
+        row['b_contig_id'] = row.pop('contig_id')
+        row['b_pos'] = row.pop('pos')
+    session.execute(_update_variant, rows)
+
+def with_sample_ids(batch: StatsBatch, sample_ids):
+    """Return a statistics batch with the sample names of its min/max sample columns replaced by their ids."""
+    def encode(names):
+        return np.array([sample_ids.get(name) for name in names.tolist()], dtype=object)
+    batch = batch.take(slice(None))
+    batch.max_non_ref_af_sample = encode(batch.max_non_ref_af_sample)
+    batch.min_non_ref_af_sample = encode(batch.min_non_ref_af_sample)
+    return batch
+
+def to_mappings(batch: StatsBatch, contig_id, generation=None):
+    """Build the bulk insert/update mappings for Variant from a statistics batch with sample ids, stamped with generation."""
+    columns = [itertools.repeat(contig_id)] + [_to_list(getattr(batch, column)) for column in _STAT_COLUMNS]
+    names = ('contig_id',) + _STAT_COLUMNS
+    return [dict(zip(names, row), generation=generation) for row in zip(*columns)]
+
+def _to_block_mappings(batch: StatsBatch, contig_id):
+    """Build the bulk insert mappings for ReferenceBlock from a batch of intervals."""
+    rows = to_mappings(batch, contig_id)
+    for row, end in zip(rows, batch.end.tolist()):
+        row['start'] = row.pop('pos')
+        row['end'] = end
+        # Changes of the reference blocks are not tracked
+        del row['generation']
+    return rows
+
+def _to_stats_batch(chr, existing, rows=slice(None)):
+    """Wrap selected rows of fetched columns in a StatsBatch."""
+    return StatsBatch(
+        chr,
+        existing['pos'][rows],
+        *[existing[column][rows] for column in _STAT_COLUMNS[1:]],
+        end=existing['end'][rows] if 'end' in existing else None,
+    )
+
+def _to_arrays(records, columns):
+    """Convert fetched rows to a dict of column arrays, with None as NaN in numeric columns."""
+    values = list(zip(*records)) or [()] * len(columns)
+    arrays = {}
+    for column, column_values in zip(columns, values):
+        if column.endswith('_sample'):
+            arrays[column] = np.array(column_values, dtype=object)
+        else:
+            # None becomes NaN so that missing values survive the arithmetic
+            arrays[column] = np.array(column_values, dtype=np.float64)
+    arrays['number_of_samples'] = arrays['number_of_samples'].astype(np.int64)
+    arrays['pos'] = arrays['pos'].astype(np.int64)
+    if 'end' in arrays:
+        arrays['end'] = arrays['end'].astype(np.int64)
+    return arrays
+
+def _truncate(batches, chr, pos):
+    """Yield the records of batches up to chr:pos in file order."""
+    if chr is None:
+        return
+    reached = False
+    for batch in batches:
+        if batch.chr == chr:
+            reached = True
+            batch = batch.take(batch.pos <= pos)
+            if len(batch):
+                yield batch
+        elif reached:
+            return
+        else:
+            yield batch
+
+def _relabel(batches, sample_id):
+    """Label the batches of a sample with its id, as stored in the min/max sample columns."""
+    for batch in batches:
+        yield VariantBatch(batch.chr, batch.pos, batch.non_ref_af, batch.dp, sample_id, batch.end)
+
+def _to_copy_rows(batch: StatsBatch, contig_id, generation):
+    """Format a statistics batch with sample ids as tab separated rows for COPY FROM STDIN, stamped with generation."""
+    columns = [itertools.repeat(contig_id)] + [_to_list(getattr(batch, column)) for column in _STAT_COLUMNS]
+    columns.append(itertools.repeat(generation))
+    return ''.join(
+        '\t'.join('\\N' if value is None else repr(value) if isinstance(value, float) else str(value) for value in row) + '\n'
+        for row in zip(*columns)
+    )
 
 class Updater:
-    def __init__(self, db_adapter, gvcf_parser, batch_size=1000):
+    """Merge parsed GVCF data into the database, or remove it again.
+
+    With reference_blocks set, reference blocks are stored as intervals in the
+    reference_blocks table instead of as a variant at their start position.
+    With contributions set, the parsed values of every sample are also stored
+    in the sample_contributions table, so that it can be removed exactly
+    without its GVCF file.
+
+    With checkpoint_interval set, loads commit after about that many batches
+    at a time and record their progress in the load_progress table, so that
+    memory use stays flat and an interrupted load can be resumed.
+
+    With prefetch set, the GVCF files are parsed in a reader thread that keeps
+    up to that many batches ready while the previous ones are written. The
+    time spent per stage and the number of written rows are collected in
+    metrics, which can be shared with the caller.
+
+    Several loads and removals can write to a PostgreSQL or MySQL database at
+    the same time. Upserts merge the statistics in a single statement, the
+    rows read and rewritten by the orm write mode and by removals are locked
+    with SELECT ... FOR UPDATE, and reference blocks are rewritten under a
+    lock of their contig.
+
+    Every load and removal is a generation of its own, see
+    varnoisedb.generations, unless generation is given, for example to the
+    workers of a parallel load, which share the generation of the load.
+
+    batch_size is the number of records parsed per batch. With 'auto', or a
+    BatchSizer, it is adapted to the write latency of the batches within the
+    limits of the backend, see varnoisedb.batching.
+    """
+    def __init__(self, db_adapter, gvcf_parser, batch_size=1000, write_mode='orm', reference_blocks=False,
+                 contributions=False, checkpoint_interval=None, prefetch=0, metrics=None, generation=None):
+        if write_mode not in WRITE_MODES:
+            raise ValueError(f"Unsupported write mode: {write_mode}")
+        if write_mode == 'copy' and db_adapter.db_type != 'postgresql':
+            raise ValueError("The copy write mode is only supported for PostgreSQL")
+        if write_mode == 'copy' and reference_blocks:
+            raise ValueError("The copy write mode does not support reference blocks")
         self.db_adapter = db_adapter
         self.gvcf_parser = gvcf_parser
+        if batch_size == 'auto':
+            n_files = len(gvcf_parser.samples()) if gvcf_parser is not None else 1
+            batch_size = BatchSizer(max_batch_size(db_adapter), n_files, prefetch=prefetch)
         self.batch_size = batch_size
+        self.sizer = batch_size if isinstance(batch_size, BatchSizer) else None
+        self.write_mode = write_mode
+        self.reference_blocks = reference_blocks
+        self.contributions = contributions
+        self.checkpoint_interval = checkpoint_interval
+        self.prefetch = prefetch
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.generation = generation
+        # Ids of the contigs and samples by name, the samples table is referred to by id
+        self._contigs = {}
+        self._samples = {}
     
-    def insert_sample(self):
+    def insert_sample(self, batches=None, update_samples=True, resume=False):
+        """Load the sample, or all samples of a cohort, into the database.
+
+        batches are statistics batches to write instead of parsing the GVCF
+        files, contributions are not stored for those. The samples are added
+        to the samples table before any variants are written, as the variants
+        refer to them by id. With update_samples set to False, only the
+        variants are written and the samples must already be in the table.
+
+        Returns the number of inserted and updated variants. The upsert write
+        and copy modes cannot tell these apart and return the number of written
+        variants and None instead.
+        """
+        if self.checkpoint_interval and batches is None and update_samples and self.write_mode != 'copy':
+            with self._own_generation('load'):
+                counts = self._insert_checkpointed(resume)
+        elif resume:
+            raise ValueError("Only loads with checkpoints can be resumed")
+        else:
+            with self._own_generation('load'):
+                counts = self._insert(batches, update_samples)
+        if self.sizer is not None:
+            self.metrics.set('batch_size', self.sizer.size)
+        return counts
+
+    def _insert(self, batches, update_samples):
+        """Load the samples, or write batches, in a single transaction."""
+        # Added before the session writes, which on SQLite would block adding them in a transaction of their own
+        self._contigs = self.db_adapter.contig_ids(self.gvcf_parser.contigs())
         session = self.db_adapter.get_session()
+        try:
+            if update_samples:
+                self._update_samples(session)
+                session.flush()
+            self._samples = self._sample_ids(session)
 
-        tot_inserted = 0
-        tot_updated = 0
-        for batch in self.gvcf_parser.parse_batch(self.batch_size):
-            (n_inserted, n_updated) = self._insert_batch(session, batch)
-            tot_inserted += n_inserted
-            tot_updated += n_updated
+            writer = None
+            parsed = None
+            if batches is None:
+                if self.contributions:
+                    writer = ContributionWriter(session, self._samples)
+                batches = parsed = self._parse_stats(on_batch=writer and writer.add)
+            try:
+                (tot_inserted, tot_updated) = self.write_batches(session, batches)
+            finally:
+                if parsed is not None:
+                    # Stops the reader thread if writing failed
+                    parsed.close()
+            
+            if writer is not None:
+                writer.flush()
+            
+            with self.metrics.timer('commit'):
+                session.commit()
+        finally:
+            # Rolls back if the load failed
+            session.close()
+        return (tot_inserted, tot_updated)
+
+    @contextlib.contextmanager
+    def _own_generation(self, operation):
+        """Run an operation as a generation of its own, unless the updater was given a generation."""
+        if self.generation is not None:
+            yield
+            return
+        # Added before the session writes, which on SQLite would block adding it
+        self.generation = start_generation(self.db_adapter, operation)
+        try:
+            yield
+        finally:
+            # The session of the operation is closed, so nothing more is written as this generation
+            finish_generation(self.db_adapter, self.generation)
+            self.generation = None
+
+    def _insert_checkpointed(self, resume):
+        """Load the samples with a commit and a checkpoint after every checkpoint_interval batches.
+
+        The samples are registered first. With resume set, the load continues
+        after the checkpoint of the samples, which must all share it.
+        """
+        self._contigs = self.db_adapter.contig_ids(self.gvcf_parser.contigs())
+        session = self.db_adapter.get_session()
+        if resume:
+            sample_ids = self._sample_ids(session)
+            progress = read_progress(session, list(sample_ids))
+            checkpoints = set(progress.values())
+            if len(progress) != len(sample_ids) or len(checkpoints) != 1:
+                session.close()
+                raise ValueError("The samples do not share an unfinished load that can be resumed")
+            (chr, pos) = checkpoints.pop()
+            if chr is not None:
+                logging.info(f"Resuming the load after {chr}:{pos}...")
+                self.gvcf_parser.skip_to(chr, pos)
+            # The generation of the interrupted load was left unfinished if its process was killed
+            finish_generations(session, resume_progress(session, list(sample_ids.values()), self.generation))
+        else:
+            self._update_samples(session)
+            session.flush()
+            sample_ids = self._sample_ids(session)
+            start_progress(session, list(sample_ids.values()), self.generation)
+            session.commit()
+        self._samples = sample_ids
+        ids = list(sample_ids.values())
         
-        self._update_samples(session)
+        writer = ContributionWriter(session, sample_ids, deferred=True) if self.contributions else None
+        def checkpoint(chr, pos):
+            if writer is not None:
+                writer.flush(chr, pos)
+            save_progress(session, ids, chr, pos)
+            with self.metrics.timer('commit'):
+                session.commit()
+            # Nothing read so far is needed again
+            session.expunge_all()
+        
+        try:
+            with contextlib.closing(self._parse_stats(on_batch=writer and writer.add, checkpoints=True)) as batches:
+                (tot_inserted, tot_updated) = self.write_batches(session, batches, on_checkpoint=checkpoint)
+            if writer is not None:
+                writer.flush()
+            clear_progress(session, ids)
+            with self.metrics.timer('commit'):
+                session.commit()
+        finally:
+            # Rolls back to the last checkpoint if the load failed
+            session.close()
+        return (tot_inserted, tot_updated)
+
+    def _parse_stats(self, on_batch=None, checkpoints=False):
+        """Parse the GVCF files into statistics batches, ahead of the writer with prefetch set."""
+        if not self.prefetch:
+            yield from timed(self.gvcf_parser.parse_stats(
+                self.batch_size, reference_blocks=self.reference_blocks, on_batch=on_batch, checkpoints=checkpoints
+            ), self.metrics, 'parse')
+            return
+        
+        # on_batch may write to the session, so it is called from the writer
+        observed = []
+        def read():
+            for item in self.gvcf_parser.parse_stats(
+                self.batch_size, reference_blocks=self.reference_blocks,
+                on_batch=observed.append if on_batch else None, checkpoints=checkpoints
+            ):
+                yield from map(_Observed, observed)
+                observed.clear()
+                yield item
         
+        with contextlib.closing(prefetch(read(), self.prefetch, self.metrics)) as items:
+            for item in items:
+                if isinstance(item, _Observed):
+                    on_batch(item.batch)
+                else:
+                    yield item
 
+    def register_samples(self):
+        """Add the samples to the samples table without writing any variants."""
+        session = self.db_adapter.get_session()
+        self._update_samples(session)
         session.commit()
         session.close()
+
+    def write_batches(self, session: Session, batches, on_checkpoint=None):
+        """Merge statistics batches into the database with the configured write mode.
+
+        batches can contain the Checkpoint markers of the parsers, with
+        on_checkpoint(chr, pos) called at the first marker after every
+        checkpoint_interval batches. The time spent fetching stored rows,
+        computing the merged statistics and committing is added to the fetch,
+        compute and commit stages of metrics, the rest of the time spent
+        writing to the write stage.
+        """
+        start = time.perf_counter()
+        nested = self._nested_seconds()
+        reading = StageTimings()
+        try:
+            return self._write_batches(session, timed(batches, reading, 'read'), on_checkpoint)
+        finally:
+            elapsed = time.perf_counter() - start - reading.seconds['read']
+            self.metrics.add('write', elapsed - (self._nested_seconds() - nested))
+    
+    def _nested_seconds(self):
+        return sum(self.metrics.seconds[stage] for stage in _NESTED_STAGES)
+
+    def _contig_id(self, session: Session, chr):
+        if chr not in self._contigs:
+            # Contigs missing from the header of the GVCF files
+            self._contigs.update(self.db_adapter.contig_ids([chr], session))
+        return self._contigs[chr]
+
+    def _write_batches(self, session: Session, batches, on_checkpoint):
+        if self.write_mode == 'copy':
+            n_written = self._copy_batches(session, batches)
+            self.metrics.count('written', n_written)
+            return (n_written, None)
+        
+        tot_inserted = 0
+        tot_updated = 0 if self.write_mode == 'orm' else None
+        since_checkpoint = 0
+        chr = None
+        for batch in batches:
+            if isinstance(batch, Checkpoint):
+                if on_checkpoint is not None and since_checkpoint >= self.checkpoint_interval:
+                    on_checkpoint(batch.chr, batch.pos)
+                    since_checkpoint = 0
+                continue
+            since_checkpoint += 1
+            if batch.chr != chr:
+                chr = batch.chr
+                contig_id = self._contig_id(session, chr)
+                self.db_adapter.ensure_partitions([chr])
+            start = time.perf_counter()
+            (n_inserted, n_updated) = self._write_batch(session, contig_id, batch)
+            if self.sizer is not None and batch.end is None:
+                # Only variant batches are measured, reference blocks are merged differently
+                self.sizer.observe(len(batch), time.perf_counter() - start)
+            tot_inserted += n_inserted
+            if tot_updated is not None:
+                tot_updated += n_updated
         return (tot_inserted, tot_updated)
 
-    def remove_sample(self):
+    def _write_batch(self, session: Session, contig_id, batch: StatsBatch):
+        """Merge one statistics batch into the database and return the number of inserted and updated variants."""
+        with self.metrics.timer('compute'):
+            batch = with_sample_ids(batch, self._samples)
+        if batch.end is not None:
+            self._merge_blocks(session, contig_id, batch)
+            self.metrics.count('blocks', len(batch))
+            return (0, 0)
+        if self.write_mode == 'upsert':
+            n_written = self._upsert_batch(session, contig_id, batch)
+            self.metrics.count('written', n_written)
+            return (n_written, 0)
+        (n_inserted, n_updated) = self._insert_batch(session, contig_id, batch)
+        self.metrics.count('inserted', n_inserted)
+        self.metrics.count('updated', n_updated)
+        return (n_inserted, n_updated)
+
+    def remove_sample(self, sample_name=None):
+        """Remove a sample, by default the sample of the GVCF parser, from the database.
+
+        If contributions of the sample are stored, they are subtracted instead
+        of parsing the GVCF file, and the statistics at the positions where the
+        sample held the min or max value are recomputed from the contributions
+        of the remaining samples. So are the min/max values of the reference
+        block intervals where it held them.
+
+        The time spent reading the batches is added to the parse stage of
+        metrics and the time spent writing is split like for loads.
+        """
+        with self._own_generation('remove'):
+            self._remove_sample(sample_name)
+
+    def _remove_sample(self, sample_name):
         session = self.db_adapter.get_session()
-        sample_name = self.gvcf_parser.get_sample_name()
-        sample = session.query(Sample).filter(Sample.name == sample_name).first()
-        if sample:
-            for batch in self.gvcf_parser.parse_batch(self.batch_size):
-                self._remove_batch(session, batch)
+        try:
+            if sample_name is None:
+                sample_name = self.gvcf_parser.get_sample_name()
+            sample = session.query(Sample).filter(Sample.name == sample_name).first()
+            if not sample:
+                raise ValueError(f"Sample '{sample_name}' not found in the database.")
             
+            stored = has_contributions(session, sample.id)
+            progress = read_progress(session, [sample_name]).get(sample_name)
+            if stored:
+                batches = read_contributions(session, sample.id, sample_name)
+            elif self.gvcf_parser is not None:
+                batches = self.gvcf_parser.parse_columnar(self.batch_size)
+                if progress is not None:
+                    # Only the records up to the checkpoint of an unfinished load were written
+                    batches = _truncate(batches, *progress)
+            else:
+                raise ValueError(f"No contributions are stored for sample '{sample_name}', its GVCF file is needed to remove it.")
+            # The min/max sample columns hold the id of the sample
+            batches = _relabel(batches, sample.id)
+            self._contigs = dict(session.execute(select(Contig.name, Contig.id)).all())
+            
+            lost_extremes = {}
+            lost_blocks = []
+            start = time.perf_counter()
+            nested = self._nested_seconds()
+            reading = StageTimings()
+            for batch in timed(batches, reading, 'parse'):
+                self.metrics.count('removed', len(batch))
+                contig_id = self._contigs.get(batch.chr)
+                if contig_id is None:
+                    # Nothing was stored on this contig
+                    continue
+                if self.reference_blocks:
+                    blocks, batch = batch.split_blocks()
+                    lost = self._subtract_blocks(session, contig_id, blocks)
+                    if lost is not None:
+                        lost_blocks.append((batch.chr, contig_id) + lost)
+                lost = self._remove_batch(session, contig_id, batch)
+                if lost is not None and len(lost):
+                    lost_extremes.setdefault(batch.chr, []).append(lost)
+            
+            if stored:
+                session.query(SampleContribution).filter(SampleContribution.sample_id == sample.id).delete(synchronize_session=False)
+                if self._all_contributions_stored(session, sample.id):
+                    for chr, positions in lost_extremes.items():
+                        self._recompute_positions(session, chr, self._contigs[chr], np.unique(np.concatenate(positions)))
+                    for chr, contig_id, first, last in lost_blocks:
+                        self._recompute_blocks(session, chr, contig_id, first, last)
+                elif lost_extremes or lost_blocks:
+                    logging.warning("Not all samples have stored contributions, min/max values held by the removed sample are left empty.")
+            
+            if progress is not None:
+                # The generation of the unfinished load was left open if its process was killed
+                finish_generations(session, progress_generations(session, [sample.id]))
+                clear_progress(session, [sample.id])
             session.delete(sample)
-            session.commit()
-            session.close()
-        else:
+            self.metrics.add('parse', reading.seconds['parse'])
+            self.metrics.add('write', time.perf_counter() - start - reading.seconds['parse'] - (self._nested_seconds() - nested))
+            with self.metrics.timer('commit'):
+                session.commit()
+        finally:
             session.close()
-            raise ValueError(f"Sample '{sample_name}' not found in the database.")
     
-    def _insert_batch(self, session: Session, batch: list[tuple]):
-        """Execute batch operations efficiently using SQLAlchemy bulk operations."""
-        # Extract unique positions for querying
-        positions = [(chr, pos) for chr, pos, _, _, _ in batch]
-        
-        # Fetch all existing records in one query
-        existing_records = session.query(Variant).filter(
-            tuple_(Variant.chr, Variant.pos).in_(positions)
-        ).all()
-        
-        existing_dict = {(record.chr, record.pos): record for record in existing_records}
+    def _insert_batch(self, session: Session, contig_id, batch: StatsBatch):
+        """Merge a batch with sample ids into the database using vectorized statistics updates."""
+        existing, loc, matched = self._fetch_existing(session, contig_id, batch.pos, for_update=True)
         
         # Prepare bulk inserts and updates
-        to_insert = []
-        to_update = []
-        
-        # Process all records in the batch
-        for chr, pos, non_ref_af, dp, sample_name in batch:
-            if (chr, pos) in existing_dict:
-                # Update existing record
-                variant = existing_dict[(chr, pos)]
-                
-                # Calculate new values
-                new_mean, new_sd, new_number = update_stats(
-                    variant.mean_non_ref_af, 
-                    variant.sd_non_ref_af, 
-                    variant.number_of_samples,
-                    non_ref_af,
-                    operation='add'
-                )
-                new_min = variant.min_non_ref_af
-                new_max = variant.max_non_ref_af
-                new_max_af_sample = variant.max_non_ref_af_sample
-                new_min_af_sample = variant.min_non_ref_af_sample
-                if non_ref_af > variant.max_non_ref_af:
-                    new_max = non_ref_af
-                    new_max_af_sample = sample_name
-                if non_ref_af < variant.min_non_ref_af:
-                    new_min = non_ref_af
-                    new_min_af_sample = sample_name
-        
-                new_depth = float(variant.total_depth) + float(dp)
-                
-                # Add to update list
-                to_update.append({
-                    'chr': chr,
-                    'pos': pos,
-                    'mean_non_ref_af': new_mean,
-                    'sd_non_ref_af': new_sd,
-                    'max_non_ref_af': new_max,
-                    'min_non_ref_af': new_min,
-                    'total_depth': new_depth,
-                    'number_of_samples': new_number,
-                    'max_non_ref_af_sample': new_min_af_sample,
-                    'min_non_ref_af_sample': new_max_af_sample,
-                })
-            else:
-                # Insert new record
-                to_insert.append({
-                    'chr': chr,
-                    'pos': pos,
-                    'mean_non_ref_af': float(non_ref_af),
-                    'sd_non_ref_af': float(non_ref_af),
-                    'max_non_ref_af': float(non_ref_af),
-                    'min_non_ref_af': float(non_ref_af),
-                    'total_depth': float(dp),
-                    'number_of_samples': 1,
-                    'max_non_ref_af_sample': sample_name,
-                    'min_non_ref_af_sample': sample_name
-                })
+        with self.metrics.timer('compute'):
+            to_insert = to_mappings(batch.take(~matched), contig_id, self.generation)
+            to_update = []
+            
+            if matched.any():
+                current = _to_stats_batch(batch.chr, existing, loc[matched])
+                to_update = to_mappings(current.merge(batch.take(matched)), contig_id, self.generation)
         
         # Perform bulk operations
         if to_insert:
-            session.bulk_insert_mappings(Variant, to_insert)
+            # Another load can have inserted some of these positions since they were
+            # fetched, except on SQLite with its single writer, the upsert merges those
+            dialect = session.get_bind().dialect.name
+            session.execute(_insert_variant if dialect == 'sqlite' else variants_upsert(dialect), to_insert)
         
         if to_update:
-            session.bulk_update_mappings(Variant, to_update)
+            _update_rows(session, to_update)
 
         return(len(to_insert), len(to_update))
 
-    def _remove_batch(self, session: Session, batch: list[tuple]):
-        """Execute batch operations efficiently using SQLAlchemy bulk operations."""
-        # Extract unique positions for querying
-        positions = [(chr, pos) for chr, pos, _, _, _ in batch]
-        
-        # Fetch all existing records in one query
-        existing_records = session.query(Variant).filter(
-            tuple_(Variant.chr, Variant.pos).in_(positions)
-        ).all()
-        
-        existing_dict = {(record.chr, record.pos): record for record in existing_records}
-        
-        # Prepare bulk updates and deletions
-        to_update = []
-        to_delete = []
-        
-        # Process all records in the batch
-        for chr, pos, non_ref_af, dp, sample_name in batch:
-            if (chr, pos) in existing_dict:
-                # Update existing record
-                variant = existing_dict[(chr, pos)]
-
-                # Calculate new values
-                new_mean, new_sd, new_number = update_stats(
-                    variant.mean_non_ref_af, 
-                    variant.sd_non_ref_af, 
-                    variant.number_of_samples,
-                    non_ref_af,
-                    operation='remove'
-                )
-                new_min = variant.min_non_ref_af
-                new_max = variant.max_non_ref_af
-                # if the removed sample happened to be the max or min, we lose the min max info
-                if variant.max_non_ref_af_sample == sample_name:
-                    new_max = None
-                    new_max_af_sample = None
-                if variant.min_non_ref_af_sample == sample_name:
-                    new_min = None
-                    new_min_af_sample = None
-        
-                new_depth = float(variant.total_depth) - float(dp)
-                
-                if new_number == 0:
-                    # Add to delete list
-                    to_delete.append(variant)
-                else:
-                    # Add to update list
-                    to_update.append({
-                        'chr': chr,
-                        'pos': pos,
-                        'mean_non_ref_af': new_mean,
-                        'sd_non_ref_af': new_sd,
-                        'max_non_ref_af': new_max,
-                        'min_non_ref_af': new_min,
-                        'total_depth': new_depth,
-                        'number_of_samples': new_number,
-                        'max_non_ref_af_sample': new_min_af_sample,
-                        'min_non_ref_af_sample': new_max_af_sample,
-                    })
+    def _upsert_batch(self, session: Session, contig_id, batch: StatsBatch):
+        """Merge a batch with sample ids into the database with a prepared dialect native upsert executed for all rows."""
+        with self.metrics.timer('compute'):
+            rows = to_mappings(batch, contig_id, self.generation)
+        session.execute(variants_upsert(session.get_bind().dialect.name), rows)
+        return len(rows)
+
+    def _copy_batches(self, session: Session, batches):
+        """Stream all batches into a staging table with COPY and merge them into variants in one statement."""
+        staging = staging_table()
+        staging.create(session.connection())
+        
+        columns = [column.name for column in staging.c]
+        contigs = []
+        def chunks():
+            for batch in batches:
+                if not contigs or contigs[-1] != batch.chr:
+                    contigs.append(batch.chr)
+                    contig_id = self._contig_id(session, batch.chr)
+                yield _to_copy_rows(with_sample_ids(batch, self._samples), contig_id, self.generation)
+        self.db_adapter.copy_from(session, staging.name, columns, chunks())
+        self.db_adapter.ensure_partitions(contigs)
+
+        # One statement cannot update a row twice, the parsers yield every position once
+        stmt = dialect_insert('postgresql')(Variant.__table__).from_select(columns, select(staging))
+        result = session.execute(upsert_statement('postgresql', stmt))
+        return result.rowcount
+
+    def _remove_batch(self, session: Session, contig_id, batch: VariantBatch):
+        """Subtract a batch labeled with the sample id from the database using vectorized statistics updates."""
+        chr = batch.chr
+        sample_id = batch.sample_name
+        if not len(batch):
+            return
+        
+        existing, loc, matched = self._fetch_existing(session, contig_id, batch.pos, for_update=True)
+        if not matched.any():
+            return
+        
+        with self.metrics.timer('compute'):
+            removed = batch.take(matched)
+            remaining = _to_stats_batch(chr, existing, loc[matched]).remove(
+                removed.non_ref_af.astype(np.float64),
+                removed.dp.astype(np.float64),
+                sample_id,
+            )
+            positions = remaining.pos
+            emptied = remaining.number_of_samples == 0
+            lost = (np.isnan(remaining.max_non_ref_af) | np.isnan(remaining.min_non_ref_af)) & ~emptied
+            to_update = to_mappings(remaining.take(~emptied), contig_id, self.generation)
+        self.metrics.count('updated', len(to_update))
+        self.metrics.count('deleted', emptied.sum())
         
         # Perform bulk operations
         if to_update:
-            session.bulk_update_mappings(Variant, to_update)
+            _update_rows(session, to_update)
+        
+        if emptied.any():
+            session.query(Variant).filter(
+                Variant.contig_id == contig_id,
+                Variant.pos.in_(positions[emptied].tolist())
+            ).delete(synchronize_session=False)
+            record_tombstones(session, contig_id, positions[emptied].tolist(), self.generation)
         
-        if to_delete:
-            for variant in to_delete:
-                session.delete(variant)
+        return positions[lost]
     
-    def _update_samples(self, session: Session):
-        """Update the samples table with the sample information."""
-        sample_name = self.gvcf_parser.get_sample_name()
-        gvcf_path = self.gvcf_parser.gvcf_file
+    def _fetch_existing(self, session: Session, contig_id, pos, for_update=False):
+        """Fetch the stored statistics for positions on one contig as arrays.
+
+        Returns a dict of columns, the row index of each position in those
+        columns and a boolean mask of the positions that exist. With
+        for_update set, the rows are locked until the transaction ends
+        (ignored on SQLite).
+        """
+        # All positions share one chromosome, so a plain IN on pos suffices
+        query = session.query(*[getattr(Variant, column) for column in _STAT_COLUMNS]).filter(
+            Variant.contig_id == contig_id,
+            Variant.pos.in_(pos.tolist())
+        )
+        if for_update:
+            query = query.with_for_update()
+        with self.metrics.timer('fetch'):
+            existing_records = query.all()
         
-        # Check if the sample already exists
-        existing_sample = session.query(Sample).filter(Sample.name == sample_name).first()
+        if not existing_records:
+            return {}, np.zeros(len(pos), dtype=np.intp), np.zeros(len(pos), dtype=bool)
         
-        if existing_sample:
-            # Update the existing sample record
-            existing_sample.gvcf_path = gvcf_path
-        else:
-            # Insert a new sample record
-            new_sample = Sample(name=sample_name, gvcf_path=gvcf_path)
-            session.add(new_sample)
+        existing = _to_arrays(existing_records, _STAT_COLUMNS)
+        existing_pos = existing['pos']
+        sorter = np.argsort(existing_pos)
+        idx = np.searchsorted(existing_pos, pos, sorter=sorter)
+        loc = sorter[np.minimum(idx, len(existing_pos) - 1)]
+        matched = existing_pos[loc] == pos
+        return existing, loc, matched
+    
+    def _all_contributions_stored(self, session: Session, removed_sample_id):
+        """Check whether every sample but the removed one has stored contributions."""
+        stored = select(SampleContribution.sample_id).where(SampleContribution.sample_id == Sample.id).exists()
+        return session.query(Sample.id).filter(Sample.id != removed_sample_id, ~stored).first() is None
+    
+    def _recompute_positions(self, session: Session, chr, contig_id, positions):
+        """Recompute the statistics at sorted positions on chr from the stored contributions."""
+        batches = read_overlapping(session, chr, int(positions[0]), int(positions[-1]))
+        if self.reference_blocks:
+            batches = (batch.split_blocks()[1] for batch in batches)
+        stats = recompute_stats(batches, positions)
+        covered = stats['number_of_samples'] > 0
+        rows = to_mappings(StatsBatch(chr, *[stats[column][covered] for column in _STAT_COLUMNS]), contig_id, self.generation)
+        if rows:
+            _update_rows(session, rows)
+    
+    def _sample_ids(self, session: Session):
+        """Look up the ids of the samples of the GVCF parser by name."""
+        names = [sample_name for sample_name, _ in self.gvcf_parser.samples()]
+        sample_ids = dict(session.query(Sample.name, Sample.id).filter(Sample.name.in_(names)).all())
+        missing = [name for name in names if name not in sample_ids]
+        if missing:
+            raise ValueError(f"Samples {', '.join(missing)} must be in the samples table before their variants are written")
+        return sample_ids
+    
+    def _merge_blocks(self, session: Session, contig_id, batch: StatsBatch):
+        """Merge a batch of reference blocks with sample ids into the stored intervals they overlap."""
+        self.db_adapter.lock_contig(session, contig_id)
+        existing = self._fetch_blocks(session, contig_id, batch.chr, int(batch.pos[0]), int(batch.end[-1]))
+        merged = merge_intervals(existing, batch)
+        self._replace_blocks(session, contig_id, existing, merged)
+    
+    def _subtract_blocks(self, session: Session, contig_id, blocks: VariantBatch):
+        """Remove the reference blocks of a sample, labeled with its id, from the stored intervals they overlap.
+
+        Returns the first and last position of the intervals where the sample
+        held the min or max value, or None if it held none.
+        """
+        if not len(blocks):
+            return None
+        self.db_adapter.lock_contig(session, contig_id)
+        existing = self._fetch_blocks(session, contig_id, blocks.chr, int(blocks.pos[0]), int(blocks.end[-1]))
+        remaining = subtract_intervals(existing, blocks)
+        self._replace_blocks(session, contig_id, existing, remaining)
+        lost = np.isnan(remaining.max_non_ref_af) | np.isnan(remaining.min_non_ref_af)
+        if not lost.any():
+            return None
+        return int(remaining.pos[lost][0]), int(remaining.end[lost][-1])
+    
+    def _recompute_blocks(self, session: Session, chr, contig_id, first, last):
+        """Recompute the missing min/max values of the intervals from first to last from the stored contributions."""
+        existing = self._fetch_blocks(session, contig_id, chr, first, last)
+        batches = (batch.split_blocks()[0] for batch in read_overlapping(session, chr, first, last))
+        self._replace_blocks(session, contig_id, existing, recompute_extremes(existing, batches))
+    
+    def _fetch_blocks(self, session: Session, contig_id, chr, start, end):
+        """Fetch the stored intervals on a contig overlapping start to end as a StatsBatch."""
+        columns = ('pos', 'end') + _STAT_COLUMNS[1:]
+        stmt = self.db_adapter.reference_blocks_statement(contig_id, start, end).with_only_columns(
+            ReferenceBlock.start,
+            *[getattr(ReferenceBlock, column) for column in columns[1:]]
+        )
+        with self.metrics.timer('fetch'):
+            rows = session.execute(stmt).all()
+        return _to_stats_batch(chr, _to_arrays(rows, columns))
+    
+    def _replace_blocks(self, session: Session, contig_id, existing: StatsBatch, blocks: StatsBatch):
+        """Replace the fetched intervals with their updated version."""
+        if len(existing):
+            # The fetched intervals are all stored intervals starting in this range
+            session.query(ReferenceBlock).filter(
+                ReferenceBlock.contig_id == contig_id,
+                ReferenceBlock.start.between(int(existing.pos[0]), int(existing.pos[-1]))
+            ).delete(synchronize_session=False)
+        if len(blocks):
+            session.execute(ReferenceBlock.__table__.insert(), _to_block_mappings(blocks, contig_id))
+    
+    def _update_samples(self, session: Session):
+        """Update the samples table with the sample information."""
+        targets = self.gvcf_parser.targets
+        targets_path = None if targets is None or targets.path is None else os.path.abspath(targets.path)
+        for sample_name, gvcf_path in self.gvcf_parser.samples():
+            # Check if the sample already exists
+            existing_sample = session.query(Sample).filter(Sample.name == sample_name).first()
+            
+            if existing_sample:
+                # Update the existing sample record
+                existing_sample.gvcf_path = gvcf_path
+                existing_sample.targets_path = targets_path
+            else:
+                # Insert a new sample record
+                new_sample = Sample(name=sample_name, gvcf_path=gvcf_path, targets_path=targets_path)
+                session.add(new_sample)
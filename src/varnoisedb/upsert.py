@@ -0,0 +1,98 @@
+"""
+This module builds dialect-native upsert statements for the variants table.
+The statistics merge is written as SQL expressions so that a batch can be
+written in one statement without reading the existing rows first.
+"""
+
+import functools
+import importlib
+from sqlalchemy import case, func
+
+from varnoisedb.models import Variant, VariantTombstone
+
+# Imported on first use, so that only the dialect of the configured database is imported
+_INSERT_MODULES = {
+    'sqlite': 'sqlalchemy.dialects.sqlite',
+    'postgresql': 'sqlalchemy.dialects.postgresql',
+    'mysql': 'sqlalchemy.dialects.mysql',
+}
+
+def dialect_insert(dialect_name):
+    """Return the dialect specific insert construct supporting upserts."""
+    try:
+        module = _INSERT_MODULES[dialect_name]
+    except KeyError:
+        raise ValueError(f"Upserts are not supported for database type: {dialect_name}")
+    return importlib.import_module(module).insert
+
+def merged_stats(current, incoming):
+    """Build the SQL expressions merging incoming statistics into the current row.
+
+    Both arguments are column collections of the variants table. The moments
+    are combined with the pairwise update of Chan et al., which reduces to
+    Welford's update when the incoming row holds a single sample. The result is
+    an ordered list of (column, expression) pairs: MySQL evaluates the
+    assignments of ON DUPLICATE KEY UPDATE left to right, using already updated
+    values, so every column is assigned only after the columns that read its
+    old value.
+    """
+    n_a = current.number_of_samples
+    n_b = incoming.number_of_samples
+    n = n_a + n_b
+    delta = incoming.mean_non_ref_af - current.mean_non_ref_af
+    m2 = (
+        current.sd_non_ref_af * current.sd_non_ref_af * n_a
+        + incoming.sd_non_ref_af * incoming.sd_non_ref_af * n_b
+        + delta * delta * n_a * n_b / n
+    )
+    # Floating point drift can leave tiny negative sums of squares
+    sd = case((m2 > 0, func.sqrt(m2 / n)), else_=0.0)
+    mean = current.mean_non_ref_af + delta * n_b / n
+
+    # NULL min/max values are left behind by removals and are always replaced
+    is_new_max = current.max_non_ref_af.is_(None) | (incoming.max_non_ref_af > current.max_non_ref_af)
+    is_new_min = current.min_non_ref_af.is_(None) | (incoming.min_non_ref_af < current.min_non_ref_af)
+
+    return [
+        ('sd_non_ref_af', sd),
+        ('mean_non_ref_af', mean),
+        ('max_non_ref_af_sample', case((is_new_max, incoming.max_non_ref_af_sample), else_=current.max_non_ref_af_sample)),
+        ('max_non_ref_af', case((is_new_max, incoming.max_non_ref_af), else_=current.max_non_ref_af)),
+        ('min_non_ref_af_sample', case((is_new_min, incoming.min_non_ref_af_sample), else_=current.min_non_ref_af_sample)),
+        ('min_non_ref_af', case((is_new_min, incoming.min_non_ref_af), else_=current.min_non_ref_af)),
+        ('total_depth', current.total_depth + incoming.total_depth),
+        ('number_of_samples', n),
+    ]
+
+def upsert_statement(dialect_name, stmt, table=Variant.__table__):
+    """Add the statistics merge as conflict handling to an insert into variants, or a table with its columns.
+
+    stmt must be an insert into table created with dialect_insert(dialect_name),
+    with its rows given either as values or as a select. The generation of
+    the incoming row replaces the stored one.
+    """
+    if dialect_name == 'mysql':
+        return stmt.on_duplicate_key_update(merged_stats(table.c, stmt.inserted) + [('generation', stmt.inserted.generation)])
+    return stmt.on_conflict_do_update(
+        index_elements=[table.c.contig_id, table.c.pos],
+        set_=dict(merged_stats(table.c, stmt.excluded), generation=stmt.excluded.generation),
+    )
+
+@functools.lru_cache(maxsize=None)
+def variants_upsert(dialect_name):
+    """Return the upsert into variants without values, to be executed with a list of rows (executemany).
+
+    The statement is built once per dialect so that its compiled form is reused.
+    """
+    return upsert_statement(dialect_name, dialect_insert(dialect_name)(Variant.__table__))
+
+@functools.lru_cache(maxsize=None)
+def tombstones_upsert(dialect_name):
+    """Return the upsert into variant_tombstones without values, replacing the generation of existing tombstones."""
+    stmt = dialect_insert(dialect_name)(VariantTombstone.__table__)
+    if dialect_name == 'mysql':
+        return stmt.on_duplicate_key_update(generation=stmt.inserted.generation)
+    return stmt.on_conflict_do_update(
+        index_elements=[VariantTombstone.contig_id, VariantTombstone.pos],
+        set_={'generation': stmt.excluded.generation},
+    )
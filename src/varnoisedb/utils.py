@@ -20,47 +20,70 @@ def update_stats(mean, std_dev, n, new_val, operation='add'):
     elif operation == 'remove':
         var = std_dev ** 2 * n
         delta = new_val - mean
-        mean -= delta / n
+        mean -= delta / (n - 1)
         delta2 = new_val - mean
         var -= delta * delta2
         n -= 1
     
-    std_dev = math.sqrt(var / n) if n > 0 else 0
+    std_dev = math.sqrt(max(var, 0) / n) if n > 0 else 0
     return mean, std_dev, n
 
 def update_multiple_stats(means, std_devs, ns, new_vals, operation='add'):
+    """Vectorized version of update_stats.
+
+    Adds or removes one value per position and returns new arrays of means,
+    standard deviations and counts. Positions whose count drops to zero get a
+    mean and standard deviation of 0.
+    """
     if operation not in ['add', 'remove']:
         raise ValueError("Operation must be 'add' or 'remove'")
     
-    means = np.array(means)
-    std_devs = np.array(std_devs)
-    ns = np.array(ns)
-    new_vals = np.array(new_vals)
+    means = np.asarray(means, dtype=np.float64)
+    std_devs = np.asarray(std_devs, dtype=np.float64)
+    ns = np.asarray(ns, dtype=np.int64)
+    new_vals = np.asarray(new_vals, dtype=np.float64)
+    
+    # Sum of squared differences from the mean (M2 in Welford's algorithm)
+    m2s = std_devs ** 2 * ns
+    deltas = new_vals - means
     
     if operation == 'add':
-        mask = ns == 0
-        means[mask] = new_vals[mask]
-        std_devs[mask] = 0
-        ns[mask] = 1
-        
-        ns[~mask] += 1
-        vars = std_devs[~mask] ** 2 * (ns[~mask] - 1)
-        deltas = new_vals[~mask] - means[~mask]
-        means[~mask] += deltas / ns[~mask]
-        delta2s = new_vals[~mask] - means[~mask]
-        vars += deltas * delta2s
+        ns = ns + 1
+        means = means + deltas / ns
+        m2s = m2s + deltas * (new_vals - means)
     elif operation == 'remove':
-        mask = ns == 1
-        means[mask] = 0
-        std_devs[mask] = 0
-        ns[mask] = 0
-        
-        ns[~mask] -= 1
-        vars = std_devs[~mask] ** 2 * (ns[~mask] + 1)
-        deltas = new_vals[~mask] - means[~mask]
-        means[~mask] -= deltas / (ns[~mask] + 1)
-        delta2s = new_vals[~mask] - means[~mask]
-        vars -= deltas * delta2s
+        ns = ns - 1
+        empty = ns <= 0
+        means = np.where(empty, 0.0, means - deltas / np.where(empty, 1, ns))
+        m2s = np.where(empty, 0.0, m2s - deltas * (new_vals - means))
+        ns = np.where(empty, 0, ns)
+    
+    # Floating point drift can leave tiny negative variances
+    variances = np.divide(m2s, ns, out=np.zeros_like(m2s), where=ns > 0)
+    std_devs = np.sqrt(np.clip(variances, 0, None))
+    return means, std_devs, ns
+
+
+def combine_stats(means_a, std_devs_a, ns_a, means_b, std_devs_b, ns_b):
+    """Combine two sets of per-position statistics into one.
+
+    Uses the pairwise update of Chan et al., so each side may summarise any
+    number of values, including none. Returns arrays of the combined means,
+    standard deviations and counts.
+    """
+    means_a = np.asarray(means_a, dtype=np.float64)
+    means_b = np.asarray(means_b, dtype=np.float64)
+    std_devs_a = np.asarray(std_devs_a, dtype=np.float64)
+    std_devs_b = np.asarray(std_devs_b, dtype=np.float64)
+    ns_a = np.asarray(ns_a, dtype=np.int64)
+    ns_b = np.asarray(ns_b, dtype=np.int64)
+    
+    ns = ns_a + ns_b
+    safe_ns = np.where(ns > 0, ns, 1)
+    deltas = means_b - means_a
+    means = means_a + deltas * ns_b / safe_ns
+    m2s = std_devs_a ** 2 * ns_a + std_devs_b ** 2 * ns_b + deltas ** 2 * ns_a * ns_b / safe_ns
     
-    std_devs = np.sqrt(vars / ns) if np.any(ns > 0) else np.zeros_like(std_devs)
-    return means, std_devs, ns
\ No newline at end of file
+    variances = np.where(ns > 0, m2s / safe_ns, 0.0)
+    std_devs = np.sqrt(np.clip(variances, 0, None))
+    return means, std_devs, ns
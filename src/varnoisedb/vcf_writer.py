@@ -0,0 +1,295 @@
+"""
+This module writes the variants table as VCF. Rows are streamed from the
+database in chunks and formatted a chunk at a time, so memory use does not
+depend on the size of the database. Gzipped output is written as BGZF with a
+tabix index next to it, so that it can be queried by region.
+
+Every export records in its header the generation of the database it covers,
+see varnoisedb.generations. A delta export holds only the changes after an
+earlier generation, with deleted positions as records with the DELETED
+filter, and is applied to an earlier export with patch_vcf.
+"""
+
+import bisect
+import gzip
+import heapq
+import itertools
+import logging
+import os
+import numpy as np
+from sqlalchemy import func, select
+
+from varnoisedb.bgzf import BgzfWriter, MIN_SHIFT, TabixIndex
+from varnoisedb.generations import check_since, deleted_statement, exported_generation, open_generations
+from varnoisedb.metrics import Metrics
+from varnoisedb.models import Contig, Variant
+from varnoisedb.pipeline import timed
+
+# The INFO fields written for every variant, as (ID, Number, Type, Description)
+INFO_FIELDS = [
+    ('MEAN_AF', '1', 'Float', 'Mean non-reference allele frequency'),
+    ('SD_AF', '1', 'Float', 'Standard deviation of non-reference allele frequency'),
+    ('MAX_AF', '1', 'Float', 'Maximum non-reference allele frequency'),
+    ('MIN_AF', '1', 'Float', 'Minimum non-reference allele frequency'),
+    ('DEPTH', '1', 'Float', 'Total sequencing depth'),
+    ('SAMPLES', '1', 'Integer', 'Number of samples'),
+]
+
+_RECORD_FORMAT = (
+    "%s\t%d\t.\tN\t<NON_REF>\t.\tPASS\t"
+    "MEAN_AF=%.6f;MAX_AF=%.6f;SD_AF=%.6f;MIN_AF=%.6f;DEPTH=%.1f;SAMPLES=%d\n"
+)
+
+# A position deleted after the generation a delta export starts from
+_DELETED_FORMAT = "%s\t%d\t.\tN\t<NON_REF>\t.\tDELETED\t.\n"
+
+_GENERATION_HEADER = '##varnoisedb_generation='
+_SINCE_HEADER = '##varnoisedb_since='
+
+def info_header_lines(fields=INFO_FIELDS):
+    """Return the ##INFO header lines for (ID, Number, Type, Description) tuples."""
+    return [
+        f'##INFO=<ID={id},Number={number},Type={type},Description="{description}">\n'
+        for id, number, type, description in fields
+    ]
+
+def vcf_header(contigs=(), generation=None, since=None):
+    """Return the VCF header, with ##contig lines for contigs in their sort order and the generation of the export.
+
+    The header of a delta export also records the generation it starts from
+    and declares the DELETED filter.
+    """
+    lines = ["##fileformat=VCFv4.2\n"]
+    if generation is not None:
+        lines.append(f"{_GENERATION_HEADER}{generation}\n")
+    if since is not None:
+        lines.append(f"{_SINCE_HEADER}{since}\n")
+        lines.append(f'##FILTER=<ID=DELETED,Description="Deleted after generation {since}">\n')
+    lines += [f"##contig=<ID={name}>\n" for name in contigs]
+    return ''.join(lines) + ''.join(info_header_lines()) + "#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n"
+
+def variants_statement(contig_ids=None):
+    """Select the exported columns of all variants, or those on the contigs with contig_ids, with missing values as 0.
+
+    The variants are ordered by contig id and position, so the contigs come in
+    the order they were first loaded.
+    """
+    stmt = select(
+        Variant.contig_id,
+        Variant.pos,
+        func.coalesce(Variant.mean_non_ref_af, 0.0),
+        func.coalesce(Variant.max_non_ref_af, 0.0),
+        func.coalesce(Variant.sd_non_ref_af, 0.0),
+        func.coalesce(Variant.min_non_ref_af, 0.0),
+        func.coalesce(Variant.total_depth, 0.0),
+        func.coalesce(Variant.number_of_samples, 0),
+    ).order_by(Variant.contig_id, Variant.pos)
+    if contig_ids is not None:
+        # On a table partitioned by contig, only the partitions of these contigs are read
+        stmt = stmt.where(Variant.contig_id.in_(contig_ids))
+    return stmt
+
+def is_bgzf_path(path):
+    return path.endswith('.gz')
+
+def _index_chunk(index, rows, lines, data_offset):
+    """Add a chunk of written records to the index, one entry per run of records in the same tabix window."""
+    if not rows:
+        return
+    chrs = np.array([row[0] for row in rows], dtype=object)
+    pos = np.fromiter((row[1] for row in rows), dtype=np.int64, count=len(rows))
+    ends = data_offset + np.cumsum(np.fromiter(map(len, lines), dtype=np.int64, count=len(lines)))
+    starts = np.concatenate(([data_offset], ends[:-1]))
+
+    windows = (pos - 1) >> MIN_SHIFT
+    first = np.flatnonzero(np.concatenate(([True], (chrs[1:] != chrs[:-1]) | (windows[1:] != windows[:-1]))))
+    last = np.concatenate((first[1:] - 1, [len(rows) - 1]))
+    for i, j in zip(first.tolist(), last.tolist()):
+        index.add(chrs[i], int(pos[i]) - 1, int(pos[j]), int(starts[i]), int(ends[j]))
+
+def _with_deleted(rows, deleted, since_index, last=False):
+    """Merge the deleted positions up to the last of the rows, or all remaining with last set, into the rows.
+
+    deleted is the sorted list of (contig_id, pos) tuples of the deleted
+    positions, of which those from since_index on are not written yet.
+    Returns the merged rows and the index of the first deleted position not
+    merged.
+    """
+    end = len(deleted) if last else bisect.bisect_right(deleted, (rows[-1][0], rows[-1][1]))
+    merged = list(heapq.merge(rows, deleted[since_index:end], key=lambda row: (row[0], row[1])))
+    return merged, end
+
+def write_vcf(session, output, chunk_size=10000, contigs=None, metrics=None, since=None):
+    """Stream all variants, or those on contigs, to a VCF file and return the number of written variants.
+
+    Rows are fetched chunk_size at a time through a server-side cursor where
+    the database supports it. If output ends with .gz it is written as BGZF
+    and indexed with tabix as output + '.tbi'. The time spent fetching,
+    formatting and writing is added to the fetch, format and write stages of
+    metrics.
+
+    The header records the generation the export covers. With since, only
+    the variants changed after that generation are written, together with
+    the positions deleted after it, which are counted as deleted in metrics.
+    Raises SinceError, a ValueError, if the changes after since cannot be
+    exported.
+    """
+    if metrics is None:
+        metrics = Metrics()
+    # Taken before any row is read, changes of later generations are exported again next time
+    generation = exported_generation(session)
+    for id, operation, started in open_generations(session):
+        logging.warning(f"Generation {id} ({operation}, started {started}) has not finished, the changes after "
+                        f"generation {generation} are left to a later export")
+    if since is not None:
+        check_since(session, since, generation)
+        logging.info(f"Exporting the changes after generation {since} up to generation {generation}")
+    else:
+        logging.info(f"Exporting the variants up to generation {generation}")
+    bgzf = is_bgzf_path(output)
+    names = dict(sorted(session.execute(select(Contig.id, Contig.name)).all()))
+    contig_ids = [id for id, name in names.items() if name in contigs] if contigs else None
+    stmt = variants_statement(contig_ids)
+    deleted = None
+    if since is not None:
+        stmt = stmt.where(Variant.generation > since)
+        # Read in full, as MySQL streams only one result per connection at a time
+        with metrics.timer('fetch'):
+            deleted = [tuple(row) for row in session.execute(deleted_statement(since, contig_ids))]
+        metrics.count('deleted', len(deleted))
+    index = TabixIndex() if bgzf else None
+    file = BgzfWriter(output) if bgzf else open(output, 'wb')
+
+    def write(rows):
+        with metrics.timer('format'):
+            rows = [(names[row[0]],) + tuple(row[1:]) for row in rows]
+            lines = [((_RECORD_FORMAT if len(row) > 2 else _DELETED_FORMAT) % row).encode() for row in rows]
+            if bgzf:
+                _index_chunk(index, rows, lines, file.data_offset())
+        with metrics.timer('write'):
+            file.write(b''.join(lines))
+
+    n_variants = 0
+    with file:
+        file.write(vcf_header(names.values(), generation, since).encode())
+        with metrics.timer('fetch'):
+            result = session.execute(stmt.execution_options(yield_per=chunk_size))
+        n_merged = 0
+        for rows in timed(result.partitions(), metrics, 'fetch'):
+            n_variants += len(rows)
+            if deleted:
+                (rows, n_merged) = _with_deleted(rows, deleted, n_merged)
+            write(rows)
+        if deleted and n_merged < len(deleted):
+            write(_with_deleted([], deleted, n_merged, last=True)[0])
+
+    if bgzf:
+        with metrics.timer('write'):
+            index.write(output + '.tbi', file)
+    metrics.count('exported', n_variants)
+    return n_variants
+
+def _open_vcf(path):
+    return gzip.open(path, 'rb') if is_bgzf_path(path) else open(path, 'rb')
+
+def _read_header(file):
+    """Read the header of a VCF file written by write_vcf.
+
+    Returns the generation and since of the header, None where missing, its
+    contigs and an iterator over the record lines.
+    """
+    generation = since = None
+    contigs = []
+    for line in file:
+        if not line.startswith(b'#'):
+            return generation, since, contigs, itertools.chain([line], file)
+        text = line.decode().rstrip('\n')
+        if text.startswith(_GENERATION_HEADER):
+            generation = int(text[len(_GENERATION_HEADER):])
+        elif text.startswith(_SINCE_HEADER):
+            since = int(text[len(_SINCE_HEADER):])
+        elif text.startswith('##contig=<ID='):
+            contigs.append(text[len('##contig=<ID='):].split(',')[0].rstrip('>'))
+    return generation, since, contigs, iter(())
+
+def _keyed(records, order, path):
+    """Yield the sort key, contig, position and line of every record line."""
+    for line in records:
+        (chr, pos, _) = line.split(b'\t', 2)
+        if chr not in order:
+            raise ValueError(f"Contig {chr.decode()} of {path} is not in the header of the delta export")
+        pos = int(pos)
+        yield (order[chr], pos), chr, pos, line
+
+def _is_deleted(line):
+    return line.split(b'\t', 7)[6] == b'DELETED'
+
+def patch_vcf(base, delta, output, chunk_size=10000):
+    """Apply the delta export delta to the earlier export base and write the result to output.
+
+    Both files must have been written by write_vcf, delta with since at most
+    the generation of base. The records of base are copied unchanged, except
+    at the positions in delta, which replace them or, with the DELETED
+    filter, remove them. The result is the export at the generation of
+    delta, BGZF compressed and indexed if output ends with .gz. No database
+    is needed. Returns the number of written records, the number of records
+    taken from delta and the number of deleted positions.
+    """
+    if os.path.abspath(output) in (os.path.abspath(base), os.path.abspath(delta)):
+        raise ValueError("The patched export must be written to a new file")
+    with _open_vcf(base) as base_file, _open_vcf(delta) as delta_file:
+        (base_generation, _, _, base_records) = _read_header(base_file)
+        (generation, since, contigs, delta_records) = _read_header(delta_file)
+        if base_generation is None:
+            raise ValueError(f"{base} has no generation in its header, export the variants again")
+        if since is None:
+            raise ValueError(f"{delta} is not a delta export, export it with --since")
+        if since > base_generation:
+            raise ValueError(f"{delta} holds the changes after generation {since}, but {base} is at generation {base_generation}")
+        if base_generation > generation:
+            raise ValueError(f"{base} is at generation {base_generation}, after the generation {generation} of {delta}")
+
+        order = {name.encode(): i for i, name in enumerate(contigs)}
+        names = {name.encode(): name for name in contigs}
+        base_records = _keyed(base_records, order, base)
+        delta_records = _keyed(delta_records, order, delta)
+        bgzf = is_bgzf_path(output)
+        index = TabixIndex() if bgzf else None
+        out = BgzfWriter(output) if bgzf else open(output, 'wb')
+        rows = []
+        lines = []
+        def flush():
+            if bgzf:
+                _index_chunk(index, rows, lines, out.data_offset())
+            out.write(b''.join(lines))
+            rows.clear()
+            lines.clear()
+
+        n_written = n_changed = n_deleted = 0
+        with out:
+            out.write(vcf_header(contigs, generation).encode())
+            b = next(base_records, None)
+            d = next(delta_records, None)
+            while b is not None or d is not None:
+                if d is None or (b is not None and b[0] < d[0]):
+                    record = b
+                    b = next(base_records, None)
+                else:
+                    if b is not None and b[0] == d[0]:
+                        b = next(base_records, None)
+                    record = d
+                    d = next(delta_records, None)
+                    if _is_deleted(record[3]):
+                        n_deleted += 1
+                        continue
+                    n_changed += 1
+                rows.append((names[record[1]], record[2]))
+                lines.append(record[3])
+                if len(lines) >= chunk_size:
+                    n_written += len(lines)
+                    flush()
+            n_written += len(lines)
+            flush()
+    if bgzf:
+        index.write(output + '.tbi', out)
+    return n_written, n_changed, n_deleted
@@ -0,0 +1,90 @@
+"""
+Shared fixtures of the VarNoiseDB tests.
+"""
+
+import os
+import pytest
+from sqlalchemy.engine import make_url
+
+from varnoisedb.bgzf import BgzfWriter, TabixIndex
+from varnoisedb.database import DatabaseAdapter
+from varnoisedb.models import Base
+
+# The tests needing PostgreSQL are skipped unless this holds the URL of a database they may empty
+POSTGRESQL_URL = os.environ.get('VARNOISEDB_TEST_POSTGRESQL_URL')
+
+GVCF_HEADER = """##fileformat=VCFv4.2
+##contig=<ID=chr1,length=248956422>
+##contig=<ID=chr2,length=242193529>
+##INFO=<ID=END,Number=1,Type=Integer,Description="End position of the reference block">
+##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">
+##FORMAT=<ID=DP,Number=1,Type=Integer,Description="Read Depth">
+##FORMAT=<ID=AD,Number=R,Type=Integer,Description="Allelic Depths">
+#CHROM	POS	ID	REF	ALT	QUAL	FILTER	INFO	FORMAT	{sample}
+"""
+
+@pytest.fixture
+def db_path(tmp_path):
+    return str(tmp_path / 'variants.db')
+
+@pytest.fixture
+def db_adapter(db_path):
+    """An initialized SQLite database."""
+    db_adapter = DatabaseAdapter(db_type='sqlite', db_name=db_path)
+    db_adapter.create_tables()
+    yield db_adapter
+    db_adapter.close()
+
+@pytest.fixture
+def pg_adapter():
+    """An initialized PostgreSQL database, emptied after the test."""
+    if not POSTGRESQL_URL:
+        pytest.skip("VARNOISEDB_TEST_POSTGRESQL_URL is not set")
+    url = make_url(POSTGRESQL_URL)
+    db_adapter = DatabaseAdapter(
+        db_type='postgresql', db_name=url.database, host=url.host, port=url.port, user=url.username, password=url.password
+    )
+    Base.metadata.drop_all(db_adapter.engine)
+    db_adapter.create_tables()
+    yield db_adapter
+    Base.metadata.drop_all(db_adapter.engine)
+    db_adapter.close()
+
+@pytest.fixture
+def write_gvcf(tmp_path):
+    """Write a GVCF file of one sample and return its path.
+
+    records are (chr, pos, non_ref_ad, dp) tuples, or (chr, pos, non_ref_ad,
+    dp, end) for reference blocks, in file order.
+    """
+    def write(sample, records):
+        path = tmp_path / f'{sample}.g.vcf'
+        lines = [GVCF_HEADER.format(sample=sample)]
+        for chr, pos, non_ref_ad, dp, *end in records:
+            info = f'END={end[0]}' if end else '.'
+            lines.append(f'{chr}\t{pos}\t.\tA\t<NON_REF>\t.\t.\t{info}\tGT:DP:AD\t0/0:{dp}:{dp - non_ref_ad},{non_ref_ad}\n')
+        path.write_text(''.join(lines))
+        return str(path)
+    return write
+
+@pytest.fixture
+def bgzip():
+    """Compress a GVCF file written by write_gvcf with BGZF, index it with tabix and return the path of the copy.
+
+    The index covers reference blocks up to their END.
+    """
+    def compress(path):
+        output = path + '.gz'
+        index = TabixIndex()
+        with open(path) as file, BgzfWriter(output) as writer:
+            for line in file:
+                start = writer.data_offset()
+                writer.write(line)
+                if not line.startswith('#'):
+                    fields = line.split('\t')
+                    pos = int(fields[1])
+                    end = int(fields[7][len('END='):]) if fields[7].startswith('END=') else pos
+                    index.add(fields[0], pos - 1, end, start, writer.data_offset())
+        index.write(output + '.tbi', writer)
+        return output
+    return compress
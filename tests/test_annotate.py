@@ -0,0 +1,91 @@
+"""
+Unit tests for the annotate module.
+"""
+
+import pytest
+from cyvcf2 import VCF
+
+from varnoisedb.annotate import annotate_vcf
+from varnoisedb.gvcf_parser import GVCFParser
+from varnoisedb.snapshot import Snapshot, write_snapshot
+from varnoisedb.updater import Updater
+
+SAMPLES = {
+    'A': [('chr1', 100, 1, 10), ('chr1', 200, 2, 10), ('chr1', 5000, 1, 10), ('chr2', 50, 3, 10)],
+    'B': [('chr1', 100, 4, 10), ('chr1', 300, 5, 10), ('chr1', 5000, 3, 10), ('chr2', 60, 1, 10)],
+}
+
+# Records at stored positions, between them and past them, far apart and on both contigs
+CALLS = [
+    ('chr1', 50, 1, 10), ('chr1', 100, 3, 10), ('chr1', 150, 1, 10), ('chr1', 300, 2, 20),
+    ('chr1', 5000, 5, 10), ('chr2', 50, 1, 10), ('chr2', 70, 1, 10),
+]
+
+@pytest.fixture
+def loaded(db_adapter, write_gvcf):
+    for name, records in SAMPLES.items():
+        Updater(db_adapter, GVCFParser(write_gvcf(name, records))).insert_sample()
+    db_adapter.clear_cache()
+    return db_adapter
+
+def _annotations(path):
+    return {
+        (variant.CHROM, variant.POS): {key: variant.INFO.get(key) for key in ('MEAN_AF', 'SD_AF', 'MAX_AF', 'SAMPLES', 'Z_AF')}
+        for variant in VCF(path)
+    }
+
+def _expected(db_adapter):
+    expected = {}
+    for chr, pos, ad, dp in CALLS:
+        rows = db_adapter.fetch_variants(chr, pos, pos)
+        if not rows:
+            expected[(chr, pos)] = dict.fromkeys(('MEAN_AF', 'SD_AF', 'MAX_AF', 'SAMPLES', 'Z_AF'))
+            continue
+        row = rows[0]
+        z = (ad / dp - row.mean_non_ref_af) / row.sd_non_ref_af if row.sd_non_ref_af else None
+        expected[(chr, pos)] = {
+            'MEAN_AF': row.mean_non_ref_af, 'SD_AF': row.sd_non_ref_af, 'MAX_AF': row.max_non_ref_af,
+            'SAMPLES': row.number_of_samples, 'Z_AF': z,
+        }
+    return expected
+
+def _assert_annotations(path, expected):
+    annotations = _annotations(path)
+    assert list(annotations) == list(expected)
+    for key, values in expected.items():
+        for info_id, value in values.items():
+            assert annotations[key][info_id] == (None if value is None else pytest.approx(value, rel=1e-4, abs=1e-6))
+
+@pytest.mark.parametrize('chunk_size, max_gap, output', [
+    (10000, 1000, 'annotated.vcf'),
+    (2, 0, 'annotated.vcf'),
+    (10000, 10 ** 6, 'annotated.vcf.gz'),
+])
+def test_records_are_joined_with_the_stored_variants(tmp_path, loaded, write_gvcf, chunk_size, max_gap, output):
+    calls = write_gvcf('calls', CALLS)
+    output = str(tmp_path / output)
+    assert annotate_vcf(loaded, calls, output, chunk_size, max_gap) == (7, 4)
+    expected = _expected(loaded)
+    assert expected[('chr1', 5000)]['Z_AF'] is not None and expected[('chr1', 100)]['SAMPLES'] == 2
+    _assert_annotations(output, expected)
+    if output.endswith('.gz'):
+        assert [(variant.CHROM, variant.POS) for variant in VCF(output)('chr1:120-5000')] == [('chr1', 150), ('chr1', 300), ('chr1', 5000)]
+
+def test_snapshot_gives_the_same_annotations(tmp_path, loaded, write_gvcf):
+    calls = write_gvcf('calls', CALLS)
+    session = loaded.get_session()
+    try:
+        write_snapshot(session, str(tmp_path / 'snapshot'))
+    finally:
+        session.close()
+    annotate_vcf(loaded, calls, str(tmp_path / 'database.vcf'))
+    annotate_vcf(Snapshot(str(tmp_path / 'snapshot')), calls, str(tmp_path / 'snapshot.vcf'))
+    _assert_annotations(str(tmp_path / 'snapshot.vcf'), _annotations(str(tmp_path / 'database.vcf')))
+
+@pytest.mark.parametrize('calls, message', [
+    ([('chr1', 200, 1, 10), ('chr1', 100, 1, 10)], 'chr1:100 after chr1:200'),
+    ([('chr1', 100, 1, 10), ('chr2', 50, 1, 10), ('chr1', 200, 1, 10)], 'records for chr1 are not contiguous'),
+])
+def test_unsorted_input_is_rejected(tmp_path, loaded, write_gvcf, calls, message):
+    with pytest.raises(ValueError, match=message):
+        annotate_vcf(loaded, write_gvcf('calls', calls), str(tmp_path / 'annotated.vcf'))
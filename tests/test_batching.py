@@ -0,0 +1,117 @@
+"""
+Unit tests for the batching module.
+"""
+
+import sqlite3
+import pytest
+
+from varnoisedb import batching
+from varnoisedb.batching import _RESERVED_PARAMETERS, _ROW_BYTES, BatchSizer, max_batch_size
+
+@pytest.fixture
+def memory(monkeypatch):
+    """The peak memory the sizers observe, in bytes, set through memory[0]."""
+    memory = [100 * 2 ** 20]
+    monkeypatch.setattr(batching, '_peak_memory', lambda: memory[0])
+    return memory
+
+def _write(sizer, rate, batches=BatchSizer.WINDOW):
+    """Observe batches at the current size, written at rate(size) rows per second."""
+    for _ in range(batches):
+        sizer.observe(sizer.size, sizer.size / rate(sizer.size))
+
+class _Connection:
+    def __init__(self, max_allowed_packet):
+        self.max_allowed_packet = max_allowed_packet
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def execute(self, statement):
+        assert str(statement) == "SELECT @@max_allowed_packet"
+        return self
+
+    def scalar(self):
+        return self.max_allowed_packet
+
+class _Adapter:
+    def __init__(self, db_type, max_allowed_packet=None):
+        self.db_type = db_type
+        self.engine = self
+        self.max_allowed_packet = max_allowed_packet
+
+    def connect(self):
+        return _Connection(self.max_allowed_packet)
+
+def test_max_batch_size_per_backend(db_adapter):
+    connection = sqlite3.connect(':memory:')
+    expected = connection.getlimit(sqlite3.SQLITE_LIMIT_VARIABLE_NUMBER) if hasattr(connection, 'getlimit') else None
+    if expected is not None:
+        assert max_batch_size(db_adapter) == expected - _RESERVED_PARAMETERS
+    assert max_batch_size(_Adapter('postgresql')) == 65535 - _RESERVED_PARAMETERS
+    assert max_batch_size(_Adapter('mysql', 64 * 2 ** 20)) == 64 * 2 ** 20 // 256 - _RESERVED_PARAMETERS
+    assert max_batch_size(_Adapter('mysql', 1024)) == 1
+
+def test_limit_is_shared_between_files_and_bounded_by_memory(memory):
+    assert BatchSizer(40000, n_files=4).limit == 10000
+    sizer = BatchSizer(40000, memory_budget=500 * _ROW_BYTES)
+    assert (sizer.limit, sizer.minimum, sizer.size) == (500, 100, 500)
+    # Parsed batches waiting in the prefetch queue count against the budget
+    assert BatchSizer(40000, memory_budget=2 ** 20, prefetch=16).limit < BatchSizer(40000, memory_budget=2 ** 20).limit
+    assert BatchSizer(50, start=1000).size == 50
+
+def test_grows_to_the_limit_while_throughput_rises(memory):
+    sizer = BatchSizer(6000)
+    sizes = [sizer.size]
+    while not sizer.settled:
+        _write(sizer, lambda size: 10 * size)
+        sizes.append(sizer.size)
+    assert sizes == [1000, 2000, 4000, 6000, 6000]
+
+def test_settles_on_the_best_size(memory):
+    # The throughput stops rising past 4000 rows and falls at 16000
+    rates = {1000: 50000, 2000: 80000, 4000: 120000, 8000: 122000, 16000: 90000}
+    sizer = BatchSizer(100000)
+    sizes = []
+    while not sizer.settled:
+        sizes.append(sizer.size)
+        _write(sizer, rates.get)
+    assert sizes == [1000, 2000, 4000, 8000]
+    assert sizer.size == 4000
+    _write(sizer, rates.get, batches=3 * BatchSizer.WINDOW)
+    assert sizer.size == 4000
+
+def test_shrinks_on_slow_batches(memory):
+    sizer = BatchSizer(100000, start=8000, max_seconds=1.0)
+    _write(sizer, lambda size: 4000)
+    assert (sizer.size, sizer.limit, sizer.settled) == (4000, 4000, True)
+    _write(sizer, lambda size: 4000)
+    assert sizer.size == 4000
+    # Never below the minimum
+    for _ in range(10):
+        _write(sizer, lambda size: 10)
+    assert sizer.size == sizer.minimum == 100
+
+def test_shrinks_when_the_memory_budget_is_exceeded(memory):
+    sizer = BatchSizer(100000, start=4000, memory_budget=64 * 2 ** 20)
+    _write(sizer, lambda size: 10 * size)
+    assert sizer.size == 8000
+    memory[0] += 65 * 2 ** 20
+    _write(sizer, lambda size: 10 * size)
+    assert (sizer.size, sizer.limit, sizer.settled) == (4000, 4000, True)
+    # The new peak is the base of the next comparison
+    _write(sizer, lambda size: 10 * size)
+    assert sizer.size == 4000
+
+def test_batches_parsed_before_a_resize_are_not_measured(memory):
+    sizer = BatchSizer(100000, prefetch=2)
+    _write(sizer, lambda size: 10 * size)
+    assert sizer.size == 2000
+    # The prefetched batches and the one waiting to be queued, written slowly at the old size
+    for _ in range(3):
+        sizer.observe(1000, 10.0)
+    _write(sizer, lambda size: 10 * size)
+    assert sizer.size == 4000
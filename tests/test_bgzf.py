@@ -0,0 +1,92 @@
+"""
+Unit tests for the bgzf module.
+"""
+
+import gzip
+import pytest
+from cyvcf2 import VCF
+
+from varnoisedb.bgzf import _BLOCK_DATA_SIZE, BgzfWriter, TabixIndex
+
+HEADER = (
+    "##fileformat=VCFv4.2\n##contig=<ID=chr1>\n##contig=<ID=chr2>\n"
+    "#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n"
+)
+
+def _line(chr, pos):
+    # Padded so that a few thousand records fill several blocks
+    return f"{chr}\t{pos}\t.\tN\t<NON_REF>\t.\tPASS\tNOTE={'x' * 40}\n".encode()
+
+def _write(path, records):
+    """Write records as a BGZF VCF indexed with one entry per record, return their data offsets."""
+    index = TabixIndex()
+    offsets = []
+    with BgzfWriter(path) as writer:
+        writer.write(HEADER)
+        for chr, pos in records:
+            start = writer.data_offset()
+            writer.write(_line(chr, pos))
+            offsets.append((start, writer.data_offset()))
+            index.add(chr, pos - 1, pos, start, writer.data_offset())
+    index.write(path + '.tbi', writer)
+    return offsets
+
+@pytest.fixture
+def records():
+    return [('chr1', pos) for pos in range(1, 200000, 70)] + [('chr2', pos) for pos in range(500, 2000, 3)]
+
+@pytest.fixture
+def indexed(tmp_path, records):
+    path = str(tmp_path / 'records.vcf.gz')
+    return path, _write(path, records)
+
+def test_blocks_decompress_to_the_written_data(indexed, records):
+    (path, _) = indexed
+    with gzip.open(path, 'rb') as file:
+        assert file.read() == HEADER.encode() + b''.join(_line(chr, pos) for chr, pos in records)
+
+def test_virtual_offsets_address_the_blocks(tmp_path):
+    path = str(tmp_path / 'data.gz')
+    writer = BgzfWriter(path)
+    writer.write(b'a' * (2 * _BLOCK_DATA_SIZE + 10))
+    assert writer.tell() & 0xffff == 10
+    assert writer.virtual_offset(_BLOCK_DATA_SIZE - 1) == _BLOCK_DATA_SIZE - 1
+    writer.close()
+    with open(path, 'rb') as file:
+        data = file.read()
+    second = writer.virtual_offset(_BLOCK_DATA_SIZE) >> 16
+    # Every block starts with the gzip magic and records its size less one in the BC extra field
+    assert data[second:second + 2] == b'\x1f\x8b'
+    assert int.from_bytes(data[16:18], 'little') + 1 == second
+
+@pytest.mark.parametrize('chr, start, end', [
+    ('chr1', 1, 1000),
+    ('chr1', 16000, 17000),
+    ('chr1', 100000, 140000),
+    ('chr1', 199900, 250000),
+    ('chr2', 1, 100),
+    ('chr2', 1000, 1010),
+])
+def test_regions_read_through_the_index(indexed, records, chr, start, end):
+    (path, _) = indexed
+    found = [(variant.CHROM, variant.POS) for variant in VCF(path)(f'{chr}:{start}-{end}')]
+    assert found == [record for record in records if record[0] == chr and start <= record[1] <= end]
+
+def test_record_across_a_block_boundary(indexed, records):
+    (path, offsets) = indexed
+    crossing = [i for i, (start, end) in enumerate(offsets) if start // _BLOCK_DATA_SIZE != (end - 1) // _BLOCK_DATA_SIZE]
+    assert len(crossing) > 1
+    for i in crossing[:3]:
+        (chr, pos) = records[i]
+        found = [(variant.CHROM, variant.POS) for variant in VCF(path)(f'{chr}:{pos}-{pos}')]
+        assert found == [records[i]]
+        # A region starting in the record after it begins in the next block
+        (chr, pos) = records[i + 1]
+        assert [(variant.CHROM, variant.POS) for variant in VCF(path)(f'{chr}:{pos}-{pos + 1}')] == [records[i + 1]]
+
+def test_contigs_must_be_contiguous():
+    index = TabixIndex()
+    index.add('chr1', 0, 1, 0, 10)
+    index.add('chr2', 0, 1, 10, 20)
+    with pytest.raises(ValueError, match='not contiguous'):
+        index.add('chr1', 5, 6, 20, 30)
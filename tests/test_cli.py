@@ -1,3 +1,65 @@
 """
 Unit tests for the CLI module.
 """
+
+import pytest
+from click.testing import CliRunner
+
+from varnoisedb.cli.cli import cli
+from varnoisedb.gvcf_parser import GVCFParser
+from varnoisedb.query import MAX_POSITION, parse_region
+from varnoisedb.updater import Updater
+
+@pytest.mark.parametrize('region, expected', [
+    ('chr1', ('chr1', 1, MAX_POSITION)),
+    ('chr1:100', ('chr1', 100, 100)),
+    ('chr1:1,000-2,000', ('chr1', 1000, 2000)),
+    ('HLA-A*01:01:01:01:5-10', ('HLA-A*01:01:01:01', 5, 10)),
+    ('HLA-DRB1*15:01:01:AB', ('HLA-DRB1*15:01:01:AB', 1, MAX_POSITION)),
+    ('{HLA-A*01:01:01:01}', ('HLA-A*01:01:01:01', 1, MAX_POSITION)),
+    ('{HLA-A*01:01}:5-10', ('HLA-A*01:01', 5, 10)),
+])
+def test_parse_region(region, expected):
+    assert parse_region(region) == expected
+
+@pytest.mark.parametrize('region', ['chr1:0', 'chr1:20-10', '{chr1', '{chr1}5', '{chr1}:x', '{}'])
+def test_parse_region_rejects_invalid(region):
+    with pytest.raises(ValueError, match='Invalid region'):
+        parse_region(region)
+
+def test_parse_region_with_known_contigs():
+    contigs = {'chr1', 'HLA-A*01:01:01:01'}
+    assert parse_region('HLA-A*01:01:01:01', contigs) == ('HLA-A*01:01:01:01', 1, MAX_POSITION)
+    assert parse_region('chr1:100', contigs) == ('chr1', 100, 100)
+    with pytest.raises(ValueError, match='Ambiguous region'):
+        parse_region('A:1', {'A', 'A:1'})
+
+def test_query_whole_contig_with_colons(tmp_path, db_adapter, db_path, write_gvcf):
+    # The contig is not in the header and is added when its records are written
+    path = write_gvcf('A', [('HLA-A*01:01:01:01', 100, 1, 10), ('HLA-A*01:01:01:01', 200, 2, 10)])
+    Updater(db_adapter, GVCFParser(path)).insert_sample()
+    config = tmp_path / 'config.yaml'
+    config.write_text(f"database:\n  type: sqlite\n  name: {db_path}\n")
+
+    result = CliRunner().invoke(cli, ['--config', str(config), 'query', 'HLA-A*01:01:01:01'])
+    assert result.exit_code == 0, result.output
+    assert [line.split('\t')[:2] for line in result.output.splitlines()[1:]] == [
+        ['HLA-A*01:01:01:01', '100'], ['HLA-A*01:01:01:01', '200']
+    ]
+
+def test_export_reports_only_since_errors_as_since(tmp_path, db_adapter, db_path, write_gvcf, monkeypatch):
+    Updater(db_adapter, GVCFParser(write_gvcf('A', [('chr1', 100, 1, 10)]))).insert_sample()
+    config = tmp_path / 'config.yaml'
+    config.write_text(f"database:\n  type: sqlite\n  name: {db_path}\n")
+    args = ['--config', str(config), 'export', '--output', str(tmp_path / 'delta.vcf')]
+
+    result = CliRunner().invoke(cli, args + ['--since', '5'])
+    assert result.exit_code == 2
+    assert 'Invalid value for --since' in result.output
+
+    def write_vcf(*args):
+        raise ValueError("Records for chr1 are not contiguous")
+    monkeypatch.setattr('varnoisedb.cli.export.write_vcf', write_vcf)
+    result = CliRunner().invoke(cli, args)
+    assert isinstance(result.exception, ValueError)
+    assert '--since' not in result.output
@@ -1,3 +1,49 @@
 """
 Unit tests for the database module.
 """
+
+import pytest
+
+from varnoisedb.database import DatabaseAdapter
+from varnoisedb.gvcf_parser import GVCFParser
+from varnoisedb.updater import Updater
+
+@pytest.fixture
+def blocks_adapter(db_path, write_gvcf):
+    """A database with the reference blocks of sample A stored as intervals and a variant of sample B inside them."""
+    db_adapter = DatabaseAdapter(db_type='sqlite', db_name=db_path, reference_blocks=True)
+    db_adapter.create_tables()
+    samples = {
+        'A': [('chr1', 3290, 1, 10, 3305), ('chr1', 3306, 2, 10, 3320)],
+        'B': [('chr1', 3300, 5, 10)],
+    }
+    for name, records in samples.items():
+        Updater(db_adapter, GVCFParser(write_gvcf(name, records)), reference_blocks=True).insert_sample()
+    yield db_adapter
+    db_adapter.close()
+
+def test_query_region_includes_reference_blocks(blocks_adapter):
+    rows = blocks_adapter.query_region('chr1', 3299, 3310)
+    assert [row.pos for row in rows] == list(range(3299, 3311))
+    assert {row.number_of_samples for row in rows if row.pos != 3300} == {1}
+    assert rows[0].mean_non_ref_af == pytest.approx(0.1)
+    assert rows[-1].mean_non_ref_af == pytest.approx(0.2)
+    # The variant of B is combined with the interval of A
+    merged = rows[1]
+    assert (merged.pos, merged.number_of_samples, merged.total_depth) == (3300, 2, 20)
+    assert merged.mean_non_ref_af == pytest.approx(0.3)
+    assert merged.sd_non_ref_af == pytest.approx(0.2)
+    assert (merged.max_non_ref_af_sample, merged.min_non_ref_af_sample) == ('B', 'A')
+
+def test_query_positions_include_reference_blocks(blocks_adapter):
+    found = blocks_adapter.query_positions([('chr1', 3320), ('chr1', 3300), ('chr1', 3321), ('chr2', 1)])
+    assert found[0].mean_non_ref_af == pytest.approx(0.2)
+    assert found[1].number_of_samples == 2
+    assert found[2:] == [None, None]
+
+def test_query_without_reference_blocks_reads_variants_only(blocks_adapter, db_path):
+    db_adapter = DatabaseAdapter(db_type='sqlite', db_name=db_path)
+    try:
+        assert [row.pos for row in db_adapter.query_region('chr1', 3299, 3310)] == [3300]
+    finally:
+        db_adapter.close()
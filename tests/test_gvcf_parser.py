@@ -1,3 +1,125 @@
 """
 Unit tests for the gvcf parser module.
 """
+
+import numpy as np
+import pytest
+
+from varnoisedb.gvcf_parser import GVCFParser, StatsBatch, VariantBatch, _aggregate
+
+def test_records_sharing_a_position_keep_the_first(write_gvcf):
+    path = write_gvcf('A', [
+        ('chr1', 100, 2, 10),
+        ('chr1', 100, 4, 10),
+        ('chr1', 200, 1, 10),
+        ('chr2', 200, 3, 10),
+    ])
+    parser = GVCFParser(path)
+    # Batches of one record split the duplicates across batches
+    batches = list(parser.parse_columnar(1))
+    assert [(batch.chr, batch.pos.tolist()) for batch in batches] == [('chr1', [100]), ('chr1', [200]), ('chr2', [200])]
+    assert batches[0].non_ref_af.tolist() == pytest.approx([0.2])
+    assert parser.records_parsed == 3
+    assert parser.records_duplicate == 1
+
+def _direct(values, dp, samples):
+    """The per-position statistics of values computed directly."""
+    return (
+        np.mean(values), np.std(values), np.max(values), np.min(values), np.sum(dp), len(values),
+        samples[int(np.argmax(values))], samples[int(np.argmin(values))],
+    )
+
+def _stats_at(batch, i):
+    return (
+        batch.mean_non_ref_af[i], batch.sd_non_ref_af[i], batch.max_non_ref_af[i], batch.min_non_ref_af[i],
+        batch.total_depth[i], batch.number_of_samples[i], batch.max_non_ref_af_sample[i], batch.min_non_ref_af_sample[i],
+    )
+
+@pytest.fixture
+def cohort():
+    """Values of 5 samples at 4 positions, with positions where only some samples have a record."""
+    rng = np.random.default_rng(1)
+    names = np.array(['S0', 'S1', 'S2', 'S3', 'S4'], dtype=object)
+    af = rng.random((4, 5))
+    dp = rng.integers(10, 100, (4, 5)).astype(np.float64)
+    present = np.ones((4, 5), dtype=bool)
+    present[1, [0, 3]] = False
+    present[3, 1:] = False
+    return names, af, dp, present
+
+def _aggregate_samples(cohort, samples):
+    names, af, dp, present = cohort
+    mask = present.copy()
+    mask[:, [i for i in range(len(names)) if i not in samples]] = False
+    pos, sample_index = np.nonzero(mask)
+    return _aggregate('chr1', (pos + 1).astype(np.int32), af[mask], dp[mask], sample_index, names)
+
+def test_aggregate_matches_direct(cohort):
+    names, af, dp, present = cohort
+    batch = _aggregate_samples(cohort, range(5))
+    assert batch.pos.tolist() == [1, 2, 3, 4]
+    for i in range(4):
+        row = present[i]
+        assert _stats_at(batch, i) == pytest.approx(_direct(af[i, row], dp[i, row], names[row]))
+
+def test_aggregate_gives_ties_to_the_first_sample():
+    # Few distinct values, so most positions have ties for the min and the max
+    rng = np.random.default_rng(4)
+    names = np.array(['S0', 'S1', 'S2', 'S3'], dtype=object)
+    af = rng.choice([0.0, 0.25, 0.5], (50, 4))
+    dp = np.full((50, 4), 10.0)
+    pos, sample_index = np.nonzero(np.ones((50, 4), dtype=bool))
+    batch = _aggregate('chr1', (pos + 1).astype(np.int32), af.ravel(), dp.ravel(), sample_index, names)
+    for i in range(50):
+        assert _stats_at(batch, i) == pytest.approx(_direct(af[i], dp[i], names))
+
+def test_aggregate_ties_across_positions():
+    # Equal values at neighbouring positions must not run into each other
+    names = np.array(['S0', 'S1'], dtype=object)
+    batch = _aggregate(
+        'chr1', np.array([1, 1, 2, 2], dtype=np.int32), np.array([0.5, 0.5, 0.5, 0.5]), np.full(4, 10.0),
+        np.array([1, 0, 1, 0]), names
+    )
+    assert batch.max_non_ref_af_sample.tolist() == ['S0', 'S0']
+    assert batch.min_non_ref_af_sample.tolist() == ['S0', 'S0']
+
+def test_merge_matches_direct(cohort):
+    names, af, dp, present = cohort
+    # Positions 1 to 3 have records in both parts
+    merged = _aggregate_samples(cohort, [0, 1]).take(slice(0, 3)).merge(_aggregate_samples(cohort, [2, 3, 4]))
+    for i in range(3):
+        row = present[i]
+        assert _stats_at(merged, i) == pytest.approx(_direct(af[i, row], dp[i, row], names[row]))
+
+def test_merge_replaces_missing_extremes():
+    empty = np.array([np.nan])
+    current = StatsBatch('chr1', np.array([1]), np.array([0.3]), np.array([0.1]), empty, empty,
+                         np.array([20.0]), np.array([2]), np.array([None], dtype=object), np.array([None], dtype=object))
+    merged = current.merge(VariantBatch('chr1', np.array([1]), np.array([0.1]), np.array([10.0]), 'S9').to_stats())
+    assert merged.max_non_ref_af.tolist() == [0.1]
+    assert merged.min_non_ref_af.tolist() == [0.1]
+    assert merged.max_non_ref_af_sample.tolist() == ['S9']
+    assert merged.number_of_samples.tolist() == [3]
+
+# At position 3, which has records of all samples, S3 holds the max and S4 the min
+@pytest.mark.parametrize('removed', [0, 3, 4])
+def test_remove_matches_direct(cohort, removed):
+    names, af, dp, present = cohort
+    stats = _aggregate_samples(cohort, range(5)).take([2])
+    assert (stats.max_non_ref_af_sample[0], stats.min_non_ref_af_sample[0]) == ('S3', 'S4')
+    remaining = stats.remove(af[2, [removed]], dp[2, [removed]], names[removed])
+    keep = np.arange(5) != removed
+    (mean, sd, max_af, min_af, depth, number, max_sample, min_sample) = _direct(af[2, keep], dp[2, keep], names[keep])
+    assert remaining.mean_non_ref_af[0] == pytest.approx(mean)
+    assert remaining.sd_non_ref_af[0] == pytest.approx(sd)
+    assert remaining.total_depth[0] == pytest.approx(depth)
+    assert remaining.number_of_samples[0] == number
+    # The min/max held by the removed sample is lost, the others are kept
+    if stats.max_non_ref_af_sample[0] == names[removed]:
+        assert np.isnan(remaining.max_non_ref_af[0]) and remaining.max_non_ref_af_sample[0] is None
+    else:
+        assert (remaining.max_non_ref_af[0], remaining.max_non_ref_af_sample[0]) == (max_af, max_sample)
+    if stats.min_non_ref_af_sample[0] == names[removed]:
+        assert np.isnan(remaining.min_non_ref_af[0]) and remaining.min_non_ref_af_sample[0] is None
+    else:
+        assert (remaining.min_non_ref_af[0], remaining.min_non_ref_af_sample[0]) == (min_af, min_sample)
@@ -0,0 +1,138 @@
+"""
+Unit tests for the jobs module.
+"""
+
+import threading
+import numpy as np
+import pytest
+from sqlalchemy import exc
+
+from varnoisedb import jobs
+from varnoisedb.database import DatabaseAdapter
+from varnoisedb.gvcf_parser import GVCFParser
+from varnoisedb.updater import Updater
+
+@pytest.fixture
+def gvcf_paths(write_gvcf):
+    # Distinct values at every position, so the min/max samples do not depend on the load order
+    rng = np.random.default_rng(6)
+    return [
+        write_gvcf(f'J{i}', [('chr1', pos, int(rng.integers(0, 1000)), 1000) for pos in range(1, 301, 3)])
+        for i in range(4)
+    ]
+
+def _statuses(session):
+    return [(job.status, job.attempts) for job in jobs.list_jobs(session)]
+
+def test_claim_job_is_exclusive(db_adapter, gvcf_paths):
+    first, second = db_adapter.get_session(), db_adapter.get_session()
+    try:
+        ids = jobs.submit_jobs(first, gvcf_paths[:2])
+        claimed = [jobs.claim_job(first, 'w1').id, jobs.claim_job(second, 'w2').id]
+        assert claimed == ids
+        assert jobs.claim_job(first, 'w1') is None
+        assert [(job.status, job.worker) for job in jobs.list_jobs(first)] == [('running', 'w1'), ('running', 'w2')]
+    finally:
+        first.close()
+        second.close()
+
+def test_submit_rejects_queued_samples(db_adapter, gvcf_paths):
+    session = db_adapter.get_session()
+    try:
+        jobs.submit_jobs(session, gvcf_paths[:1])
+        with pytest.raises(ValueError, match='already queued'):
+            jobs.submit_jobs(session, gvcf_paths[:1])
+    finally:
+        session.close()
+
+def test_finish_job_retries_or_fails(db_adapter, gvcf_paths):
+    session = db_adapter.get_session()
+    try:
+        (retried, failed, done) = jobs.submit_jobs(session, gvcf_paths[:3])
+        for _ in range(3):
+            jobs.claim_job(session, 'w1')
+        jobs.finish_job(session, retried, 'deadlock', retry=True)
+        jobs.finish_job(session, failed, 'broken')
+        jobs.finish_job(session, done)
+        assert _statuses(session) == [('pending', 1), ('failed', 1), ('done', 1)]
+        # A retried job is claimed again with its attempts counted
+        assert jobs.claim_job(session, 'w1').id == retried
+        assert _statuses(session)[0] == ('running', 2)
+
+        assert jobs.requeue_jobs(session) == 1
+        assert _statuses(session) == [('running', 2), ('pending', 0), ('done', 1)]
+        assert jobs.count_jobs(session) == {'running': 1, 'pending': 1, 'done': 1}
+    finally:
+        session.close()
+
+def _submit(db_adapter, paths):
+    session = db_adapter.get_session()
+    try:
+        return jobs.submit_jobs(session, paths)
+    finally:
+        session.close()
+
+def test_worker_fails_job_on_unexpected_error(db_adapter, gvcf_paths, monkeypatch):
+    def run_job(*args, **kwargs):
+        raise RuntimeError('malformed record')
+    monkeypatch.setattr(jobs, 'run_job', run_job)
+    _submit(db_adapter, gvcf_paths[:2])
+    assert jobs.run_worker(db_adapter, 'w1', exit_when_empty=True) == (2, 2)
+    session = db_adapter.get_session()
+    try:
+        assert [(job.status, job.error) for job in jobs.list_jobs(session)] == [('failed', 'RuntimeError: malformed record')] * 2
+    finally:
+        session.close()
+
+def test_worker_retries_database_errors(db_adapter, gvcf_paths, monkeypatch):
+    def run_job(*args, **kwargs):
+        raise exc.OperationalError('INSERT', {}, Exception('deadlock detected'))
+    monkeypatch.setattr(jobs, 'run_job', run_job)
+    _submit(db_adapter, gvcf_paths[:1])
+    # Returned to the queue until the last attempt fails
+    assert jobs.run_worker(db_adapter, 'w1', exit_when_empty=True, max_attempts=2) == (2, 2)
+    session = db_adapter.get_session()
+    try:
+        assert [(job.status, job.attempts, job.error) for job in jobs.list_jobs(session)] == [('failed', 2, 'deadlock detected')]
+    finally:
+        session.close()
+
+def test_two_workers_match_sequential_load(tmp_path, db_path, db_adapter, gvcf_paths):
+    _submit(db_adapter, gvcf_paths)
+    results = []
+    def work(name):
+        worker_adapter = DatabaseAdapter(db_type='sqlite', db_name=db_path)
+        try:
+            # SQLite allows one writer at a time, a worker waiting too long retries its job
+            results.append(jobs.run_worker(
+                worker_adapter, name, exit_when_empty=True, max_attempts=10, batch_size=20, checkpoint_interval=2
+            ))
+        finally:
+            worker_adapter.close()
+    workers = [threading.Thread(target=work, args=(f'w{i}',)) for i in range(2)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    assert sum(n_jobs for n_jobs, _ in results) >= 4
+    session = db_adapter.get_session()
+    try:
+        assert {job.status for job in jobs.list_jobs(session)} == {'done'}
+    finally:
+        session.close()
+
+    sequential = DatabaseAdapter(db_type='sqlite', db_name=str(tmp_path / 'sequential.db'))
+    sequential.create_tables()
+    try:
+        for path in gvcf_paths:
+            Updater(sequential, GVCFParser(path)).insert_sample()
+        expected = sequential.query_region('chr1', 1, 1000)
+    finally:
+        sequential.close()
+    db_adapter.clear_cache()
+    rows = db_adapter.query_region('chr1', 1, 1000)
+    assert len(rows) == len(expected) == 100
+    for row, expected_row in zip(rows, expected):
+        assert tuple(row)[:2] == tuple(expected_row)[:2]
+        assert tuple(row)[2:8] == pytest.approx(tuple(expected_row)[2:8])
+        assert tuple(row)[8:] == tuple(expected_row)[8:]
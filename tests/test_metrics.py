@@ -0,0 +1,73 @@
+"""
+Unit tests for the metrics module.
+"""
+
+import json
+import pstats
+import pytest
+from click.testing import CliRunner
+
+from varnoisedb.cli.cli import cli
+from varnoisedb.metrics import Metrics, statement_kind
+
+@pytest.mark.parametrize('statement, kind', [
+    ('SELECT variants.pos FROM variants WHERE variants.contig_id = ?', 'SELECT variants'),
+    ('INSERT INTO variants (contig_id, pos) VALUES (?, ?) ON CONFLICT DO UPDATE', 'INSERT variants'),
+    ('UPDATE "samples" SET name=?', 'UPDATE samples'),
+    ('  DELETE FROM `variant_tombstones`', 'DELETE variant_tombstones'),
+    ('CREATE TABLE generations (id INTEGER)', 'CREATE generations'),
+    ('COMMIT', 'COMMIT'),
+])
+def test_statement_kind(statement, kind):
+    assert statement_kind(statement) == kind
+
+def test_to_dict():
+    metrics = Metrics()
+    metrics.add('parse', 1.5)
+    with metrics.timer('write'):
+        pass
+    metrics.count('written', 30)
+    metrics.count('written', 10)
+    metrics.set('batch_size', 2000)
+    assert 'statements' not in metrics.to_dict()
+    report = metrics.to_dict(wall_seconds=4.0)
+    assert report['stages']['parse'] == 1.5 and report['stages']['write'] >= 0
+    assert report['counts'] == {'written': 40}
+    assert report['values'] == {'batch_size': 2000}
+    assert report['throughput'] == {'written_per_second': 10.0}
+    assert str(metrics).endswith('; written 40')
+
+def test_commands_write_metrics(tmp_path, db_path, write_gvcf):
+    path = write_gvcf('A', [('chr1', 100, 1, 10), ('chr1', 100, 2, 10), ('chr1', 200, 2, 10), ('chr2', 50, 3, 10)])
+    config = tmp_path / 'config.yaml'
+    config.write_text(f"database:\n  type: sqlite\n  name: {db_path}\n")
+    runner = CliRunner()
+    assert runner.invoke(cli, ['--config', str(config), 'init']).exit_code == 0
+
+    load_metrics = tmp_path / 'load.json'
+    profile = tmp_path / 'load.prof'
+    result = runner.invoke(cli, [
+        '--config', str(config), 'load', '--gvcf', path, '--prefetch', '0',
+        '--metrics-out', str(load_metrics), '--sql-timing', '--profile', str(profile)
+    ])
+    assert result.exit_code == 0, result.output
+    report = json.loads(load_metrics.read_text())
+    assert report['command'] == 'load'
+    assert report['counts']['parsed'] == 3
+    assert report['counts']['skipped_duplicate_position'] == 1
+    assert report['counts']['written'] == 3
+    assert {'parse', 'write'} <= set(report['stages'])
+    assert report['throughput']['written_per_second'] == pytest.approx(3 / report['wall_seconds'])
+    assert report['statements']['INSERT variants']['executions'] >= 1
+    assert pstats.Stats(str(profile)).total_calls > 0
+
+    export_metrics = tmp_path / 'export.json'
+    result = runner.invoke(cli, [
+        '--config', str(config), 'export', '--output', str(tmp_path / 'variants.vcf'), '--metrics-out', str(export_metrics)
+    ])
+    assert result.exit_code == 0, result.output
+    report = json.loads(export_metrics.read_text())
+    assert report['command'] == 'export'
+    assert report['counts'] == {'exported': 3}
+    assert {'fetch', 'format', 'write'} <= set(report['stages'])
+    assert 'statements' not in report
@@ -0,0 +1,101 @@
+"""
+Unit tests for the migrate module.
+"""
+
+import sqlite3
+import pytest
+from sqlalchemy import inspect
+
+from varnoisedb import migrate
+from varnoisedb.database import DatabaseAdapter
+
+HEAD = '0005'
+
+# The schema created by init before migrations were introduced
+BASELINE_SCHEMA = """
+CREATE TABLE variants (
+    chr VARCHAR(50) NOT NULL,
+    pos INTEGER NOT NULL,
+    mean_non_ref_af FLOAT,
+    sd_non_ref_af FLOAT,
+    max_non_ref_af FLOAT,
+    min_non_ref_af FLOAT,
+    total_depth FLOAT,
+    number_of_samples INTEGER,
+    max_non_ref_af_sample VARCHAR(255),
+    min_non_ref_af_sample VARCHAR(255),
+    PRIMARY KEY (chr, pos)
+);
+CREATE TABLE samples (
+    id INTEGER NOT NULL PRIMARY KEY,
+    name VARCHAR(255) NOT NULL UNIQUE,
+    gvcf_path VARCHAR(1024) NOT NULL,
+    date_added DATETIME
+);
+CREATE INDEX idx_variants_chr_pos ON variants (chr, pos);
+INSERT INTO samples (id, name, gvcf_path) VALUES (1, 'S1', 's1.g.vcf'), (2, 'S2', 's2.g.vcf');
+INSERT INTO variants VALUES ('chr1', 100, 0.1, 0.05, 0.15, 0.05, 60.0, 2, 'S2', 'S1');
+INSERT INTO variants VALUES ('chr1', 200, 0.2, 0.0, 0.2, 0.2, 30.0, 1, 'S1', 'S1');
+INSERT INTO variants VALUES ('chr2', 100, 0.3, 0.0, 0.3, 0.3, 10.0, 1, 'S2', 'S2');
+"""
+
+@pytest.fixture
+def baseline_db(db_path):
+    with sqlite3.connect(db_path) as connection:
+        connection.executescript(BASELINE_SCHEMA)
+    db_adapter = DatabaseAdapter(db_type='sqlite', db_name=db_path)
+    yield db_adapter
+    db_adapter.close()
+
+def _columns(db_adapter, table):
+    return {column['name'] for column in inspect(db_adapter.engine).get_columns(table)}
+
+def test_upgrade_baseline_to_head(baseline_db):
+    (before, after) = migrate.upgrade(baseline_db)
+    baseline_db.create_tables()
+    assert (before, after) == (migrate.BASELINE, HEAD)
+    assert {'contig_id', 'generation'} <= _columns(baseline_db, 'variants')
+    assert 'targets_path' in _columns(baseline_db, 'samples')
+    assert 'generation' in _columns(baseline_db, 'load_progress')
+    # The index duplicating the primary key is dropped
+    assert [index['name'] for index in inspect(baseline_db.engine).get_indexes('variants')] == ['idx_variants_generation']
+
+    rows = baseline_db.query_region('chr1', 1, 1000)
+    assert [row.pos for row in rows] == [100, 200]
+    assert rows[0].max_non_ref_af_sample == 'S2'
+    assert rows[0].min_non_ref_af_sample == 'S1'
+    assert rows[0].mean_non_ref_af == pytest.approx(0.1)
+    assert [row.pos for row in baseline_db.query_region('chr2', 1, 1000)] == [100]
+
+def test_upgrade_is_idempotent(baseline_db):
+    migrate.upgrade(baseline_db)
+    baseline_db.create_tables()
+    assert migrate.upgrade(baseline_db) == (HEAD, HEAD)
+
+def test_downgrade_and_upgrade_again(baseline_db):
+    migrate.upgrade(baseline_db)
+    baseline_db.create_tables()
+    assert migrate.downgrade(baseline_db, migrate.BASELINE) == (HEAD, migrate.BASELINE)
+    assert 'chr' in _columns(baseline_db, 'variants')
+    assert 'generation' not in _columns(baseline_db, 'load_progress')
+    assert migrate.upgrade(baseline_db) == (migrate.BASELINE, HEAD)
+    baseline_db.clear_cache()
+    assert [row.pos for row in baseline_db.query_region('chr1', 1, 1000)] == [100, 200]
+
+def test_failed_upgrade_leaves_database_unchanged(baseline_db, db_path):
+    with sqlite3.connect(db_path) as connection:
+        # Makes the last migration fail after the earlier ones rewrote the tables
+        connection.execute("CREATE TABLE variant_tombstones (id INTEGER PRIMARY KEY)")
+    with pytest.raises(Exception):
+        migrate.upgrade(baseline_db)
+    inspector = inspect(baseline_db.engine)
+    assert not inspector.has_table('contigs')
+    assert 'chr' in _columns(baseline_db, 'variants')
+    assert migrate.current_revision(baseline_db) == migrate.BASELINE
+
+def test_upgrade_new_database_is_head(db_adapter):
+    assert migrate.upgrade(db_adapter)[1] == HEAD
+
+def test_new_database_has_no_index_on_primary_key(db_adapter):
+    indexes = inspect(db_adapter.engine).get_indexes('variants')
+    assert [index['name'] for index in indexes] == ['idx_variants_generation']
@@ -0,0 +1,87 @@
+"""
+Unit tests for the parallel module.
+"""
+
+import pytest
+from sqlalchemy import select
+from sqlalchemy.engine import make_url
+
+from varnoisedb.database import DatabaseAdapter
+from varnoisedb.gvcf_parser import MAX_TABIX_POSITION, CohortParser
+from varnoisedb.models import ReferenceBlock
+from varnoisedb.parallel import interleave_contigs, load_parallel, shard_regions
+from varnoisedb.updater import Updater
+from tests.conftest import POSTGRESQL_URL
+
+SHARD_SIZE = 100_000_000
+
+# Records and reference blocks on both sides of the shard boundary at 100,000,001 and a block across it
+SAMPLES = {
+    'A': [
+        ('chr1', 100, 1, 10), ('chr1', 99_999_990, 2, 10, 100_000_010), ('chr1', 100_000_020, 3, 10),
+        ('chr2', 50, 1, 20), ('chr2', 200_000_001, 4, 10),
+    ],
+    'B': [
+        ('chr1', 100, 3, 10), ('chr1', 99_999_995, 1, 20), ('chr1', 100_000_001, 2, 10, 100_000_020),
+        ('chr2', 40, 2, 10, 60), ('chr2', 100_000_000, 5, 10),
+    ],
+    'C': [('chr1', 100_000_000, 4, 10), ('chr2', 50, 3, 10)],
+}
+
+def test_shard_regions(write_gvcf):
+    path = write_gvcf('A', [])
+    regions = shard_regions([path], SHARD_SIZE)
+    assert regions[:4] == [
+        ('chr1', 1, 100_000_000), ('chr1', 100_000_001, 200_000_000), ('chr1', 200_000_001, 248_956_422),
+        ('chr2', 1, 100_000_000),
+    ]
+    assert regions[-1] == ('chr2', 200_000_001, 242_193_529)
+    assert shard_regions([path], None) == [('chr1', 1, MAX_TABIX_POSITION), ('chr2', 1, MAX_TABIX_POSITION)]
+    assert interleave_contigs(regions) == [regions[0], regions[3], regions[1], regions[4], regions[2], regions[5]]
+
+def _state(db_adapter):
+    rows = [tuple(row) for chr in ('chr1', 'chr2') for row in db_adapter.fetch_variants(chr, 1, MAX_TABIX_POSITION)]
+    with db_adapter.engine.connect() as connection:
+        blocks = [tuple(row) for row in connection.execute(select(ReferenceBlock.__table__).order_by(
+            ReferenceBlock.contig_id, ReferenceBlock.start))]
+    return rows, blocks
+
+@pytest.mark.parametrize('reference_blocks', [False, True])
+def test_sharded_load_matches_sequential_load(tmp_path, write_gvcf, bgzip, reference_blocks):
+    paths = [bgzip(write_gvcf(name, records)) for name, records in SAMPLES.items()]
+    sequential = DatabaseAdapter(db_type='sqlite', db_name=str(tmp_path / 'sequential.db'), reference_blocks=reference_blocks)
+    sequential.create_tables()
+    counts = Updater(sequential, CohortParser(paths), 2, write_mode='upsert', reference_blocks=reference_blocks).insert_sample()
+
+    db_config = {'type': 'sqlite', 'name': str(tmp_path / 'parallel.db'), 'reference_blocks': reference_blocks}
+    sharded = DatabaseAdapter.from_config(db_config)
+    sharded.create_tables()
+    try:
+        assert load_parallel(db_config, paths, 2, batch_size=2, shard_size=SHARD_SIZE) == counts
+        (rows, blocks) = _state(sharded)
+        assert (rows, blocks) == _state(sequential)
+        assert bool(blocks) == reference_blocks
+    finally:
+        sharded.close()
+        sequential.close()
+
+def test_sharded_load_on_postgresql(tmp_path, pg_adapter, write_gvcf, bgzip):
+    # The workers write their regions concurrently as one generation
+    paths = [bgzip(write_gvcf(name, records)) for name, records in SAMPLES.items()]
+    sequential = DatabaseAdapter(db_type='sqlite', db_name=str(tmp_path / 'sequential.db'))
+    sequential.create_tables()
+    counts = Updater(sequential, CohortParser(paths), 2, write_mode='upsert').insert_sample()
+
+    url = make_url(POSTGRESQL_URL)
+    db_config = {'type': 'postgresql', 'name': url.database, 'host': url.host, 'port': url.port,
+                 'user': url.username, 'password': url.password}
+    try:
+        assert load_parallel(db_config, paths, 2, batch_size=2, shard_size=SHARD_SIZE) == counts
+        (rows, _) = _state(pg_adapter)
+        (expected, _) = _state(sequential)
+        assert [row[:2] for row in rows] == [row[:2] for row in expected]
+        for row, expected_row in zip(rows, expected):
+            assert row[2:8] == pytest.approx(expected_row[2:8])
+            assert row[8:] == expected_row[8:]
+    finally:
+        sequential.close()
@@ -0,0 +1,70 @@
+"""
+Unit tests for the pipeline module.
+"""
+
+import threading
+import pytest
+
+from varnoisedb.gvcf_parser import GVCFParser
+from varnoisedb.pipeline import StageTimings, prefetch
+from varnoisedb.updater import Updater
+
+def _readers():
+    return [thread for thread in threading.enumerate() if thread.name == 'varnoisedb-reader']
+
+def _counting(n, produced, fail_at=None):
+    try:
+        for i in range(n):
+            if i == fail_at:
+                raise ValueError(f"Bad record {i}")
+            produced.append(i)
+            yield i
+    finally:
+        produced.append('closed')
+
+def test_items_are_read_ahead_in_order_within_the_bound():
+    produced = []
+    consumed = []
+    timings = StageTimings()
+    for item in prefetch(_counting(20, produced), 2, timings):
+        # The queue holds 2 items and the reader one more it is putting
+        assert len([i for i in produced if i != 'closed']) <= item + 4
+        consumed.append(item)
+    assert consumed == list(range(20))
+    assert produced[-1] == 'closed'
+    assert set(timings.seconds) >= {'parse', 'wait', 'blocked'}
+    assert not _readers()
+
+def test_reader_errors_are_raised_after_the_items_before_them():
+    produced = []
+    consumed = []
+    with pytest.raises(ValueError, match='Bad record 5'):
+        for item in prefetch(_counting(20, produced, fail_at=5), 3):
+            consumed.append(item)
+    assert consumed == [0, 1, 2, 3, 4]
+    assert produced[-1] == 'closed'
+    assert not _readers()
+
+def test_closing_early_stops_the_reader():
+    produced = []
+    items = prefetch(_counting(1000, produced), 2)
+    assert [next(items) for _ in range(3)] == [0, 1, 2]
+    items.close()
+    assert produced[-1] == 'closed'
+    assert len(produced) < 10
+    assert not _readers()
+
+def test_prefetched_load_raises_parse_errors(db_adapter, write_gvcf, monkeypatch):
+    path = write_gvcf('A', [('chr1', 100, 1, 10), ('chr1', 200, 2, 10), ('chr1', 300, 3, 10)])
+    parse_columnar = GVCFParser.parse_columnar
+    def failing(self, batch_size):
+        for i, batch in enumerate(parse_columnar(self, batch_size)):
+            if i == 2:
+                raise ValueError("Truncated file")
+            yield batch
+    monkeypatch.setattr(GVCFParser, 'parse_columnar', failing)
+    with pytest.raises(ValueError, match='Truncated file'):
+        Updater(db_adapter, GVCFParser(path), batch_size=1, prefetch=2).insert_sample()
+    assert not _readers()
+    # The load was rolled back
+    assert db_adapter.query_region('chr1', 1, 1000) == []
@@ -0,0 +1,75 @@
+"""
+Unit tests for the rebuild module.
+"""
+
+import numpy as np
+import pytest
+from sqlalchemy import inspect, select
+
+from varnoisedb import rebuild
+from varnoisedb.gvcf_parser import GVCFParser
+from varnoisedb.models import Sample
+from varnoisedb.snapshot import samples_fingerprint
+from varnoisedb.updater import Updater
+
+@pytest.fixture
+def loaded(db_adapter, db_path, write_gvcf):
+    """A database with four samples loaded one after another, with ties at most positions."""
+    rng = np.random.default_rng(7)
+    for i in range(4):
+        records = [('chr1', pos, int(rng.choice([0, 2, 5])), 10) for pos in range(1, 101)]
+        records += [('chr2', pos, int(rng.choice([0, 5])), 20) for pos in range(1, 51, 2)]
+        Updater(db_adapter, GVCFParser(write_gvcf(f'R{i}', records)), write_mode='upsert').insert_sample()
+    return {'type': 'sqlite', 'name': db_path}
+
+def _all_rows(db_adapter):
+    db_adapter.clear_cache()
+    return [tuple(row) for chr in ('chr1', 'chr2') for row in db_adapter.query_region(chr, 1, 1000)]
+
+def _assert_same_rows(rows, expected):
+    assert len(rows) == len(expected)
+    for row, expected_row in zip(rows, expected):
+        assert row[:2] == expected_row[:2]
+        assert row[2:8] == pytest.approx(expected_row[2:8])
+        # Ties go to the sample loaded first in both
+        assert row[8:] == expected_row[8:]
+
+@pytest.mark.parametrize('group_size', [2, 100])
+def test_rebuild_matches_load(db_adapter, loaded, group_size):
+    expected = _all_rows(db_adapter)
+    assert rebuild.rebuild_variants(loaded, workers=2, group_size=group_size) == (4, 4 // min(group_size, 4), len(expected))
+    _assert_same_rows(_all_rows(db_adapter), expected)
+    # The secondary index is created again on the swapped table
+    inspector = inspect(db_adapter.engine)
+    assert [index['name'] for index in inspector.get_indexes('variants')] == ['idx_variants_generation']
+    assert not inspector.has_table(rebuild.REBUILD_TABLE)
+
+def test_replace_aborts_when_samples_changed(db_adapter, loaded):
+    rebuild._rebuild_table.create(db_adapter.engine)
+    session = db_adapter.get_session()
+    try:
+        fingerprint = samples_fingerprint(session)
+    finally:
+        session.close()
+    session = db_adapter.get_session()
+    try:
+        gvcf_path = session.execute(select(Sample.gvcf_path).where(Sample.name == 'R3')).scalar()
+    finally:
+        session.close()
+    Updater(db_adapter, GVCFParser(gvcf_path)).remove_sample()
+    expected = _all_rows(db_adapter)
+    with pytest.raises(ValueError, match='Samples were added or removed'):
+        rebuild.replace_variants(db_adapter, fingerprint)
+    # The variants table is left as it was after the removal, not replaced by the empty fresh table
+    assert _all_rows(db_adapter) == expected
+    assert inspect(db_adapter.engine).has_table(rebuild.REBUILD_TABLE)
+
+def test_failed_rebuild_drops_fresh_table(db_adapter, loaded, monkeypatch):
+    expected = _all_rows(db_adapter)
+    def replace_variants(db_adapter, fingerprint):
+        raise ValueError("Samples were added or removed during the rebuild")
+    monkeypatch.setattr(rebuild, 'replace_variants', replace_variants)
+    with pytest.raises(ValueError):
+        rebuild.rebuild_variants(loaded, workers=1)
+    assert not inspect(db_adapter.engine).has_table(rebuild.REBUILD_TABLE)
+    assert _all_rows(db_adapter) == expected
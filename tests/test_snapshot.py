@@ -0,0 +1,83 @@
+"""
+Unit tests for the snapshot module.
+"""
+
+import pytest
+
+from varnoisedb.gvcf_parser import GVCFParser
+from varnoisedb.snapshot import Snapshot, update_snapshot, write_snapshot
+from varnoisedb.updater import Updater
+
+SAMPLES = {
+    'A': [('chr1', 100, 1, 10), ('chr1', 200, 2, 10), ('chr2', 50, 3, 10)],
+    'B': [('chr1', 100, 4, 10), ('chr1', 300, 5, 10), ('chr2', 60, 1, 10)],
+    'C': [('chr1', 100, 2, 20), ('chr1', 400, 6, 10), ('chr2', 50, 2, 10)],
+}
+
+@pytest.fixture
+def samples(write_gvcf):
+    return {name: write_gvcf(name, records) for name, records in SAMPLES.items()}
+
+def _update(db_adapter, path, remove=False):
+    updater = Updater(db_adapter, GVCFParser(path))
+    if remove:
+        updater.remove_sample()
+    else:
+        updater.insert_sample()
+    db_adapter.clear_cache()
+
+def _snapshot(db_adapter, directory, update=False):
+    session = db_adapter.get_session()
+    try:
+        return (update_snapshot if update else write_snapshot)(session, str(directory), chunk_size=2)
+    finally:
+        session.close()
+
+def _assert_matches_database(snapshot, db_adapter):
+    for chr in ('chr1', 'chr2'):
+        expected = [tuple(row) for row in db_adapter.fetch_variants(chr, 1, 1000)]
+        rows = [tuple(row) for row in snapshot.fetch_variants(chr, 1, 1000)]
+        assert [row[:2] for row in rows] == [row[:2] for row in expected]
+        for row, expected_row in zip(rows, expected):
+            assert row[2:8] == pytest.approx(expected_row[2:8], rel=1e-6)
+            assert row[8:] == expected_row[8:]
+
+def test_lookups_match_the_database(tmp_path, db_adapter, samples):
+    for name in 'AB':
+        _update(db_adapter, samples[name])
+    manifest = _snapshot(db_adapter, tmp_path / 'snapshot')
+    assert {chr: contig['variants'] for chr, contig in manifest['contigs'].items()} == {'chr1': 3, 'chr2': 2}
+
+    snapshot = Snapshot(str(tmp_path / 'snapshot'))
+    _assert_matches_database(snapshot, db_adapter)
+    batch = snapshot.query_region('chr1', 150, 300)
+    assert batch.pos.tolist() == [200, 300]
+    assert batch.max_non_ref_af_sample.tolist() == ['A', 'B']
+    batch, found = snapshot.query_positions('chr1', [99, 100, 300, 301])
+    assert found.tolist() == [False, True, True, False]
+    assert batch.number_of_samples.tolist() == [2, 1]
+    assert batch.max_non_ref_af_sample.tolist() == ['B', 'B']
+    assert batch.min_non_ref_af_sample.tolist() == ['A', 'B']
+    assert len(snapshot.query_region('chrX', 1, 1000)) == 0
+    assert not snapshot.query_positions('chrX', [100])[1].any()
+
+def test_staleness_and_update(tmp_path, db_adapter, samples):
+    for name in 'AB':
+        _update(db_adapter, samples[name])
+    directory = tmp_path / 'snapshot'
+    _snapshot(db_adapter, directory)
+    session = db_adapter.get_session()
+    try:
+        assert not Snapshot(str(directory)).is_stale(session)
+        _update(db_adapter, samples['C'])
+        assert Snapshot(str(directory)).is_stale(session)
+        # Changes chr1:100 and chr2:50, adds chr1:400 and deletes chr1:300 and chr2:60
+        _update(db_adapter, samples['B'], remove=True)
+        manifest = _snapshot(db_adapter, directory, update=True)
+        snapshot = Snapshot(str(directory))
+        assert not snapshot.is_stale(session)
+    finally:
+        session.close()
+    assert {chr: contig['variants'] for chr, contig in manifest['contigs'].items()} == {'chr1': 3, 'chr2': 1}
+    _assert_matches_database(snapshot, db_adapter)
+    assert manifest['generation'] == _snapshot(db_adapter, tmp_path / 'fresh')['generation']
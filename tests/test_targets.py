@@ -0,0 +1,103 @@
+"""
+Unit tests for the targets module.
+"""
+
+import numpy as np
+import pytest
+
+from varnoisedb.gvcf_parser import GVCFParser, VariantBatch
+from varnoisedb.targets import Targets
+
+# BED regions, 0-based and end exclusive, out of order and with an overlapping and an adjacent pair
+BED = """track name=panel
+chr1\t1049\t1500
+chr1\t89\t110
+chr1\t199\t250
+chr1\t299\t330
+chr1\t320\t350
+chr1\t399\t420
+chr1\t1500\t2000
+chr2\t14\t30
+chr3\t0\t100
+"""
+
+# (chr, pos, non_ref_ad, dp) records and (..., end) reference blocks
+RECORDS = [
+    ('chr1', 100, 1, 10),
+    ('chr1', 150, 2, 20, 450),
+    ('chr1', 500, 3, 10),
+    ('chr1', 1000, 4, 20, 1100),
+    ('chr1', 1200, 5, 10),
+    ('chr2', 10, 6, 20, 20),
+    ('chr2', 40, 7, 10),
+]
+
+# The records clipped to the targets as (chr, pos, end, non_ref_af)
+CLIPPED = [
+    ('chr1', 100, 100, 0.1),
+    ('chr1', 200, 250, 0.1),
+    ('chr1', 300, 350, 0.1),
+    ('chr1', 400, 420, 0.1),
+    ('chr1', 1050, 1100, 0.2),
+    ('chr1', 1200, 1200, 0.5),
+    ('chr2', 15, 20, 0.3),
+]
+
+@pytest.fixture
+def targets(tmp_path):
+    path = tmp_path / 'targets.bed'
+    path.write_text(BED)
+    return Targets.from_bed(str(path))
+
+def _parsed(parser, batch_size):
+    return [
+        (batch.chr, int(pos), int(end), round(float(af), 4))
+        for batch in parser.parse_columnar(batch_size)
+        for pos, end, af in zip(batch.pos, batch.end, batch.non_ref_af)
+    ]
+
+def test_regions_are_merged_and_sorted(targets):
+    assert targets.starts['chr1'] == [90, 200, 300, 400, 1050]
+    assert targets.ends['chr1'] == [110, 250, 350, 420, 2000]
+    assert len(targets) == 7
+    assert targets.size == 21 + 51 + 51 + 21 + 951 + 16 + 100
+    assert list(targets.regions(['chr2', 'chr4'])) == [('chr2', 15, 30)]
+    with pytest.raises(ValueError, match='Invalid target region'):
+        Targets([('chr1', 10, 5)])
+
+@pytest.mark.parametrize('start, end, expected', [
+    (80, 89, False), (80, 90, True), (111, 199, False), (250, 260, True), (2001, 3000, False), (1, 5000, True),
+])
+def test_overlaps(targets, start, end, expected):
+    assert targets.overlaps('chr1', start, end) == expected
+    assert not targets.overlaps('chrX', start, end)
+
+def test_clip_splits_blocks_across_regions(targets):
+    pos = np.array([100, 150, 500, 1000, 1200], dtype=np.int32)
+    end = np.array([100, 450, 500, 1100, 1200], dtype=np.int32)
+    af = np.array([0.1, 0.2, 0.3, 0.4, 0.5], dtype=np.float32)
+    dp = np.array([10, 20, 30, 40, 50], dtype=np.float32)
+    clipped = targets.clip(VariantBatch('chr1', pos, af, dp, 'A', end))
+    assert clipped.pos.tolist() == [100, 200, 300, 400, 1050, 1200]
+    assert clipped.end.tolist() == [100, 250, 350, 420, 1100, 1200]
+    assert clipped.non_ref_af.tolist() == pytest.approx([0.1, 0.2, 0.2, 0.2, 0.4, 0.5])
+    assert clipped.dp.tolist() == [10, 20, 20, 20, 40, 50]
+    assert clipped.pos.dtype == np.int32 and clipped.end.dtype == np.int32
+    assert len(targets.clip(VariantBatch('chrX', pos, af, dp, 'A', end))) == 0
+
+@pytest.mark.parametrize('indexed', [False, True])
+@pytest.mark.parametrize('batch_size', [1, 3, 100])
+def test_parser_clips_records_to_targets(write_gvcf, bgzip, targets, indexed, batch_size):
+    path = write_gvcf('A', RECORDS)
+    if indexed:
+        path = bgzip(path)
+    assert _parsed(GVCFParser(path, targets=targets), batch_size) == CLIPPED
+
+def test_indexed_and_streamed_reads_agree(write_gvcf, bgzip, targets):
+    # Of two records at one position in a region only the first is kept, whichever way the file is read
+    records = RECORDS[:1] + [('chr1', 100, 9, 10)] + RECORDS[1:]
+    path = write_gvcf('A', records)
+    streamed = GVCFParser(path, targets=targets)
+    indexed = GVCFParser(bgzip(path), targets=targets)
+    assert _parsed(indexed, 2) == _parsed(streamed, 2) == CLIPPED
+    assert indexed.records_duplicate == streamed.records_duplicate == 1
@@ -1,3 +1,364 @@
 """
 Unit tests for the updater module.
 """
+
+import numpy as np
+import pytest
+from sqlalchemy import select
+
+from varnoisedb.contributions import read_contributions, recompute_stats
+from varnoisedb.database import DatabaseAdapter
+from varnoisedb.gvcf_parser import CohortParser, GVCFParser, VariantBatch
+from varnoisedb.intervals import merge_intervals, recompute_extremes, subtract_intervals
+from varnoisedb.models import Sample
+from varnoisedb.progress import read_progress
+from varnoisedb.updater import _STAT_COLUMNS, Updater
+from varnoisedb.utils import combine_stats, update_multiple_stats, update_stats
+
+# Sample A has two records at chr1:100, of which only the first counts
+SAMPLES = {
+    'A': [('chr1', 100, 2, 10), ('chr1', 100, 4, 10), ('chr1', 200, 1, 20)],
+    'B': [('chr1', 100, 3, 20), ('chr1', 200, 5, 10)],
+    'C': [('chr1', 100, 5, 10)],
+}
+
+def _load(db_adapter, path, **kwargs):
+    _load_parser(db_adapter, GVCFParser(path), **kwargs)
+
+def _load_parser(db_adapter, parser, **kwargs):
+    Updater(db_adapter, parser, **kwargs).insert_sample()
+    db_adapter.clear_cache()
+
+def _remove(db_adapter, path, sample_name=None, **kwargs):
+    Updater(db_adapter, GVCFParser(path), **kwargs).remove_sample(sample_name)
+    db_adapter.clear_cache()
+
+def _rows(db_adapter):
+    return [tuple(row) for row in db_adapter.query_region('chr1', 1, 1000)]
+
+def _expected(values):
+    """The variants row of (non_ref_af, dp, sample) values computed directly."""
+    af = np.array([value[0] for value in values])
+    return (
+        af.mean(), af.std(), af.max(), af.min(), sum(value[1] for value in values), len(values),
+        values[int(af.argmax())][2], values[int(af.argmin())][2],
+    )
+
+def _assert_row(row, pos, values):
+    assert row.pos == pos
+    assert tuple(row)[2:] == pytest.approx(_expected(values))
+
+@pytest.fixture
+def samples(write_gvcf):
+    return {name: write_gvcf(name, records) for name, records in SAMPLES.items()}
+
+@pytest.mark.parametrize('write_mode', ['orm', 'upsert'])
+def test_records_sharing_a_position_count_once(db_adapter, samples, write_mode):
+    for name in 'ABC':
+        _load(db_adapter, samples[name], write_mode=write_mode)
+    rows = db_adapter.query_region('chr1', 1, 1000)
+    _assert_row(rows[0], 100, [(0.2, 10, 'A'), (0.15, 20, 'B'), (0.5, 10, 'C')])
+    _assert_row(rows[1], 200, [(0.05, 20, 'A'), (0.5, 10, 'B')])
+
+    _remove(db_adapter, samples['B'])
+    _remove(db_adapter, samples['A'])
+    rows = db_adapter.query_region('chr1', 1, 1000)
+    assert len(rows) == 1
+    assert rows[0].number_of_samples == 1
+    assert rows[0].mean_non_ref_af == pytest.approx(0.5)
+    assert rows[0].total_depth == pytest.approx(10)
+
+def test_write_modes_agree(tmp_path, samples):
+    results = []
+    for write_mode in ('orm', 'upsert'):
+        db_adapter = DatabaseAdapter(db_type='sqlite', db_name=str(tmp_path / f'{write_mode}.db'))
+        db_adapter.create_tables()
+        for name in 'ABC':
+            _load(db_adapter, samples[name], write_mode=write_mode)
+        loaded = _rows(db_adapter)
+        _remove(db_adapter, samples['A'])
+        results.append((loaded, _rows(db_adapter)))
+        db_adapter.close()
+    assert results[0] == results[1]
+
+def test_cohort_load_matches_sequential_loads(tmp_path, write_gvcf):
+    # Tied values at every position, so the min/max samples show the order of the samples
+    rng = np.random.default_rng(5)
+    paths = [
+        write_gvcf(f'T{i}', [('chr1', pos, int(rng.choice([0, 5])), 10) for pos in range(1, 101)]) for i in range(4)
+    ]
+    results = []
+    for cohort in (True, False):
+        db_adapter = DatabaseAdapter(db_type='sqlite', db_name=str(tmp_path / f'{cohort}.db'))
+        db_adapter.create_tables()
+        if cohort:
+            _load_parser(db_adapter, CohortParser(paths), write_mode='upsert')
+        else:
+            for path in paths:
+                _load(db_adapter, path, write_mode='upsert')
+        results.append(_rows(db_adapter))
+        db_adapter.close()
+    assert results[0] == results[1]
+
+def test_copy_counts_a_repeated_position_once(pg_adapter, samples):
+    for name in 'ABC':
+        _load(pg_adapter, samples[name], write_mode='copy')
+    rows = pg_adapter.query_region('chr1', 1, 1000)
+    _assert_row(rows[0], 100, [(0.2, 10, 'A'), (0.15, 20, 'B'), (0.5, 10, 'C')])
+    _assert_row(rows[1], 200, [(0.05, 20, 'A'), (0.5, 10, 'B')])
+
+def test_remove_with_contributions_recomputes_extremes(db_adapter, samples):
+    for name in 'ABC':
+        _load(db_adapter, samples[name], contributions=True)
+    # B holds the min at chr1:100, which is recomputed from the contributions of A and C
+    Updater(db_adapter, None).remove_sample('B')
+    db_adapter.clear_cache()
+    rows = db_adapter.query_region('chr1', 1, 1000)
+    _assert_row(rows[0], 100, [(0.2, 10, 'A'), (0.5, 10, 'C')])
+    _assert_row(rows[1], 200, [(0.05, 20, 'A')])
+
+def test_recompute_stats_counts_a_repeated_position_once():
+    batches = [
+        VariantBatch('chr1', np.array([100, 100, 200], dtype=np.int32), np.array([0.2, 0.4, 0.1], dtype=np.float32),
+                     np.array([10, 10, 20], dtype=np.float32), 1),
+        VariantBatch('chr1', np.array([100], dtype=np.int32), np.array([0.5], dtype=np.float32),
+                     np.array([10], dtype=np.float32), 2),
+    ]
+    stats = recompute_stats(batches, np.array([100, 200]))
+    assert stats['number_of_samples'].tolist() == [2, 1]
+    assert stats['mean_non_ref_af'] == pytest.approx([0.35, 0.1])
+    assert stats['sd_non_ref_af'] == pytest.approx([0.15, 0.0])
+    assert stats['total_depth'].tolist() == [20, 20]
+    assert stats['min_non_ref_af_sample'].tolist() == [1, 1]
+    assert stats['max_non_ref_af_sample'].tolist() == [2, 1]
+
+def test_update_stats_matches_direct():
+    values = [0.3, 0.1, 0.7, 0.2, 0.5]
+    (mean, sd, n) = (0, 0, 0)
+    for value in values:
+        (mean, sd, n) = update_stats(mean, sd, n, value)
+    assert (mean, sd, n) == pytest.approx((np.mean(values), np.std(values), 5))
+    for removed in (0.7, 0.3, 0.5):
+        (mean, sd, n) = update_stats(mean, sd, n, removed, operation='remove')
+        values.remove(removed)
+        assert (mean, sd, n) == pytest.approx((np.mean(values), np.std(values), len(values)))
+    (mean, sd, n) = update_stats(mean, sd, n, 0.1, operation='remove')
+    assert update_stats(mean, sd, n, 0.2, operation='remove') == (0, 0, 0)
+
+def test_update_multiple_stats_matches_direct():
+    rng = np.random.default_rng(2)
+    values = rng.random((3, 6))
+    means, sds, ns = values[:, :5].mean(axis=1), values[:, :5].std(axis=1), np.full(3, 5)
+    means, sds, ns = update_multiple_stats(means, sds, ns, values[:, 5])
+    assert means == pytest.approx(values.mean(axis=1))
+    assert sds == pytest.approx(values.std(axis=1))
+    assert ns.tolist() == [6, 6, 6]
+    means, sds, ns = update_multiple_stats(means, sds, ns, values[:, 0], operation='remove')
+    assert means == pytest.approx(values[:, 1:].mean(axis=1))
+    assert sds == pytest.approx(values[:, 1:].std(axis=1))
+    assert ns.tolist() == [5, 5, 5]
+
+def test_update_multiple_stats_removes_last_value():
+    means, sds, ns = update_multiple_stats([0.4, 0.3], [0.0, 0.1], [1, 2], [0.4, 0.2], operation='remove')
+    assert means.tolist() == pytest.approx([0.0, 0.4])
+    assert sds.tolist() == pytest.approx([0.0, 0.0], abs=1e-6)
+    assert ns.tolist() == [0, 1]
+
+def test_combine_stats_matches_direct():
+    rng = np.random.default_rng(3)
+    a, b = rng.random(4), rng.random(7)
+    means, sds, ns = combine_stats([a.mean(), 0.0, a.mean()], [a.std(), 0.0, a.std()], [4, 0, 4],
+                                   [b.mean(), b.mean(), 0.0], [b.std(), b.std(), 0.0], [7, 7, 0])
+    both = np.concatenate((a, b))
+    assert means == pytest.approx([both.mean(), b.mean(), a.mean()])
+    assert sds == pytest.approx([both.std(), b.std(), a.std()])
+    assert ns.tolist() == [11, 7, 4]
+    assert combine_stats([0.0], [0.0], [0], [0.0], [0.0], [0]) == ([0.0], [0.0], [0])
+
+def test_remove_max_holder_leaves_max_empty(db_adapter, samples):
+    for name in 'ABC':
+        _load(db_adapter, samples[name])
+    # C holds the max at chr1:100, without contributions it cannot be recomputed
+    _remove(db_adapter, samples['C'])
+    (row, _) = db_adapter.query_region('chr1', 1, 1000)
+    (mean, sd, _, min_af, depth, number, _, min_sample) = _expected([(0.2, 10, 'A'), (0.15, 20, 'B')])
+    assert (row.mean_non_ref_af, row.sd_non_ref_af, row.min_non_ref_af, row.total_depth) == pytest.approx((mean, sd, min_af, depth))
+    assert (row.number_of_samples, row.min_non_ref_af_sample) == (number, min_sample)
+    assert row.max_non_ref_af is None and row.max_non_ref_af_sample is None
+
+# Reference blocks (start, end, non_ref_af, dp) of three samples with mismatched boundaries and gaps.
+# Bases 21 to 25 are covered by S2 only and 26 to 30 by S3 only.
+BLOCKS = {
+    'S1': [(1, 10, 0.1, 10), (11, 20, 0.3, 20)],
+    'S2': [(5, 15, 0.2, 30), (18, 25, 0.05, 10)],
+    'S3': [(8, 12, 0.4, 20), (26, 30, 0.5, 10)],
+}
+
+def _blocks(name):
+    start, end, af, dp = (np.array(column) for column in zip(*BLOCKS[name]))
+    return VariantBatch('chr1', start.astype(np.int32), af.astype(np.float32), dp.astype(np.float32), name, end.astype(np.int32))
+
+def _per_base(intervals):
+    """Expand intervals to the statistics of every base they cover."""
+    bases = {}
+    for i in range(len(intervals)):
+        stats = tuple(getattr(intervals, column)[i] for column in _STAT_COLUMNS[1:])
+        for pos in range(int(intervals.pos[i]), int(intervals.end[i]) + 1):
+            bases[pos] = stats
+    return bases
+
+def _expected_per_base(names, lost=()):
+    """The statistics of every base covered by the blocks of samples, computed directly.
+
+    The min/max values held by a sample in lost are missing, as after removing it.
+    """
+    values = {}
+    for name in list(names) + list(lost):
+        for start, end, af, dp in BLOCKS[name]:
+            for pos in range(start, end + 1):
+                values.setdefault(pos, []).append((float(np.float32(af)), dp, name))
+    bases = {}
+    for pos, all_values in values.items():
+        counted = [value for value in all_values if value[2] in names]
+        if counted:
+            stats = list(_expected(counted))
+            if max(all_values)[2] in lost:
+                stats[2], stats[6] = np.nan, None
+            if min(all_values)[2] in lost:
+                stats[3], stats[7] = np.nan, None
+            bases[pos] = tuple(stats)
+    return bases
+
+def _assert_per_base(intervals, expected):
+    bases = _per_base(intervals)
+    assert sorted(bases) == sorted(expected)
+    for pos, stats in expected.items():
+        assert bases[pos] == pytest.approx(stats, nan_ok=True), pos
+
+def _assert_coalesced(intervals):
+    """Check that no neighbouring intervals have identical statistics, counting NaN as equal."""
+    for i in range(len(intervals) - 1):
+        if intervals.end[i] + 1 != intervals.pos[i + 1]:
+            continue
+        assert any(
+            not (a == b or (a != a and b != b))
+            for a, b in ((getattr(intervals, column)[i], getattr(intervals, column)[i + 1]) for column in _STAT_COLUMNS[1:])
+        ), intervals.pos[i + 1]
+
+def _merge_all(names):
+    intervals = _blocks(names[0]).take(slice(0, 0)).to_stats(intervals=True)
+    for name in names:
+        intervals = merge_intervals(intervals, _blocks(name).to_stats(intervals=True))
+    return intervals
+
+def test_merge_intervals_matches_per_base():
+    intervals = _merge_all(['S1', 'S2', 'S3'])
+    _assert_per_base(intervals, _expected_per_base(['S1', 'S2', 'S3']))
+    _assert_coalesced(intervals)
+
+def test_merge_intervals_coalesces_identical_pieces():
+    # Two samples with the same value on adjacent blocks leave a single interval
+    first = VariantBatch('chr1', np.array([1, 6], dtype=np.int32), np.array([0.1, 0.1], dtype=np.float32),
+                         np.array([10, 10], dtype=np.float32), 'S1', np.array([5, 10], dtype=np.int32))
+    merged = merge_intervals(first.take(slice(0, 0)).to_stats(intervals=True), first.to_stats(intervals=True))
+    assert (merged.pos.tolist(), merged.end.tolist()) == ([1], [10])
+
+def test_subtract_intervals_coalesces_missing_extremes():
+    # S1 holds the min on 1 to 10 in two blocks, whose pieces both lose it and are joined again
+    s1 = VariantBatch('chr1', np.array([1, 4], dtype=np.int32), np.array([0.1, 0.1], dtype=np.float32),
+                      np.array([10, 10], dtype=np.float32), 'S1', np.array([3, 10], dtype=np.int32))
+    s2 = VariantBatch('chr1', np.array([1], dtype=np.int32), np.array([0.3], dtype=np.float32),
+                      np.array([10], dtype=np.float32), 'S2', np.array([10], dtype=np.int32))
+    merged = merge_intervals(s1.to_stats(intervals=True), s2.to_stats(intervals=True))
+    assert (merged.pos.tolist(), merged.end.tolist()) == ([1], [10])
+    remaining = subtract_intervals(merged, s1)
+    assert (remaining.pos.tolist(), remaining.end.tolist()) == ([1], [10])
+    assert np.isnan(remaining.min_non_ref_af[0]) and remaining.min_non_ref_af_sample[0] is None
+    assert remaining.max_non_ref_af_sample[0] == 'S2'
+
+@pytest.mark.parametrize('removed', ['S1', 'S2', 'S3'])
+def test_subtract_intervals_matches_per_base(removed):
+    remaining = [name for name in ('S1', 'S2', 'S3') if name != removed]
+    intervals = subtract_intervals(_merge_all(['S1', 'S2', 'S3']), _blocks(removed))
+    # Bases covered by the removed sample only are dropped
+    _assert_per_base(intervals, _expected_per_base(remaining, lost=[removed]))
+    _assert_coalesced(intervals)
+
+    recomputed = recompute_extremes(intervals, [_blocks(name) for name in remaining])
+    _assert_per_base(recomputed, _expected_per_base(remaining))
+    _assert_coalesced(recomputed)
+
+# Sample R has blocks and single records on two chromosomes, spread over many batches
+RESUMED = [('chr1', pos, pos % 7, 20) for pos in range(1, 60)] + [('chr1', 60, 3, 20, 90)] + \
+    [('chr1', pos, pos % 5, 10) for pos in range(91, 120)] + [('chr2', pos, pos % 3, 10) for pos in range(1, 40, 2)]
+
+class _Interrupted(Exception):
+    pass
+
+def _load_state(db_adapter):
+    """The variants, reference blocks and contributions of sample R in a database."""
+    db_adapter.clear_cache()
+    variants = [tuple(row) for chr in ('chr1', 'chr2') for row in db_adapter.query_region(chr, 1, 1000)]
+    blocks = [tuple(row) for chr in ('chr1', 'chr2') for row in db_adapter.fetch_reference_blocks(chr, 1, 1000)]
+    session = db_adapter.get_session()
+    try:
+        sample_id = session.execute(select(Sample.id).where(Sample.name == 'R')).scalar()
+        stored = [
+            (batch.chr, batch.pos.tolist(), batch.end.tolist(), batch.non_ref_af.tolist(), batch.dp.tolist())
+            for batch in read_contributions(session, sample_id, 'R')
+        ]
+    finally:
+        session.close()
+    # Contributions are stored per batch, which an interruption splits differently
+    records = sorted(
+        (chr, pos, end, af, dp) for chr, *columns in stored for pos, end, af, dp in zip(*columns)
+    )
+    return variants, blocks, records
+
+@pytest.mark.parametrize('options', [
+    {},
+    {'reference_blocks': True},
+    {'contributions': True},
+    {'reference_blocks': True, 'contributions': True},
+])
+def test_resumed_load_matches_uninterrupted(tmp_path, write_gvcf, monkeypatch, options):
+    paths = {'A': write_gvcf('A', SAMPLES['A'] + [('chr2', 5, 2, 10)]), 'R': write_gvcf('R', RESUMED)}
+    states = []
+    for interrupted in (False, True):
+        db_adapter = DatabaseAdapter(db_type='sqlite', db_name=str(tmp_path / f'{interrupted}.db'))
+        db_adapter.create_tables()
+        _load(db_adapter, paths['A'], **options)
+        if interrupted:
+            write_batch = Updater._write_batch
+            n_batches = []
+            def failing_write_batch(self, *args):
+                n_batches.append(1)
+                if len(n_batches) > 7:
+                    raise _Interrupted()
+                return write_batch(self, *args)
+            with monkeypatch.context() as patch:
+                patch.setattr(Updater, '_write_batch', failing_write_batch)
+                with pytest.raises(_Interrupted):
+                    _load(db_adapter, paths['R'], batch_size=8, checkpoint_interval=2, **options)
+            session = db_adapter.get_session()
+            try:
+                # Some batches were committed before the interruption
+                assert read_progress(session, ['R'])['R'][0] == 'chr1'
+            finally:
+                session.close()
+            Updater(db_adapter, GVCFParser(paths['R']), batch_size=8, checkpoint_interval=2, **options).insert_sample(resume=True)
+        else:
+            _load(db_adapter, paths['R'], batch_size=8, checkpoint_interval=2, **options)
+        states.append(_load_state(db_adapter))
+        db_adapter.close()
+
+    (variants, blocks, records), expected = states[1], states[0]
+    assert len(variants) == len(expected[0])
+    for row, expected_row in zip(variants, expected[0]):
+        assert row[:2] == expected_row[:2]
+        assert row[2:8] == pytest.approx(expected_row[2:8])
+        assert row[8:] == expected_row[8:]
+    assert blocks == expected[1]
+    assert records == expected[2]
+    assert bool(blocks) == bool(options.get('reference_blocks'))
+    assert bool(records) == bool(options.get('contributions'))
@@ -0,0 +1,92 @@
+"""
+Unit tests for the vcf_writer module.
+"""
+
+import gzip
+import pytest
+from cyvcf2 import VCF
+
+from varnoisedb.generations import SinceError
+from varnoisedb.gvcf_parser import GVCFParser
+from varnoisedb.updater import Updater
+from varnoisedb.bgzf import _BLOCK_DATA_SIZE
+from varnoisedb.vcf_writer import patch_vcf, write_vcf
+
+def _update(db_adapter, path, remove=False):
+    updater = Updater(db_adapter, GVCFParser(path))
+    if remove:
+        updater.remove_sample()
+    else:
+        updater.insert_sample()
+    db_adapter.clear_cache()
+
+def _export(db_adapter, path, since=None):
+    session = db_adapter.get_session()
+    try:
+        return write_vcf(session, str(path), chunk_size=2, since=since)
+    finally:
+        session.close()
+
+def _read(path):
+    with (gzip.open(path, 'rt') if str(path).endswith('.gz') else open(path)) as file:
+        return file.read()
+
+def _generation(path):
+    return int(next(line for line in _read(path).splitlines() if line.startswith('##varnoisedb_generation=')).split('=')[1])
+
+@pytest.mark.parametrize('suffix', ['.vcf', '.vcf.gz'])
+def test_delta_patched_onto_export_equals_fresh_export(tmp_path, db_adapter, write_gvcf, suffix):
+    a = write_gvcf('A', [('chr1', 100, 1, 10), ('chr1', 200, 2, 10), ('chr2', 50, 3, 10)])
+    b = write_gvcf('B', [('chr1', 100, 4, 10), ('chr1', 300, 5, 10), ('chr2', 60, 1, 10)])
+    c = write_gvcf('C', [('chr1', 100, 2, 20), ('chr1', 400, 6, 10), ('chr2', 50, 2, 10)])
+    _update(db_adapter, a)
+    _update(db_adapter, b)
+    base = tmp_path / f'base{suffix}'
+    _export(db_adapter, base)
+    since = _generation(base)
+
+    # Changes chr1:100 and chr2:50, adds chr1:400 and deletes chr1:300 and chr2:60
+    _update(db_adapter, c)
+    _update(db_adapter, b, remove=True)
+    delta = tmp_path / f'delta{suffix}'
+    n_changed = _export(db_adapter, delta, since=since)
+    fresh = tmp_path / f'fresh{suffix}'
+    _export(db_adapter, fresh)
+    patched = tmp_path / f'patched{suffix}'
+
+    assert n_changed == 3
+    assert patch_vcf(str(base), str(delta), str(patched), chunk_size=2) == (4, 3, 2)
+    assert _generation(fresh) > since
+    assert _read(patched) == _read(fresh)
+    if suffix == '.vcf.gz':
+        with open(f'{patched}.tbi', 'rb') as patched_index, open(f'{fresh}.tbi', 'rb') as fresh_index:
+            assert patched_index.read() == fresh_index.read()
+
+def test_delta_since_a_later_generation_is_rejected(tmp_path, db_adapter, write_gvcf):
+    _update(db_adapter, write_gvcf('A', [('chr1', 100, 1, 10)]))
+    with pytest.raises(SinceError, match='newer than the database'):
+        _export(db_adapter, tmp_path / 'delta.vcf', since=2)
+
+def test_export_regions_read_through_the_index(tmp_path, db_adapter, write_gvcf):
+    # Enough records to fill several BGZF blocks and tabix windows
+    records = [('chr1', pos, pos % 7, 20) for pos in range(1, 120000, 97)] + [('chr2', pos, 3, 10) for pos in range(10, 5000, 11)]
+    _update(db_adapter, write_gvcf('A', records))
+    output = str(tmp_path / 'variants.vcf.gz')
+    assert _export(db_adapter, output) == len(records)
+
+    lines = _read(output).splitlines(keepends=True)
+    n_header = sum(line.startswith('#') for line in lines)
+    offsets = [0]
+    for line in lines:
+        offsets.append(offsets[-1] + len(line.encode()))
+    # The records whose line starts in one block and ends in the next
+    crossing = [i - n_header for i in range(n_header, len(lines))
+                if offsets[i] // _BLOCK_DATA_SIZE != (offsets[i + 1] - 1) // _BLOCK_DATA_SIZE]
+    assert crossing
+    regions = [('chr1', 1, 500), ('chr1', 16300, 16500), ('chr1', 50000, 90000), ('chr2', 4000, 6000)]
+    regions += [(records[i][0], records[i][1], records[i][1]) for i in crossing]
+    for chr, start, end in regions:
+        found = [(variant.CHROM, variant.POS, variant.INFO['SAMPLES'], round(variant.INFO['MAX_AF'], 4))
+                 for variant in VCF(output)(f'{chr}:{start}-{end}')]
+        assert found == [(chr, pos, 1, round(ad / dp, 4)) for (record_chr, pos, ad, dp) in records
+                         if record_chr == chr and start <= pos <= end]